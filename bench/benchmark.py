@@ -0,0 +1,174 @@
+"""End-to-end benchmark of instadb.main() against the fake Instagram server
+
+usage: benchmark.py [--users N] [--posts N] [--workers N] [--json FILE] ...
+
+Scenarios, each run against fresh or reused temporary folders:
+    cold     Full sync into an empty folder, with --db
+    resync   Full sync again over the files the cold run left
+    new      --new sync over the files the cold run left
+    only-db  --only-db sync into an empty folder
+
+For each scenario it reports posts/sec, MB/sec of media written, mean
+tagging latency per file and database rows/sec. Use --json to keep the
+numbers for comparing runs.
+
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'instadb'))
+
+import instadb  # noqa: E402
+from fake_instagram import FakeInstagram, serve  # noqa: E402
+from network import Retrieve  # noqa: E402
+from stats import stats  # noqa: E402
+
+SCENARIOS = ['cold', 'resync', 'new', 'only-db']
+
+
+def folder_bytes(path):
+    """Total size of the media files under path"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(('.jpg', '.mp4')):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def run_scenario(name, users, path, args, tag_later):
+    """Run instadb.main() once and return its measurements"""
+    options = {
+        'cold': dict(write_db=True),
+        'resync': dict(write_db=True),
+        'new': dict(write_db=True, only_new_files=True),
+        'only-db': dict(only_db=True),
+    }[name]
+
+    before = folder_bytes(path)
+    stats.enable()  # from zero for every scenario
+    with open(os.devnull, 'w') as devnull:
+        with redirect_stdout(devnull):
+            start = time.perf_counter()
+            summaries = instadb.main(users, None, args.rate_limit, path, None,
+                                     None, workers=args.workers,
+                                     media_rate_limit=args.media_rate_limit,
+                                     min_rate_limit=args.min_rate_limit,
+                                     prefetch=args.prefetch, tag_later=tag_later,
+                                     subfolders=True, **options)
+            elapsed = time.perf_counter() - start
+    written = folder_bytes(path) - before
+
+    posts = sum(summary['posts'] for summary in summaries.values())
+    report = stats.as_dict()
+    counters, histograms = report['counters'], report['histograms']
+
+    def seconds(*names):
+        return sum(histograms[name]['sum'] for name in names if name in histograms)
+
+    tagged = counters.get('images_tagged', 0)
+    if 'tag_video' in histograms:
+        tagged += histograms['tag_video']['count']
+    tag_seconds = seconds('tag_video', 'tag_exiftool_batch')
+    db_rows = counters.get('db_rows', 0)
+    db_seconds = seconds('db_query', 'db_commit')
+
+    return OrderedDict([
+        ('scenario', name),
+        ('seconds', round(elapsed, 3)),
+        ('posts', posts),
+        ('posts_per_sec', round(posts / elapsed, 1)),
+        ('mb_per_sec', round(written / elapsed / 2 ** 20, 2)),
+        ('files_tagged', tagged),
+        ('tag_ms_per_file', round(tag_seconds / tagged * 1000, 2)
+         if tagged else None),
+        ('db_rows', db_rows),
+        ('db_rows_per_sec', round(db_rows / db_seconds, 1)
+         if db_seconds else None),
+    ])
+
+
+def print_results(results):
+    """Print the results as a table"""
+    columns = list(results[0].keys())
+    widths = [max(len(column), *(len(str(result[column])) for result in results))
+              for column in columns]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).rjust(width)
+                        for column, width in zip(columns, widths)))
+
+
+def parse_args():
+    """Parse arguments from CLI"""
+    parser = argparse.ArgumentParser(description='Benchmark instadb against a fake Instagram')
+    parser.add_argument('--users', help='Number of users (default: %(default)s)',
+                        type=int, default=1)
+    parser.add_argument('--posts', help='Posts per user (default: %(default)s)',
+                        type=int, default=200)
+    parser.add_argument('--jpeg-kb', type=int, default=150)
+    parser.add_argument('--mp4-kb', type=int, default=2000)
+    parser.add_argument('--latency', help='Seconds added to every response',
+                        type=float, default=0.0)
+    parser.add_argument('--error-rate', help='Fraction of requests that get an error',
+                        type=float, default=0.0)
+    parser.add_argument('--error-status', help='HTTP status of those errors (default: %(default)s)',
+                        type=int, default=503)
+    parser.add_argument('--retry-after', help='Retry-After seconds sent with the errors',
+                        type=int)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--prefetch', type=int, default=1)
+    parser.add_argument('--rate-limit', type=float, default=0)
+    parser.add_argument('--media-rate-limit', type=float)
+    parser.add_argument('--min-rate-limit', type=float)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--json', help='Also write the results to this file',
+                        metavar='FILE')
+    return parser.parse_args()
+
+
+def main(args):
+    """Start the fake server, run the scenarios, report"""
+    fake = FakeInstagram(args.posts, args.jpeg_kb, args.mp4_kb, args.latency,
+                         args.error_rate, error_status=args.error_status,
+                         retry_after=args.retry_after)
+    server = serve(fake)
+    instadb.BASE_URL = 'http://127.0.0.1:{}/{{}}/media/'.format(fake.port)
+    Retrieve.JSON_HOST = '127.0.0.1'
+    # Nobody is around to type in a proxy, retry on the same connection
+    Retrieve.new_proxy = lambda retrieve: retrieve.proxy
+
+    tag_later = not shutil.which('exiftool')
+    if tag_later:
+        print('[!] exiftool not found, files are recorded with --tag-later '
+              'instead of tagged\n')
+
+    users = ['user{}'.format(num) for num in range(args.users)]
+    workdir = tempfile.mkdtemp(prefix='instadb-bench-')
+    results = []
+    try:
+        for name in args.scenarios:
+            # resync and new reuse what cold downloaded
+            path = os.path.join(workdir, 'only-db' if name == 'only-db' else 'sync')
+            results.append(run_scenario(name, users, path, args, tag_later))
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'settings': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+
+    main(parse_args())
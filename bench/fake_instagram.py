@@ -0,0 +1,244 @@
+"""A local stand-in for Instagram's /{user}/media/ endpoint and CDN
+
+Serves synthetic pages in the format JsonPage expects, plus JPEG and MP4
+payloads of a configurable size, with optional latency and errors.
+
+usage: fake_instagram.py [--port PORT] [--posts N] [--jpeg-kb KB] ...
+
+Pages are served from http://127.0.0.1:PORT/{user}/media/ and media from
+http://localhost:PORT/cdn/..., so the two land in different rate limiters.
+Pages carry an ETag and answer a matching If-None-Match with a 304.
+
+"""
+import argparse
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+PAGE_SIZE = 20
+FIRST_TIMESTAMP = 1483228800  # 2017-01-01, posts are an hour apart
+
+
+def fake_jpeg(size):
+    """Return a valid 1x1 JPEG padded to about `size` bytes with COM segments"""
+    head = bytes.fromhex(
+        'ffd8ffe000104a46494600010100000100010000'
+        'ffdb004300' + '01' * 64 +
+        'ffc0000b080001000101011100'
+        'ffc4001f0000010501010101010100000000000000000102030405060708090a0b'
+        'ffc400b5100002010303020403050504040000017d01020300041105122131410613'
+        '516107227114328191a1082342b1c11552d1f02433627282090a161718191a2526'
+        '2728292a3435363738393a434445464748494a535455565758595a636465666768'
+        '696a737475767778797a838485868788898a92939495969798999aa2a3a4a5a6a7'
+        'a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3'
+        'e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9fa')
+    scan = bytes.fromhex('ffda0008010100003f00d2cf20ffd9')
+
+    padding = b''
+    remaining = size - len(head) - len(scan)
+    while remaining > 4:
+        chunk = min(remaining - 4, 65533)
+        padding += b'\xff\xfe' + struct.pack('>H', chunk + 2) + b'\0' * chunk
+        remaining -= chunk + 4
+    return head + padding + scan
+
+
+def fake_mp4(size):
+    """Return a minimal MP4 (ftyp, moov/mvhd, mdat) of about `size` bytes"""
+    def atom(name, data):
+        return struct.pack('>I', 8 + len(data)) + name + data
+
+    mvhd = atom(b'mvhd', b'\0' * 4 + struct.pack('>IIII', 0, 0, 1000, 5000) +
+                b'\0\x01\0\0' + b'\x01\0' + b'\0' * 10 + b'\0' * 36 +
+                b'\0' * 24 + struct.pack('>I', 2))
+    head = atom(b'ftyp', b'isom\0\0\x02\0isomiso2mp41') + atom(b'moov', mvhd)
+    return head + atom(b'mdat', b'\0' * max(size - len(head) - 8, 0))
+
+
+class FakeInstagram:
+    """Settings and payloads shared by every request handler"""
+
+    def __init__(self, posts=200, jpeg_kb=150, mp4_kb=2000, latency=0.0,
+                 error_rate=0.0, carousel_size=3, seed=0, error_status=503,
+                 retry_after=None, short_body=None):
+        """
+        posts: Posts per user
+        jpeg_kb, mp4_kb: Payload sizes
+        latency: Seconds added to every response
+        error_rate: Fraction of requests answered with an error
+        carousel_size: Slides per carousel post
+        seed: Random seed for the error injection
+        error_status: Status of those errors, e.g. 429
+        retry_after: Retry-After seconds sent with the errors
+        short_body: Bytes of each media response sent before the connection
+                    is closed, short of its Content-Length (None sends it all)
+
+        """
+        self.posts = posts
+        self.jpeg = fake_jpeg(jpeg_kb * 1024)
+        self.mp4 = fake_mp4(mp4_kb * 1024)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.carousel_size = carousel_size
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.short_body = short_body
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.port = None
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def item(self, user, num):
+        """Post number `num` (0 is the newest) in /media/ JSON format"""
+        cdn = 'http://localhost:{}/cdn/{}_{}'.format(self.port, user, num)
+        post_type = ['image', 'video', 'carousel', 'image'][num % 4]
+        item = {
+            'id': str(self.posts - num),
+            'code': 'B{}{:09d}'.format(user[:1].upper(), num),
+            'created_time': str(FIRST_TIMESTAMP + (self.posts - num) * 3600),
+            'type': post_type,
+            'likes': {'count': (num * 37) % 5000},
+            'location': {'name': 'Somewhere'} if num % 3 else None,
+            'caption': {'text': 'Post {} by {}\n#fake'.format(num, user)},
+            'images': {'standard_resolution': {'url': cdn + '/p640x640/img.jpg'}},
+            'videos': {'standard_resolution': {'url': cdn + '/vid.mp4'}},
+        }
+        if post_type == 'carousel':
+            item['carousel_media'] = [
+                {'type': 'video',
+                 'videos': {'standard_resolution': {'url': '{}_{}.mp4'.format(cdn, slide)}}}
+                if slide % 2 else
+                {'type': 'image',
+                 'images': {'standard_resolution': {'url': '{}_{}.jpg'.format(cdn, slide)}}}
+                for slide in range(self.carousel_size)]
+        return item
+
+    def page(self, user, max_id):
+        """The page of posts older than max_id (the newest page if None)"""
+        first = 0 if max_id is None else self.posts - int(max_id) + 1
+        last = min(first + PAGE_SIZE, self.posts)
+        return {'status': 'ok',
+                'items': [self.item(user, num) for num in range(first, last)],
+                'more_available': last < self.posts}
+
+
+class Handler(BaseHTTPRequestHandler):
+    fake = None  # set by serve()
+
+    def do_GET(self):
+        fake = self.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.should_fail():
+            self.send_response(fake.error_status)
+            if fake.retry_after is not None:
+                self.send_header('Retry-After', str(fake.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+
+        if len(parts) == 2 and parts[1] == 'media':
+            max_id = parse_qs(url.query).get('max_id', [None])[0]
+            body = json.dumps(fake.page(parts[0], max_id)).encode('UTF-8')
+            content_type = 'application/json'
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+        elif parts[0] == 'cdn' and url.path.endswith('.jpg'):
+            body, content_type = fake.jpeg, 'image/jpeg'
+        elif parts[0] == 'cdn' and url.path.endswith('.mp4'):
+            body, content_type = fake.mp4, 'video/mp4'
+        else:
+            self.send_error(404)
+            return
+
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            start = int(range_header[len('bytes='):].split('-')[0])
+            if start >= len(body):
+                self.send_error(416)
+                return
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if content_type == 'application/json':
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        if fake.short_body is not None and content_type != 'application/json':
+            self.wfile.write(body[start:start + fake.short_body])
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, format, *args):
+        pass  # keep benchmark output readable
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(fake, port=0):
+    """Start the server on a background thread
+
+    returns: The HTTPServer, call shutdown() when done
+
+    """
+    Handler.fake = fake
+    server = ThreadingServer(('127.0.0.1', port), Handler)
+    fake.port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args():
+    """Parse arguments from CLI"""
+    parser = argparse.ArgumentParser(description='Serve fake Instagram pages and media')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--posts', help='Posts per user (default: %(default)s)',
+                        type=int, default=200)
+    parser.add_argument('--jpeg-kb', type=int, default=150)
+    parser.add_argument('--mp4-kb', type=int, default=2000)
+    parser.add_argument('--latency', help='Seconds added to every response',
+                        type=float, default=0.0)
+    parser.add_argument('--error-rate', help='Fraction of requests that get an error',
+                        type=float, default=0.0)
+    parser.add_argument('--error-status', help='HTTP status of those errors (default: %(default)s)',
+                        type=int, default=503)
+    parser.add_argument('--retry-after', help='Retry-After seconds sent with the errors',
+                        type=int)
+    parser.add_argument('--short-body', help='Bytes of each media file sent before '
+                        'the connection is cut short', type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    ARGS = parse_args()
+    FAKE = FakeInstagram(ARGS.posts, ARGS.jpeg_kb, ARGS.mp4_kb, ARGS.latency,
+                         ARGS.error_rate, error_status=ARGS.error_status,
+                         retry_after=ARGS.retry_after, short_body=ARGS.short_body)
+    SERVER = serve(FAKE, ARGS.port)
+    print('Serving http://127.0.0.1:{}/{{user}}/media/'.format(FAKE.port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        SERVER.shutdown()
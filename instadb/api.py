@@ -0,0 +1,265 @@
+"""instadb as a library, for long-running workers
+
+Nothing here prints, asks for input or exits: failures are exceptions and
+progress comes back from generators. The long-lived pieces (the Retrieve
+with its session and rate limits, each user's Database, a download pool)
+belong to the caller and are passed in, so a worker sets them up once
+instead of once per account. metadata, and with it mutagen, is imported
+the first time a video is downloaded.
+
+    retrieve = api.retriever(session=requests.Session(), rate_limit=2)
+    for post in api.iter_posts('espn', retrieve):
+        ...
+
+    db = Database('espn', folder)
+    for result in api.sync_user('espn', retrieve, folder, db=db):
+        ...
+    db.close()
+
+"""
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import as_completed
+
+from database import media_filenames
+from manifest import Manifest
+from network import Retrieve
+from parsejson import JsonPage
+from pipeline import TagJob
+
+BASE_URL = 'https://www.instagram.com/{}/media/'
+
+log = logging.getLogger('instadb')
+
+# What sync_user() did with one post
+#   post: The parsed Post (see parsejson.Post)
+#   db_status: 'new', 'changed' or 'unchanged' (see Database.upsert()),
+#              None without a database
+#   files: List of FileResults, empty when media isn't downloaded
+PostResult = namedtuple('PostResult', 'post db_status files')
+
+# One media file of a post
+#   status: 'downloaded', 'linked' (to an identical file, see ContentIndex),
+#           'cloned' (shares its media with a file tagged for another post),
+#           'existing' (already on disk) or 'missing' (404)
+#   digest: Hash of the server's bytes of a downloaded file, else None
+#   tagged: The file has its metadata (videos get it while downloading)
+FileResult = namedtuple('FileResult', 'filename path status digest tagged')
+
+
+class UserError(Exception):
+    """A single user can't be synced (private, missing, ...)"""
+
+
+def retriever(proxy=None, rate_limit=0, media_rate_limit=None, workers=1,
+              cache=None, proxies=None, min_rate_limit=None, session=None):
+    """Return a Retrieve that never prompts and logs instead of printing
+
+    A request that fails for a reason other than a 429 or 5xx raises
+    network.FetchError instead of asking for a new proxy, and so does a URL
+    that keeps failing (Retrieve.MAX_FAILURES times). Messages go to the
+    "instadb" logger. See Retrieve for the parameters.
+
+    session: Optional requests Session to reuse, e.g. one per worker
+
+    """
+    return Retrieve(proxy, rate_limit, media_rate_limit, workers, cache, proxies,
+                    min_rate_limit, session=session, interactive=False,
+                    log=lambda message: log.warning(message.strip('\n\007')))
+
+
+def iter_pages(user, retrieve, end_cursor=''):
+    """Yield a user's pages of posts, newest first
+
+    Pages are only requested as the iteration needs them, so stopping early
+    costs nothing further.
+
+    user: Instagram user
+    retrieve: Retrieve to send the requests through, see retriever()
+    end_cursor: Only posts older than this Post.id, e.g. the last one an
+                earlier iteration got to
+
+    yields: parsejson.JsonPage objects, each an iterable of Posts
+
+    raises: UserError if the user is private or can't be fetched,
+            network.FetchError, parsejson.BadJson
+
+    """
+    base_url = BASE_URL.format(user)
+    posts = 0
+    while True:
+        resp = retrieve.get(base_url, end_cursor)
+        if not resp:
+            raise UserError('Can\'t get posts for {}'.format(user))
+        page = JsonPage(resp)
+        if page.private_user(posts):
+            raise UserError('Private user {}'.format(user))
+
+        posts += len(page.posts)
+        yield page
+        if not page.posts or not page.more_available():
+            return
+        end_cursor = page.posts[-1].id
+
+
+def iter_posts(user, retrieve, end_cursor=''):
+    """Yield a user's posts, newest first
+
+    See iter_pages() for the parameters and exceptions.
+
+    yields: parsejson.Post tuples
+
+    """
+    for page in iter_pages(user, retrieve, end_cursor):
+        yield from page
+
+
+def sync_user(user, retrieve, directory, db=None, tags=None, end_cursor='',
+              download=True, only_photos=False, only_videos=False,
+              min_likes=0, pool=None, tagger=None, content_index=None,
+              snapshot=False, reserve_only=False):
+    """Write a user's posts to db and download their media, post by post
+
+    A generator: every step hands back one post, and the caller decides how
+    far to go. Posts are synced a page at a time (see sync_posts()), so
+    stopping halfway through a page stops once that page is done. db is
+    flushed when the generator finishes or is closed, and is left open for
+    the next user.
+
+    user: Instagram user
+    retrieve: Retrieve to send the requests through, see retriever()
+    directory: Folder for the user's media files (must exist)
+    end_cursor: Start below this Post.id, see iter_pages()
+    download: Download media files (False only writes db)
+
+    See sync_posts() for the other parameters.
+
+    yields: A PostResult for each post, newest first
+
+    raises: Same as iter_pages()
+
+    """
+    manifest = Manifest(user, directory) if download else None
+    try:
+        for page in iter_pages(user, retrieve, end_cursor):
+            yield from sync_posts(user, page, retrieve, directory, manifest, db,
+                                  tags, only_photos, only_videos, min_likes, pool,
+                                  tagger, content_index, snapshot, reserve_only)
+    finally:
+        if db:
+            db.flush()
+
+
+def sync_posts(user, posts, retrieve, directory, manifest=None, db=None,
+               tags=None, only_photos=False, only_videos=False, min_likes=0,
+               pool=None, tagger=None, content_index=None, snapshot=False,
+               reserve_only=False):
+    """Write a batch of posts (a page, say) to db and download their media
+
+    The whole batch's files are downloaded at once on pool, and each is
+    linked or handed to tagger as soon as it's finished. db isn't flushed.
+
+    user: Instagram user
+    posts: Iterable of parsejson.Posts, e.g. a JsonPage
+    retrieve: Retrieve to send the requests through, see retriever()
+    directory: Folder for the user's media files (must exist)
+    manifest: Manifest of directory, None to only write db
+    db: Optional Database for the user, or a catalog.CatalogUser
+    tags: List of tags used for metadata
+        Default: [user, 'instagram']
+    only_photos, only_videos: Download one kind of media file
+    min_likes: Only download posts with at least this many likes
+    pool: Optional ThreadPoolExecutor to download the files on
+    tagger: Optional pipeline.TaggingStage for the files that weren't tagged
+            while downloading (images, videos with mdat first), given a
+            log so it doesn't print. Without it they're left untagged,
+            see FileResult.tagged.
+    content_index: Optional dedupe.ContentIndex; identical downloads
+                   (tags included) become hardlinks of each other, videos
+                   that only differ in their tags reflinks
+    snapshot: Also record every post's likes count in db's likes history
+    reserve_only: Only reserve room for videos' tags, for a tagger that
+                  tags them later (pipeline.PendingTags)
+
+    returns: List of PostResults, in the order of posts
+
+    """
+    tags = tags or [user, 'instagram']
+    results = []
+    jobs = []  # (post, files, slot, url, filename, path)
+    for post in posts:
+        db_status = None
+        if db:
+            db_status = db.upsert(post.date, post.type, post.code, post.likes,
+                                  post.location, post.caption, post.media)
+            if snapshot:
+                db.snapshot_likes(post.code, post.likes)
+
+        files = []
+        if manifest is not None and post.likes >= min_likes:
+            # Carousel files are numbered by position in the post, so
+            # files skipped by only_photos or only_videos keep their
+            # numbers when they're filled in later.
+            for url, filename in zip(post.media, media_filenames(
+                    user, post.code, post.type, post.media)):
+                if only_photos and not filename.endswith('.jpg'):
+                    continue
+                if only_videos and not filename.endswith('.mp4'):
+                    continue
+                path = os.path.join(directory, filename)
+                if filename in manifest:
+                    files.append(FileResult(filename, path, 'existing', None, None))
+                else:
+                    jobs.append((post, files, len(files), url, filename, path))
+                    files.append(None)  # filled in once it's downloaded
+        results.append(PostResult(post, db_status, files))
+
+    def fetch(job):
+        post, _, _, url, _, path = job
+        return job, fetch_file(retrieve, url, path, user, post.date, post.caption,
+                               tags, post.code, reserve_only=reserve_only)
+
+    if pool:
+        done = (future.result() for future in
+                as_completed([pool.submit(fetch, job) for job in jobs]))
+    else:
+        done = map(fetch, jobs)
+    for (post, files, slot, _, filename, path), (digest, tagged) in done:
+        if not digest:  # Instagram 404'd the media link
+            files[slot] = FileResult(filename, path, 'missing', None, False)
+            continue
+        manifest.add(filename, os.path.getsize(path))
+        files[slot] = finish_file(user, post, tags, filename, path, digest,
+                                  tagged, tagger, content_index)
+    return results
+
+
+def fetch_file(retrieve, url, path, user, date, caption, tags, code,
+               reserve_only=False):
+    """Download one media file, tagging videos on the way to disk
+
+    reserve_only: Only reserve room for a video's tags, see VideoTagStream
+
+    returns: (content hash, tagged), or (False, False) if the URL is 404'd
+
+    """
+    video_tagger = None
+    if path.endswith('.mp4'):
+        from metadata import VideoTagStream  # loads mutagen
+        video_tagger = VideoTagStream(user, date, caption, tags, code,
+                                      reserve_only=reserve_only, log=retrieve.log)
+    digest = retrieve.download(url, path, video_tagger)
+    return digest, bool(digest and video_tagger and video_tagger.tagged)
+
+
+def finish_file(user, post, tags, filename, path, digest, tagged, tagger,
+                content_index):
+    """Link or queue a downloaded file for tagging, return its FileResult"""
+    job = TagJob(path, user, post.date, post.caption, tags, post.code)
+    link = content_index.link_duplicate(digest, job) if content_index else None
+    if link == 'linked':
+        return FileResult(filename, path, 'linked', digest, True)
+    if not tagged and tagger:
+        tagger.submit(job)
+    return FileResult(filename, path, link or 'downloaded', digest, tagged)
@@ -0,0 +1,143 @@
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from stats import stats
+
+try:
+    import requests
+except ImportError:
+    raise ImportError('Requests not installed\npip3 install requests') from None
+
+
+class ResponseCache:
+    """On-disk cache of JSON page responses, keyed by URL (cursor included)
+
+    A fresh entry is served without a request. A stale one is revalidated
+    with If-None-Match / If-Modified-Since, and a 304 is answered from disk.
+    How long an entry stays fresh depends on the page: the first page of a
+    user changes all the time, pages deep in history almost never do.
+
+    Entries are evicted least recently used first once the bodies add up to
+    more than max_bytes.
+
+    """
+
+    def __init__(self, path, max_bytes=200 * 2 ** 20, first_page_ttl=0,
+                 history_ttl=7 * 24 * 3600):
+        """
+        path: SQLite file the cache lives in
+        max_bytes: Total size of cached bodies before eviction
+        first_page_ttl: Seconds a user's first page (no max_id) is fresh
+        history_ttl: Seconds any later page (?max_id=...) is fresh
+
+        """
+        self.max_bytes = max_bytes
+        self.first_page_ttl = first_page_ttl
+        self.history_ttl = history_ttl
+        self.lock = threading.Lock()
+
+        # Shared by the page fetcher threads, hence the lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses('
+                          'url TEXT PRIMARY KEY,'
+                          'etag TEXT,'
+                          'last_modified TEXT,'
+                          'content_type TEXT,'
+                          'body BLOB,'
+                          'size INT,'
+                          'fetched REAL,'
+                          'used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_used '
+                          'ON responses(used)')
+        self.conn.commit()
+
+    def ttl(self, url):
+        """Return how many seconds a response for url stays fresh"""
+        if 'max_id' in parse_qs(urlparse(url).query):
+            return self.history_ttl
+        return self.first_page_ttl
+
+    def lookup(self, url):
+        """Return the cached entry for url as a dict, or None"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT etag, last_modified, content_type, body, fetched '
+                'FROM responses WHERE url=?', (url,)).fetchone()
+        if not row:
+            return None
+        etag, last_modified, content_type, body, fetched = row
+        return {'etag': etag, 'last_modified': last_modified,
+                'content_type': content_type, 'body': body,
+                'fresh': time.time() - fetched < self.ttl(url)}
+
+    def conditional_headers(self, entry):
+        """Return the headers that revalidate a cached entry"""
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def response(self, url, entry):
+        """Build a 200 requests.Response out of a cached entry"""
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = url
+        resp._content = entry['body']
+        resp.encoding = 'UTF-8'
+        if entry['content_type']:
+            resp.headers['Content-Type'] = entry['content_type']
+        return resp
+
+    def hit(self, url, entry, revalidated=False):
+        """Serve a cached entry, bumping it for LRU (and freshness on a 304)"""
+        now = time.time()
+        with self.lock:
+            if revalidated:
+                self.conn.execute('UPDATE responses SET fetched=?, used=? '
+                                  'WHERE url=?', (now, now, url))
+            else:
+                self.conn.execute('UPDATE responses SET used=? WHERE url=?',
+                                  (now, url))
+            self.conn.commit()
+        stats.count('cache_revalidated' if revalidated else 'cache_hits')
+        return self.response(url, entry)
+
+    def store(self, url, resp):
+        """Cache a 200 response, then evict down to max_bytes"""
+        body = resp.content
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO responses '
+                              'VALUES(?, ?, ?, ?, ?, ?, ?, ?)',
+                              (url, resp.headers.get('ETag'),
+                               resp.headers.get('Last-Modified'),
+                               resp.headers.get('Content-Type'),
+                               body, len(body), now, now))
+            self.evict()
+            self.conn.commit()
+        stats.count('cache_misses')
+
+    def evict(self):
+        """Drop least recently used entries until under max_bytes"""
+        total = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute('SELECT url, size FROM responses ORDER BY used')
+        doomed = []
+        for url, size in rows:
+            if total <= self.max_bytes:
+                break
+            doomed.append((url,))
+            total -= size
+        self.conn.executemany('DELETE FROM responses WHERE url=?', doomed)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,210 @@
+import os
+import sqlite3
+import time
+
+from database import Database, KnownPosts, media_filenames, media_type
+from stats import stats
+
+
+class Catalog:
+    """One database for every user of an archive, instead of a {user}.db each
+
+    Batch runs write all their users through one connection and one WAL
+    journal, and cross-account queries are plain SQL. The tables are those
+    of a user database with a `user` column in front:
+
+        posts(user, code, date, type, likes, location, caption, updated)
+            keyed by (user, code), indexed on (user, date), likes and
+            (updated, user, code)
+        media(user, code, position, type, url, filename)
+        likes_history(user, code, time, likes)
+
+    Rows are written through the per-user writers that for_user() returns.
+    Existing {user}.db files are merged in with import_database().
+
+    """
+    FILENAME = 'catalog.db'
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path, synchronous='NORMAL', batch_size=500):
+        """
+        path: SQLite file of the catalog, normally FILENAME in the archive
+              folder
+        synchronous: SQLite PRAGMA synchronous level (OFF, NORMAL, FULL, EXTRA)
+        batch_size: Commit automatically after this many written rows, from
+                    all users together
+
+        """
+        if synchronous.upper() not in Database.SYNCHRONOUS_LEVELS:
+            raise ValueError('synchronous must be one of {}'.format(
+                ', '.join(Database.SYNCHRONOUS_LEVELS)))
+
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.cur = self.conn.cursor()
+        self.cur.execute('PRAGMA journal_mode=WAL')
+        self.cur.execute('PRAGMA synchronous={}'.format(synchronous.upper()))
+        self.create_tables()
+
+        self.batch_size = batch_size
+        self.uncommitted = 0
+        self.snapshot_time = int(time.time())
+        self.snapshots = []  # (user, code, time, likes) rows for the next flush
+
+    def create_tables(self):
+        """Create the catalog tables in an empty file"""
+        version = self.cur.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        with self.conn:
+            self.cur.execute('CREATE TABLE posts('
+                             'user TEXT,'
+                             'code TEXT,'
+                             'date TEXT,'
+                             'type TEXT,'
+                             'likes INT,'
+                             'location TEXT,'
+                             'caption TEXT,'
+                             'updated INT DEFAULT 0,'
+                             'PRIMARY KEY(user, code))')
+            self.cur.execute('CREATE INDEX posts_user_date ON posts(user, date)')
+            self.cur.execute('CREATE INDEX posts_likes ON posts(likes)')
+            self.cur.execute('CREATE INDEX posts_updated ON posts(updated, user, code)')
+            self.cur.execute('CREATE TABLE media('
+                             'user TEXT,'
+                             'code TEXT,'
+                             'position INT,'
+                             'type TEXT,'
+                             'url TEXT,'
+                             'filename TEXT,'
+                             'PRIMARY KEY(user, code, position)) WITHOUT ROWID')
+            self.cur.execute('CREATE TABLE likes_history('
+                             'user TEXT,'
+                             'code TEXT,'
+                             'time INT,'
+                             'likes INT,'
+                             'PRIMARY KEY(user, code, time)) WITHOUT ROWID')
+            self.cur.execute('PRAGMA user_version={}'.format(self.SCHEMA_VERSION))
+
+    def for_user(self, user):
+        """Return a CatalogUser, the Database stand-in for one user's sync"""
+        return CatalogUser(self, user)
+
+    def import_database(self, user, path):
+        """Merge a {user}.db file into the catalog in one transaction
+
+        The file is attached and copied table by table with INSERT ...
+        SELECT, so rows never pass through Python. A post that's already in
+        the catalog keeps whichever likes count was written last. Files
+        older than the current user database schema are migrated first.
+
+        user: Instagram user the file belongs to
+        path: The {user}.db file
+
+        returns: Number of posts in the file
+
+        """
+        self.flush()
+        conn = sqlite3.connect(path)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        conn.close()
+        if version < Database.SCHEMA_VERSION:
+            Database(user, os.path.dirname(path)).close()
+
+        self.cur.execute('ATTACH DATABASE ? AS source', (path,))
+        try:
+            with self.conn:
+                self.cur.execute(
+                    'INSERT INTO posts SELECT ?, code, date, type, likes, location, '
+                    'caption, updated FROM source.posts WHERE 1 '
+                    'ON CONFLICT(user, code) DO UPDATE SET likes=excluded.likes, '
+                    'updated=excluded.updated WHERE excluded.updated >= posts.updated',
+                    (user,))
+                self.cur.execute('INSERT OR IGNORE INTO media SELECT ?, code, position, '
+                                 'type, url, filename FROM source.media', (user,))
+                self.cur.execute('INSERT OR IGNORE INTO likes_history SELECT ?, code, '
+                                 'time, likes FROM source.likes_history', (user,))
+                posts = self.cur.execute('SELECT COUNT(*) FROM source.posts').fetchone()[0]
+        finally:
+            self.cur.execute('DETACH DATABASE source')
+        stats.count('db_rows', posts)
+        return posts
+
+    def flush(self):
+        """Commit everything written since the last flush"""
+        if self.snapshots:
+            with stats.timer('db_query'):
+                self.cur.executemany('INSERT OR REPLACE INTO likes_history '
+                                     'VALUES(?, ?, ?, ?)', self.snapshots)
+            stats.count('likes_snapshots', len(self.snapshots))
+            self.uncommitted += len(self.snapshots)
+            self.snapshots = []
+        if self.uncommitted:
+            with stats.timer('db_commit'):
+                self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        """Commit outstanding rows and close the connection"""
+        self.flush()
+        self.conn.close()
+
+
+class CatalogUser:
+    """One user's view of a Catalog, with the writing methods of Database
+
+    sync_user() uses it in place of a Database. close() only flushes; the
+    catalog's connection stays open for the next user.
+
+    """
+
+    def __init__(self, catalog, user):
+        self.catalog = catalog
+        self.user = user
+        # One query up front, along the (user, code) primary key
+        self.known = KnownPosts(catalog.cur.execute(
+            'SELECT code, likes FROM posts WHERE user=? ORDER BY code', (user,)))
+
+    def existing_entry(self, code):
+        """Check if a post shortcode already exists in the catalog"""
+        return code in self.known
+
+    def upsert(self, date, post_type, code, likes, location, caption, media_files):
+        """Insert a post, or update its likes count, see Database.upsert()"""
+        stored_likes = self.known.get(code)
+        if stored_likes == likes:
+            return 'unchanged'
+
+        catalog = self.catalog
+        with stats.timer('db_query'):
+            catalog.cur.execute('INSERT INTO posts VALUES(?, ?, ?, ?, ?, ?, ?, ?) '
+                                'ON CONFLICT(user, code) DO UPDATE SET '
+                                'likes=excluded.likes, updated=excluded.updated',
+                                (self.user, code, date, post_type, likes, location,
+                                 caption, int(time.time())))
+            if stored_likes is None:
+                filenames = media_filenames(self.user, code, post_type, media_files)
+                catalog.cur.executemany(
+                    'INSERT OR IGNORE INTO media VALUES(?, ?, ?, ?, ?, ?)',
+                    [(self.user, code, position, media_type(filename), url, filename)
+                     for position, (url, filename)
+                     in enumerate(zip(media_files, filenames), 1)])
+        stats.count('db_rows')
+        self.known.set(code, likes)
+        catalog.uncommitted += 1
+
+        status = 'new' if stored_likes is None else 'changed'
+        if catalog.uncommitted >= catalog.batch_size:
+            catalog.flush()
+        return status
+
+    def snapshot_likes(self, code, likes):
+        """Queue a post's likes count for likes_history"""
+        self.catalog.snapshots.append((self.user, code, self.catalog.snapshot_time,
+                                       likes))
+
+    def flush(self):
+        self.catalog.flush()
+
+    def close(self):
+        self.catalog.flush()
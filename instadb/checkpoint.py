@@ -0,0 +1,84 @@
+import json
+import os
+
+
+def post_number(post_id):
+    """Return a post ID as a number that grows with time, or None
+
+    Media IDs look like "{media id}_{owner id}" and the media part
+    increases with every upload, so it orders posts newest first.
+
+    """
+    try:
+        return int(str(post_id).split('_')[0])
+    except ValueError:
+        return None
+
+
+class Checkpoint:
+    """How far a user's syncs have got, saved after every page
+
+    The range from `top` (the newest post a sync started at) down to
+    `cursor` (the max_id of the next page) has been walked without gaps.
+    `complete` means the range runs all the way to the user's first post.
+
+    """
+    FILENAME = '{}.checkpoint.json'
+
+    def __init__(self, user, directory='.'):
+        """
+        user: Instagram user, the file is "{user}.checkpoint.json"
+        directory: Downloads folder for the user
+
+        """
+        self.path = os.path.join(directory, self.FILENAME.format(user))
+        self.top = None
+        self.cursor = ''
+        self.post_counter = 0
+        self.complete = False
+
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='UTF-8') as file:
+                state = json.load(file)
+            self.top = state['top']
+            self.cursor = state['cursor']
+            self.post_counter = state['post_counter']
+            self.complete = state['complete']
+        except (OSError, ValueError, KeyError) as error:
+            print('\n[!] Ignoring unreadable checkpoint {}: {}\n'.format(
+                self.path, error))
+
+    def __bool__(self):
+        return self.top is not None
+
+    def covers(self, post_id):
+        """True if post_id is at or below the top of the checkpointed range"""
+        top, number = post_number(self.top), post_number(post_id)
+        return None not in (top, number) and number <= top
+
+    def passed(self, post_id):
+        """True if post_id is at or below the cursor, past the checkpointed range"""
+        cursor, number = post_number(self.cursor), post_number(post_id)
+        return None not in (cursor, number) and number <= cursor
+
+    def save(self, top, cursor, post_counter, complete=False):
+        """Record a gapless range and write it to disk
+
+        The file is replaced atomically and synced, so a crash leaves
+        either the old checkpoint or the new one.
+
+        """
+        self.top = top
+        self.cursor = cursor
+        self.post_counter = post_counter
+        self.complete = complete
+
+        state = {'top': top, 'cursor': cursor, 'post_counter': post_counter,
+                 'complete': complete}
+        with open(self.path + '.tmp', 'w', encoding='UTF-8') as file:
+            json.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.path + '.tmp', self.path)
@@ -1,17 +1,143 @@
+import os
 import sqlite3
+import time
+from array import array
+from bisect import bisect_left
+
+from stats import stats
+
+
+class KnownPosts:
+    """Shortcodes and likes counts of every stored post, held in memory
+
+    Rows loaded at startup are kept as one sorted list of codes (searched
+    with bisect) plus a parallel array of likes, which is far smaller than a
+    dict of the same rows. Posts first seen during this run go in a dict.
+
+    """
+
+    def __init__(self, rows):
+        """
+        rows: Iterable of (code, likes) tuples sorted by code
+
+        """
+        self.codes = []
+        self.likes = array('q')
+        for code, likes in rows:
+            self.codes.append(code)
+            self.likes.append(-1 if likes is None else likes)
+        self.added = {}
+
+    def __len__(self):
+        return len(self.codes) + len(self.added)
+
+    def __contains__(self, code):
+        return code in self.added or self.index(code) is not None
+
+    def index(self, code):
+        """Return the position of a loaded code, or None"""
+        i = bisect_left(self.codes, code)
+        if i < len(self.codes) and self.codes[i] == code:
+            return i
+
+    def get(self, code):
+        """Return the stored likes count for a code, or None if unknown"""
+        if code in self.added:
+            return self.added[code]
+        i = self.index(code)
+        if i is not None:
+            return self.likes[i]
+
+    def set(self, code, likes):
+        """Record a code's latest stored likes count"""
+        likes = -1 if likes is None else likes
+        i = self.index(code)
+        if i is not None:
+            self.likes[i] = likes
+        else:
+            self.added[code] = likes
+
+
+def media_filenames(user, code, post_type, media_files):
+    """Return the local filename of each of a post's media files
+
+    Carousel files get a counter after the shortcode:
+        sportscenter - BaXyursFd2k (1).jpg
+        sportscenter - BaXyursFd2k (2).mp4
+
+    """
+    filenames = []
+    for counter, media in enumerate(media_files, 1):
+        file_ext = media.split('.')[-1]
+        if post_type == 'carousel':
+            filenames.append('{} - {} ({}).{}'.format(user, code, counter, file_ext))
+        else:
+            filenames.append('{} - {}.{}'.format(user, code, file_ext))
+    return filenames
+
+
+def media_type(filename):
+    """'video' for an .mp4, else 'image'"""
+    return 'video' if filename.endswith('.mp4') else 'image'
 
 
 class Database:
-    """Write Instagram posts to database"""
+    """Write Instagram posts to database
+
+    Rows are written inside one open transaction that flush() commits. Call
+    flush() once per page of posts and close() on shutdown, or the
+    uncommitted rows are rolled back. posts.updated is set by flush() too,
+    see commit_time().
+
+    posts.likes is the latest count. With snapshot_likes(), every run also
+    appends (code, time, likes) rows to likes_history, all stamped with the
+    time the Database was opened.
+
+    Each post's media files are rows of the media table, and captions and
+    locations are indexed for full text search in posts_fts (when SQLite
+    has FTS5). See search().
+
+    """
+    SCHEMA_VERSION = 4
+    SYNCHRONOUS_LEVELS = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
 
-    def __init__(self, user):
-        """Initialize the database"""
-        self.conn = sqlite3.connect('{}.db'.format(user))
+    def __init__(self, user, directory='.', synchronous='NORMAL',
+                 batch_size=500):
+        """Initialize the database
+
+        user: Instagram user, the database file is "{user}.db"
+        directory: Folder the database file lives in
+        synchronous: SQLite PRAGMA synchronous level (OFF, NORMAL, FULL, EXTRA)
+            NORMAL is safe with WAL; only the last commits can be lost on
+            power failure, never the database itself.
+        batch_size: Commit automatically after this many written rows
+
+        """
+        if synchronous.upper() not in self.SYNCHRONOUS_LEVELS:
+            raise ValueError('synchronous must be one of {}'.format(
+                ', '.join(self.SYNCHRONOUS_LEVELS)))
+
+        self.user = user
+        self.conn = sqlite3.connect(os.path.join(directory, '{}.db'.format(user)))
         self.cur = self.conn.cursor()
+        self.cur.execute('PRAGMA journal_mode=WAL')
+        self.cur.execute('PRAGMA synchronous={}'.format(synchronous.upper()))
         self.create_tables()
+        self.migrate()
+        self.fts = self.create_fts()
+
+        # One query up front, so per-post lookups never touch SQLite
+        self.known = KnownPosts(self.cur.execute(
+            'SELECT code, likes FROM posts ORDER BY code'))
+
+        self.batch_size = batch_size
+        self.uncommitted = 0
+        self.written = []  # codes to stamp with the next flush's commit_time()
+        self.snapshot_time = int(time.time())
+        self.snapshots = []  # (code, time, likes) rows for the next flush
 
     def create_tables(self):
-        """Create database table for posts"""
+        """Create the original posts table, migrate() brings it up to date"""
         self.cur.execute(('CREATE TABLE IF NOT EXISTS posts('
                           'date TEXT,'
                           'type TEXT,'
@@ -21,16 +147,126 @@ class Database:
                           'caption TEXT,'
                           'media TEXT)'))
 
+    def migrate(self):
+        """Bring an existing database file up to SCHEMA_VERSION
+
+        Version 1: UNIQUE index on posts.code. Older files may hold the
+                   same shortcode twice, the newest row is kept.
+        Version 2: likes_history table. WITHOUT ROWID, so rows are stored
+                   in (code, time) order and a post's count at any time
+                   is one b-tree lookup.
+        Version 3: posts is rebuilt keyed by code, without the comma joined
+                   media column. Its URLs move to the media table, along
+                   with their local filenames. Indexes on likes and date.
+        Version 4: posts.updated, when the row's insert or latest likes
+                   change was committed (Unix time, 0 for older rows).
+                   Indexed for incremental exports.
+
+        """
+        version = self.cur.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+
+        with self.conn:
+            if version < 1:
+                self.cur.execute('DELETE FROM posts WHERE rowid NOT IN '
+                                 '(SELECT MAX(rowid) FROM posts GROUP BY code)')
+                self.cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS '
+                                 'posts_code ON posts(code)')
+            if version < 2:
+                self.cur.execute('CREATE TABLE IF NOT EXISTS likes_history('
+                                 'code TEXT,'
+                                 'time INT,'
+                                 'likes INT,'
+                                 'PRIMARY KEY(code, time)) WITHOUT ROWID')
+            if version < 3:
+                self.migrate_media()
+            if version < 4:
+                self.cur.execute('ALTER TABLE posts ADD COLUMN updated INT DEFAULT 0')
+                self.cur.execute('CREATE INDEX posts_updated ON posts(updated, code)')
+            # PRAGMA can't take a ? parameter
+            self.cur.execute('PRAGMA user_version={}'.format(self.SCHEMA_VERSION))
+
+    def migrate_media(self):
+        """Schema version 3, see migrate()"""
+        self.cur.execute('CREATE TABLE media('
+                         'code TEXT,'
+                         'position INT,'
+                         'type TEXT,'
+                         'url TEXT,'
+                         'filename TEXT,'
+                         'PRIMARY KEY(code, position)) WITHOUT ROWID')
+        rows = []
+        for code, post_type, media in self.cur.execute(
+                'SELECT code, type, media FROM posts').fetchall():
+            urls = media.split(',') if media else []
+            filenames = media_filenames(self.user, code, post_type, urls)
+            rows.extend((code, position, media_type(filename), url, filename)
+                        for position, (url, filename)
+                        in enumerate(zip(urls, filenames), 1))
+        self.cur.executemany('INSERT INTO media VALUES(?, ?, ?, ?, ?)', rows)
+
+        self.cur.execute('CREATE TABLE posts_v3('
+                         'code TEXT PRIMARY KEY,'
+                         'date TEXT,'
+                         'type TEXT,'
+                         'likes INT,'
+                         'location TEXT,'
+                         'caption TEXT)')
+        self.cur.execute('INSERT INTO posts_v3 SELECT code, date, type, likes, '
+                         'location, caption FROM posts')
+        self.cur.execute('DROP TABLE posts')  # and the posts_code index
+        self.cur.execute('ALTER TABLE posts_v3 RENAME TO posts')
+        self.cur.execute('CREATE INDEX posts_likes ON posts(likes)')
+        self.cur.execute('CREATE INDEX posts_date ON posts(date)')
+
+    def create_fts(self):
+        """Set up posts_fts, the caption / location full text index
+
+        It's an external content FTS5 table over posts, kept in sync by
+        triggers, so the text isn't stored twice. It's created (and filled)
+        whenever it's missing rather than in a migration, since not every
+        SQLite build has FTS5.
+
+        returns: False if this SQLite has no FTS5
+
+        """
+        exists = self.cur.execute("SELECT 1 FROM sqlite_master "
+                                  "WHERE name='posts_fts'").fetchone()
+        if exists:
+            return True
+        try:
+            with self.conn:
+                self.cur.execute("CREATE VIRTUAL TABLE posts_fts USING "
+                                 "fts5(caption, location, content='posts', "
+                                 "content_rowid='rowid')")
+                self.cur.execute("CREATE TRIGGER posts_fts_insert AFTER INSERT ON posts BEGIN "
+                                 "INSERT INTO posts_fts(rowid, caption, location) "
+                                 "VALUES(new.rowid, new.caption, new.location); END")
+                self.cur.execute("CREATE TRIGGER posts_fts_delete AFTER DELETE ON posts BEGIN "
+                                 "INSERT INTO posts_fts(posts_fts, rowid, caption, location) "
+                                 "VALUES('delete', old.rowid, old.caption, old.location); END")
+                # Likes updates don't touch the index
+                self.cur.execute("CREATE TRIGGER posts_fts_update "
+                                 "AFTER UPDATE OF caption, location ON posts BEGIN "
+                                 "INSERT INTO posts_fts(posts_fts, rowid, caption, location) "
+                                 "VALUES('delete', old.rowid, old.caption, old.location); "
+                                 "INSERT INTO posts_fts(rowid, caption, location) "
+                                 "VALUES(new.rowid, new.caption, new.location); END")
+                self.cur.execute("INSERT INTO posts_fts(posts_fts) VALUES('rebuild')")
+        except sqlite3.OperationalError as error:
+            if 'fts5' not in str(error):
+                raise
+            return False
+        return True
+
     def existing_entry(self, code):
         """Check if a post shortcode already exists in the database"""
-        self.cur.execute('SELECT * FROM posts WHERE code="{}"'.format(code))
-        post_exists = self.cur.fetchone()
-        if post_exists:
-            return True
+        return code in self.known
 
-    def write(self, date: str, post_type: str, code: str, likes: int,
-              location: str, caption: str, media_files: list):
-        """Insert a post into the posts table
+    def upsert(self, date: str, post_type: str, code: str, likes: int,
+               location: str, caption: str, media_files: list):
+        """Insert a post, or update its likes count if it's already stored
 
         date: Post date & time (2017:08:04 16:12:01)
         post_type: Post type (image, video, carousel)
@@ -38,40 +274,165 @@ class Database:
         likes: Post likes count
         location: Post tagged location
         caption: Post caption
-        media: Post media URL (mp4, jpg)
+        media_files: Post media URLs (mp4, jpg), in post order
+
+        returns: 'new', 'changed' (likes updated) or 'unchanged'
+
+        """
+        stored_likes = self.known.get(code)
+        if stored_likes == likes:
+            return 'unchanged'
+
+        with stats.timer('db_query'):
+            self.cur.execute('INSERT INTO posts(code, date, type, likes, location, '
+                             'caption) VALUES(?, ?, ?, ?, ?, ?) '
+                             'ON CONFLICT(code) DO UPDATE SET likes=excluded.likes',
+                             (code, date, post_type, likes, location, caption))
+            if stored_likes is None:
+                filenames = media_filenames(self.user, code, post_type, media_files)
+                self.cur.executemany(
+                    'INSERT OR IGNORE INTO media VALUES(?, ?, ?, ?, ?)',
+                    [(code, position, media_type(filename), url, filename)
+                     for position, (url, filename)
+                     in enumerate(zip(media_files, filenames), 1)])
+        stats.count('db_rows')
+        self.known.set(code, likes)
+        self.written.append(code)
+        self.uncommitted += 1
+
+        status = 'new' if stored_likes is None else 'changed'
+        if self.uncommitted >= self.batch_size:
+            self.flush()
+        return status
+
+    def snapshot_likes(self, code, likes):
+        """Queue a post's likes count for likes_history, written by flush()"""
+        self.snapshots.append((code, self.snapshot_time, likes))
+
+    def likes_growth(self, start, end):
+        """Return how each post's likes count changed between two times
+
+        start, end: Unix timestamps; the latest snapshot at or before each
+                    one is used
+
+        returns: List of (code, likes at start, likes at end), None where
+                 there's no snapshot yet
 
         """
-        print('Adding new db entry: {}'.format(code))
-        self.cur.execute('INSERT INTO posts VALUES(?, ?, ?, ?, ?, ?, ?)',
-                         (date, post_type, code, likes, location,
-                          caption, (',').join(media_files)))
-        self.conn.commit()
+        return self.cur.execute(
+            'SELECT code,'
+            ' (SELECT likes FROM likes_history h WHERE h.code=posts.code '
+            '  AND time<=? ORDER BY time DESC LIMIT 1),'
+            ' (SELECT likes FROM likes_history h WHERE h.code=posts.code '
+            '  AND time<=? ORDER BY time DESC LIMIT 1) '
+            'FROM posts', (start, end)).fetchall()
+
+    def search(self, text=None, min_likes=None, max_likes=None, since=None,
+               until=None, order='likes', limit=None):
+        """Find posts, using the full text, likes and date indexes
 
-    def likes_changed(self, code, ig_likes):
-        """Check if the likes count for a post needs to be updated
+        text: FTS5 query over captions and locations
+            Example: 'touchdown' or '"world cup" OR olympics'
+        min_likes, max_likes: Likes range, inclusive
+        since, until: Date range, inclusive, as YYYY, YYYY-MM or YYYY-MM-DD
+            Example: since='2017', until='2017-06'
+        order: 'likes' (most first), 'date' (newest first) or 'rank'
+               (best text match first)
+        limit: Maximum number of posts
 
-        code: The Instagram shortcode
-        ig_likes: The latest likes count from the Instagram post
-        returns: True if db likes count needs to be updated
+        returns: List of (code, date, type, likes, location, caption)
+
+        raises: sqlite3.OperationalError for a malformed text query
 
         """
-        self.cur.execute('SELECT * FROM posts WHERE code="{}"'.format(code))
-        post_exists = self.cur.fetchone()
-        if post_exists:
-            db_likes = post_exists[3]
+        columns = ('posts.code, posts.date, posts.type, posts.likes, '
+                   'posts.location, posts.caption')
+        where, params = [], []
+        if text and self.fts:
+            sql = ('SELECT {} FROM posts_fts JOIN posts '
+                   'ON posts.rowid = posts_fts.rowid'.format(columns))
+            where.append('posts_fts MATCH ?')
+            params.append(text)
         else:
-            db_likes = 0
-        if ig_likes != db_likes:
-            return True
+            sql = 'SELECT {} FROM posts'.format(columns)
+            if text:  # no FTS5, fall back to a scan
+                where.append('(posts.caption LIKE ? OR posts.location LIKE ?)')
+                params.extend(['%{}%'.format(text)] * 2)
 
-    def update_likes(self, code, ig_likes):
-        """Update an existing db entry's likes count
+        if min_likes is not None:
+            where.append('posts.likes >= ?')
+            params.append(min_likes)
+        if max_likes is not None:
+            where.append('posts.likes <= ?')
+            params.append(max_likes)
+        # Dates are stored as "2017:08:04 16:12:01", so a prefix compares
+        # correctly, and "~" sorts after anything that can follow it
+        if since:
+            where.append('posts.date >= ?')
+            params.append(since.replace('-', ':'))
+        if until:
+            where.append('posts.date <= ?')
+            params.append(until.replace('-', ':') + '~')
+
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        if order == 'rank' and text and self.fts:
+            sql += ' ORDER BY posts_fts.rank'
+        elif order == 'date':
+            sql += ' ORDER BY posts.date DESC'
+        else:
+            sql += ' ORDER BY posts.likes DESC'
+        if limit:
+            sql += ' LIMIT {:d}'.format(limit)
+        return self.cur.execute(sql, params).fetchall()
 
-        code: The Instagram shortcode
-        ig_likes: The latest likes count from the Instagram post
+    def media(self, code):
+        """Return a post's (position, type, url, filename) media rows"""
+        return self.cur.execute('SELECT position, type, url, filename FROM media '
+                                'WHERE code=? ORDER BY position', (code,)).fetchall()
+
+    def commit_time(self):
+        """Return the posts.updated value for the rows about to be committed
+
+        It's the current Unix time, or one more than the newest committed
+        value if that's not already in the past. Either way, a commit's rows
+        come after every row committed before them, so an export that saw
+        up to (updated, code) never has rows appear behind that position,
+        however long they waited for their page's downloads.
+
+        Must run in the write transaction, i.e. after an upsert(), so no
+        other connection commits between this and flush()'s commit.
+
+        """
+        latest = self.cur.execute('SELECT MAX(updated) FROM posts').fetchone()[0]
+        return max(int(time.time()), (latest or 0) + 1)
+
+    def flush(self):
+        """Commit everything written since the last flush
+
+        Queued likes snapshots go in with a single executemany(), and the
+        posts written get their posts.updated, see commit_time().
 
         """
-        print('Updating db likes count for entry: {}'.format(code))
-        self.cur.execute('UPDATE posts SET likes=? WHERE code=?',
-                         (ig_likes, code))
-        self.conn.commit()
+        if self.written:
+            updated = self.commit_time()
+            with stats.timer('db_query'):
+                self.cur.executemany('UPDATE posts SET updated=? WHERE code=?',
+                                     [(updated, code) for code in self.written])
+            self.written = []
+        if self.snapshots:
+            with stats.timer('db_query'):
+                self.cur.executemany('INSERT OR REPLACE INTO likes_history '
+                                     'VALUES(?, ?, ?)', self.snapshots)
+            stats.count('likes_snapshots', len(self.snapshots))
+            self.uncommitted += len(self.snapshots)
+            self.snapshots = []
+        if self.uncommitted:
+            with stats.timer('db_commit'):
+                self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        """Commit outstanding rows and close the connection"""
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,356 @@
+import errno
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from manifest import mp4_atoms
+from stats import stats
+
+try:
+    import fcntl
+except ImportError:  # Windows, hardlinks only
+    fcntl = None
+
+MEDIA_EXTENSIONS = ('.jpg', '.mp4')
+HASH_CHUNK_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # Linux ioctl, see ioctl_ficlone(2)
+# Errors of a link or clone this filesystem (or OS) can't make
+UNSUPPORTED = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP,
+               errno.ENOTTY, errno.EINVAL)
+
+
+def new_hash():
+    """Return the hash object media files are identified by"""
+    return hashlib.sha256()
+
+
+def hash_file(path, digest=None):
+    """Return the hex digest of a file's contents
+
+    digest: Optional hash object to feed instead of a fresh one
+
+    """
+    digest = digest or new_hash()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def video_payload(path):
+    """Return the (offset, size) of an MP4's mdat atoms
+
+    The media data is the same whatever the tags, which live in moov.
+
+    returns: List of ranges, empty if the file isn't a complete MP4
+
+    """
+    with open(path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return [(offset, size) for name, offset, size in mp4_atoms(data) or []
+                if name == b'mdat']
+
+
+def hash_ranges(path, ranges):
+    """Return the hex digest of the (offset, size) ranges of a file"""
+    digest = new_hash()
+    with open(path, 'rb') as file:
+        for offset, size in ranges:
+            file.seek(offset)
+            while size > 0:
+                chunk = file.read(min(size, HASH_CHUNK_SIZE))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size -= len(chunk)
+    return digest.hexdigest()
+
+
+def tag_key(job):
+    """Return a digest of the metadata a TagJob writes into its file
+
+    Two downloads with the same content hash and tag key end up as the same
+    bytes once tagged, so they can share one inode.
+
+    """
+    fields = [job.user, job.date, job.caption, job.tags, job.code]
+    return hashlib.sha256(json.dumps(fields).encode('UTF-8')).hexdigest()
+
+
+def reflink(source, target):
+    """Clone source's blocks into target (copy-on-write), Linux only"""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported here')
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_file(source, target):
+    """Replace target with a hardlink to source, or a reflink if that fails
+
+    The link is made under a temporary name and renamed over target, so
+    target is never missing.
+
+    returns: 'hardlink', 'reflink', or None if neither is possible
+
+    """
+    temp = target + '.link'
+    for method, make_link in [('hardlink', os.link), ('reflink', reflink)]:
+        try:
+            make_link(source, temp)
+        except OSError as error:
+            if os.path.exists(temp):
+                os.remove(temp)
+            if error.errno in UNSUPPORTED:
+                continue  # not supported here, try the next method
+            raise
+        os.replace(temp, target)
+        return method
+    return None
+
+
+def clone_video(source, target):
+    """Replace target with a reflink of source that keeps target's own tags
+
+    source and target are the same video with different tags (another
+    account's repost, say). The clone gets target's tags written in place,
+    into the free space after source's, so only its moov blocks stop
+    being shared. When they don't fit, mdat would move and nothing would
+    be saved, so target is left as it is.
+
+    returns: True if target is now a clone
+
+    raises: OSError with an errno in UNSUPPORTED if reflinks can't be made
+            here
+
+    """
+    from metadata import MP4, MP4Tags, video_padding  # loads mutagen
+    temp = target + '.link'
+    try:
+        reflink(source, temp)
+        size = os.path.getsize(temp)
+        clone = MP4(temp)
+        clone.tags = MP4Tags()
+        clone.tags.update(MP4(target).tags or {})
+        clone.save(padding=video_padding)
+        # Same size and the same media as target: nothing moved
+        cloned = (os.path.getsize(temp) == size and
+                  [length for _, length in video_payload(temp)] ==
+                  [length for _, length in video_payload(target)])
+    except OSError:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    except Exception:  # anything mutagen can't read or write
+        cloned = False
+    if not cloned:
+        os.remove(temp)
+        return False
+    os.replace(temp, target)
+    return True
+
+
+class ContentIndex:
+    """Content hashes of every media file downloaded into an archive
+
+    Shared by all users of a run, so a post downloaded into a second
+    folder or reposted by another account is stored once. Files are keyed
+    by the hash of the server's bytes, which doesn't depend on the tags.
+    A duplicate with the same tags becomes a hardlink, one file on disk. A
+    video with other tags (a repost) becomes a reflink, sharing its media
+    blocks copy-on-write while keeping its own tags, on filesystems with
+    reflinks (Linux btrfs or XFS). Images are small and exiftool rewrites
+    them whole, so they keep their own copy.
+
+    """
+    FILENAME = 'content.db'
+
+    def __init__(self, path):
+        """
+        path: SQLite file of the index, normally FILENAME in the archive folder
+
+        """
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS content('
+                          'hash TEXT,'
+                          'tags TEXT,'
+                          'path TEXT,'
+                          'size INT,'
+                          'PRIMARY KEY(hash, tags))')
+        self.conn.commit()
+        self.clones = True  # until the filesystem turns out not to have reflinks
+
+    def link_duplicate(self, digest, job):
+        """Link a freshly downloaded file to the same media, if indexed
+
+        digest: Hash of the server's bytes of job.path, see Retrieve.download()
+        job: The file's TagJob
+
+        returns: 'linked' if job.path is now a hardlink of a file with the
+                 same tags and needs no tagging, 'cloned' if it's now a
+                 reflink of a video with other tags that kept its own (see
+                 clone_video()), else None
+
+        """
+        key = tag_key(job)
+        size = os.path.getsize(job.path)
+        status = None
+        with self.lock:
+            sources = [(tags, path) for tags, path in self.conn.execute(
+                'SELECT tags, path FROM content WHERE hash=?', (digest,))
+                if path != job.path and os.path.exists(path)]
+            for tags, source in sources:
+                if tags == key and link_file(source, job.path):
+                    stats.count('dedupe_links')
+                    stats.count('dedupe_bytes', size)
+                    return 'linked'
+
+            if sources and self.clones and job.path.endswith('.mp4'):
+                try:
+                    if clone_video(sources[0][1], job.path):
+                        stats.count('dedupe_clones')
+                        stats.count('dedupe_bytes', size)
+                        status = 'cloned'
+                except OSError as error:
+                    if error.errno not in UNSUPPORTED:
+                        raise
+                    self.clones = False
+
+            # Indexed under its own tags, for the next file that has them
+            self.conn.execute('INSERT OR REPLACE INTO content VALUES(?, ?, ?, ?)',
+                              (digest, key, job.path, size))
+            self.conn.commit()
+            return status
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def media_files(root):
+    """Yield (path, os.stat_result) for every finished media file under root"""
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(MEDIA_EXTENSIONS):
+                path = os.path.join(directory, filename)
+                yield path, os.stat(path)
+
+
+def dedupe_archive(root, workers=None, dry_run=False, exclude=()):
+    """Hardlink identical media files anywhere under root, then reflink
+    videos that only differ in their tags
+
+    Files are grouped by size first, so only files that share a size with
+    another one are hashed, on `workers` threads (hashlib and file reads
+    release the GIL). Files that are already links of each other are
+    hashed once.
+
+    root: Archive folder, e.g. ~/Downloads/instadb
+    workers: Hashing threads (default: one per CPU)
+    dry_run: Only report what would be linked
+    exclude: Absolute paths not to hardlink, e.g. files still waiting for
+             their tags (clones keep their own tags, so they're cloned)
+
+    returns: (files scanned, files linked, files cloned, bytes saved)
+
+    """
+    by_size = defaultdict(dict)  # (device, size): {inode: [paths]}
+    scanned = 0
+    for path, stat in media_files(root):
+        scanned += 1
+        if stat.st_size and os.path.abspath(path) not in exclude:
+            by_size[stat.st_dev, stat.st_size].setdefault(stat.st_ino, []).append(path)
+
+    # One path per inode of every size that occurs more than once
+    candidates = [(key, sorted(paths))
+                  for key, inodes in by_size.items() if len(inodes) > 1
+                  for paths in inodes.values()]
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        digests = pool.map(lambda candidate: hash_file(candidate[1][0]), candidates)
+        groups = defaultdict(list)  # (device, size, digest): [[paths of an inode]]
+        for (key, paths), digest in zip(candidates, digests):
+            groups[key + (digest,)].append(paths)
+
+    linked = saved = 0
+    for (_, size, _), inodes in groups.items():
+        if len(inodes) < 2:
+            continue
+        inodes.sort()
+        source = inodes[0][0]
+        for paths in inodes[1:]:
+            results = []
+            for path in paths:
+                print('{} -> {}'.format(path, source))
+                results.append(dry_run or link_file(source, path))
+            linked += sum(1 for result in results if result)
+            if all(results):  # the inode's last name is gone
+                saved += size
+
+    cloned, clone_saved = clone_videos(root, workers, dry_run)
+    return scanned, linked, cloned, saved + clone_saved
+
+
+def clone_videos(root, workers=None, dry_run=False):
+    """Reflink the videos under root that only differ in their tags
+
+    Videos are grouped by the size of their mdat atoms, and only those
+    that share one are hashed, mdat only. In each group of the same media
+    every file becomes a clone of the first one, keeping its own tags (see
+    clone_video()). A reflink can't be told apart from a copy, so files
+    cloned by an earlier run are cloned again, which is cheap.
+
+    returns: (files cloned, bytes saved)
+
+    """
+    inodes = defaultdict(list)  # (device, inode): [paths]
+    for path, stat in media_files(root):
+        if path.endswith('.mp4') and stat.st_size:
+            inodes[stat.st_dev, stat.st_ino].append(path)
+    inodes = [(device, sorted(paths)) for (device, _), paths in inodes.items()]
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        payloads = list(pool.map(lambda inode: video_payload(inode[1][0]), inodes))
+        by_size = defaultdict(list)  # (device, mdat size): [(paths, ranges)]
+        for (device, paths), ranges in zip(inodes, payloads):
+            if ranges:
+                by_size[device, sum(size for _, size in ranges)].append((paths, ranges))
+        candidates = [(key, paths, ranges) for key, videos in by_size.items()
+                      if len(videos) > 1 for paths, ranges in videos]
+        digests = pool.map(lambda candidate: hash_ranges(candidate[1][0], candidate[2]),
+                           candidates)
+        groups = defaultdict(list)  # (device, mdat size, digest): [[paths of an inode]]
+        for (key, paths, _), digest in zip(candidates, digests):
+            groups[key + (digest,)].append(paths)
+
+    cloned = saved = 0
+    for (_, size, _), videos in groups.items():
+        if len(videos) < 2:
+            continue
+        videos.sort()
+        source = videos[0][0]
+        for paths in videos[1:]:
+            print('{} -> {} (own tags)'.format(paths[0], source))
+            if not dry_run:
+                try:
+                    if not clone_video(source, paths[0]):
+                        continue
+                except OSError as error:
+                    if error.errno not in UNSUPPORTED:
+                        raise
+                    print('\n[!] No reflinks on this filesystem, videos with '
+                          'other tags keep their own copy\n')
+                    return cloned, saved
+                for path in paths[1:]:  # the inode's other names
+                    link_file(paths[0], path)
+            cloned += len(paths)
+            saved += size
+    return cloned, saved
@@ -0,0 +1,227 @@
+import csv
+import json
+import os
+import sqlite3
+import sys
+from itertools import groupby
+
+from database import Database
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # only needed for --format parquet
+    pyarrow = None
+
+FORMATS = ['jsonl', 'csv', 'parquet']
+FIELDS = ['user', 'code', 'date', 'type', 'likes', 'location', 'caption',
+          'updated', 'media']
+FETCH_SIZE = 1000  # rows held in memory at a time
+
+
+def find_databases(paths):
+    """Return the user databases among paths, searching folders recursively
+
+    A user database is any .db file with a posts table without a user
+    column, so the content and cache files and a catalog are skipped.
+
+    returns: List of (user, path) tuples
+
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = sorted(os.path.join(directory, filename)
+                                for directory, _, filenames in os.walk(path)
+                                for filename in filenames
+                                if filename.endswith('.db'))
+        else:
+            candidates = [path]
+        for candidate in candidates:
+            conn = sqlite3.connect('file:{}?mode=ro'.format(candidate), uri=True)
+            try:
+                columns = [row[1] for row in conn.execute('PRAGMA table_info(posts)')]
+                has_posts = columns and 'user' not in columns
+            except sqlite3.DatabaseError:
+                has_posts = False
+            finally:
+                conn.close()
+            if has_posts:
+                user = os.path.basename(candidate)[:-len('.db')]
+                found.append((user, os.path.abspath(candidate)))
+    return found
+
+
+def iter_posts(user, path, after=None):
+    """Stream a user database's posts, each with its media files
+
+    Rows come off one cursor FETCH_SIZE at a time, ordered by (updated,
+    code) along the posts_updated index, so memory use doesn't depend on
+    the size of the database. Databases older than the current schema are
+    migrated first.
+
+    after: Only posts after this (updated, code) position, e.g. the last
+           post of the previous export. Rows committed later always come
+           after it, see Database.commit_time().
+
+    yields: Dicts with the FIELDS keys, media being a list of
+            {position, type, url, filename} dicts
+
+    """
+    conn = sqlite3.connect(path)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < Database.SCHEMA_VERSION:
+            conn.close()
+            Database(user, os.path.dirname(path)).close()
+            conn = sqlite3.connect(path)
+
+        cur = conn.execute(
+            'SELECT posts.code, date, posts.type, likes, location, caption, '
+            'updated, position, media.type, url, filename '
+            'FROM posts LEFT JOIN media ON media.code = posts.code '
+            'WHERE (updated, posts.code) > (?, ?) '
+            'ORDER BY updated, posts.code, position',
+            tuple(after or (-1, '')))
+
+        def rows():
+            while True:
+                batch = cur.fetchmany(FETCH_SIZE)
+                if not batch:
+                    return
+                yield from batch
+
+        for _, post_rows in groupby(rows(), key=lambda row: row[0]):
+            post_rows = list(post_rows)
+            code, date, post_type, likes, location, caption, updated = post_rows[0][:7]
+            yield {'user': user, 'code': code, 'date': date, 'type': post_type,
+                   'likes': likes, 'location': location, 'caption': caption,
+                   'updated': updated,
+                   'media': [{'position': position, 'type': media_type,
+                              'url': url, 'filename': filename}
+                             for *_, position, media_type, url, filename in post_rows
+                             if position is not None]}
+    finally:
+        conn.close()
+
+
+class JsonlWriter:
+    """One JSON object per line"""
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, post):
+        self.file.write(json.dumps(post, ensure_ascii=False) + '\n')
+
+    def close(self):
+        pass
+
+
+class CsvWriter:
+    """One row per post, the media list as a JSON array"""
+
+    def __init__(self, file):
+        self.writer = csv.DictWriter(file, FIELDS)
+        self.writer.writeheader()
+
+    def write(self, post):
+        self.writer.writerow(dict(post, media=json.dumps(post['media'])))
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    """Parquet via pyarrow, one row group per FETCH_SIZE posts"""
+
+    def __init__(self, path):
+        media = pyarrow.struct([('position', pyarrow.int32()),
+                                ('type', pyarrow.string()),
+                                ('url', pyarrow.string()),
+                                ('filename', pyarrow.string())])
+        self.schema = pyarrow.schema([('user', pyarrow.string()),
+                                      ('code', pyarrow.string()),
+                                      ('date', pyarrow.string()),
+                                      ('type', pyarrow.string()),
+                                      ('likes', pyarrow.int64()),
+                                      ('location', pyarrow.string()),
+                                      ('caption', pyarrow.string()),
+                                      ('updated', pyarrow.int64()),
+                                      ('media', pyarrow.list_(media))])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.pending = []
+
+    def write(self, post):
+        self.pending.append(post)
+        if len(self.pending) >= FETCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.writer.write_table(
+                pyarrow.Table.from_pylist(self.pending, schema=self.schema))
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def read_watermarks(path):
+    """Return {database path: [updated, code] of the last exported post}"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding='UTF-8') as file:
+        return json.load(file)
+
+
+def write_watermarks(path, watermarks):
+    """Replace the watermark file atomically"""
+    with open(path + '.tmp', 'w', encoding='UTF-8') as file:
+        json.dump(watermarks, file, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def export(databases, output='-', output_format='jsonl', watermark=None):
+    """Export the posts of user databases to a JSONL, CSV or Parquet file
+
+    databases: List of (user, path) tuples, see find_databases()
+    output: File to write, '-' for stdout (not for parquet)
+    output_format: One of FORMATS
+    watermark: Optional JSON file remembering the last post exported from
+               each database. Only posts updated after it are written, and
+               the file is moved forward once the export has finished.
+
+    returns: Number of posts written
+
+    """
+    if output_format == 'parquet' and pyarrow is None:
+        raise SystemExit('\n[!] pyarrow not installed\npip3 install pyarrow\n')
+    if output_format == 'parquet' and output == '-':
+        raise SystemExit('\n[!] Parquet needs an output file\n')
+
+    watermarks = read_watermarks(watermark)
+    if output_format == 'parquet':
+        file = None
+        writer = ParquetWriter(output)
+    else:
+        file = sys.stdout if output == '-' else open(output, 'w', encoding='UTF-8',
+                                                     newline='')
+        writer = (CsvWriter if output_format == 'csv' else JsonlWriter)(file)
+
+    written = 0
+    try:
+        for user, path in databases:
+            for post in iter_posts(user, path, watermarks.get(path)):
+                writer.write(post)
+                written += 1
+                watermarks[path] = [post['updated'], post['code']]
+        writer.close()
+    finally:
+        if file and file is not sys.stdout:
+            file.close()
+
+    if watermark:
+        write_watermarks(watermark, watermarks)
+    return written
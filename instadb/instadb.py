@@ -1,29 +1,120 @@
 import argparse
 import os
-from time import sleep
+import sqlite3
+import sys
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-import metadata
+from api import BASE_URL, UserError, fetch_file, sync_posts
+from cache import ResponseCache
+from catalog import Catalog
+from checkpoint import Checkpoint
 from database import Database
+from dedupe import ContentIndex, dedupe_archive
+from export import FORMATS, export, find_databases
+from manifest import Manifest
 from network import Retrieve, correct_proxy_format
-from parsejson import JsonPage
+from parsejson import BadJson
+from pipeline import (PagePrefetcher, PendingTags, TaggingStage, TagJob,
+                      read_pending)
+from stats import profile, stats
+from verify import read_repair_list, verify_archive
+
+ARCHIVE_DIR = os.path.join('~', 'Downloads', 'instadb')
+
+# Users synced at once by default. Each holds its database (three files
+# in WAL mode), a prefetch thread and a connection open while it's active.
+ACTIVE_USERS = 8
+
+# `instadb.py COMMAND ...` runs a maintenance command instead of a download
+COMMANDS = ['dedupe', 'query', 'export', 'import', 'verify']
+
+# Per-run settings shared by every user, see main() for descriptions
+Options = namedtuple('Options', ['tags', 'min_likes_required', 'only_photos',
+                                 'only_videos', 'only_new_files', 'write_db',
+                                 'only_db', 'db_synchronous', 'prefetch',
+                                 'tag_later', 'resume', 'snapshot'])
 
 
 def parse_args():
     """Parse arguments from CLI"""
     parser = argparse.ArgumentParser(
-        description='Download an Instagram user\'s media plus metadata')
+        description='Download an Instagram user\'s media plus metadata',
+        epilog='Maintenance commands: {} (run "instadb.py COMMAND -h")'.format(
+            ', '.join(COMMANDS)))
     parser.add_argument(
         'user',
-        help='Instagram user')
+        help='Instagram user',
+        nargs='?')
+    parser.add_argument(
+        '--users-file',
+        help='File of Instagram users to download in one run, one per line',
+        metavar='FILE')
     parser.add_argument(
+        '--active-users',
+        help='Users of a --users-file synced at once, the next one starting '
+             'when one finishes (default: %(default)s)',
+        type=int,
+        metavar='N',
+        default=ACTIVE_USERS)
+    proxy_group = parser.add_mutually_exclusive_group()
+    proxy_group.add_argument(
         '--proxy',
         help='Proxy must be in the format address:port')
+    proxy_group.add_argument(
+        '--proxies',
+        help='File of proxies (address:port, one per line) to spread requests '
+             'over, rotating away from failing ones without prompting',
+        metavar='FILE')
     parser.add_argument(
         '--rate-limit',
         help='Seconds between Instagram requests (default: %(default)s)',
         type=int,
         metavar='LIMIT',  # shortens RATE_LIMIT to LIMIT in --help output
         default=1)
+    parser.add_argument(
+        '--media-rate-limit',
+        help='Seconds between media file requests (default: same as --rate-limit)',
+        type=float,
+        metavar='LIMIT')
+    parser.add_argument(
+        '--min-rate-limit',
+        help='Let the rate limits speed up to this many seconds between '
+             'requests while Instagram answers normally (default: never '
+             'faster than --rate-limit / --media-rate-limit)',
+        type=float,
+        metavar='LIMIT')
+    parser.add_argument(
+        '--workers',
+        help='Number of media files to download at once (default: %(default)s)',
+        type=int,
+        metavar='N',
+        default=1)
+    parser.add_argument(
+        '--prefetch',
+        help='JSON pages to fetch ahead while posts are processed (default: %(default)s)',
+        type=int,
+        metavar='N',
+        default=1)
+    parser.add_argument(
+        '--cache',
+        help='Cache JSON pages in this Sqlite3 file and revalidate them with '
+             'conditional requests',
+        metavar='FILE')
+    parser.add_argument(
+        '--cache-size',
+        help='Cache size in MB before least recently used pages are dropped '
+             '(default: %(default)s)',
+        type=int,
+        metavar='MB',
+        default=200)
+    parser.add_argument(
+        '--cache-ttl',
+        help='Seconds a cached page past the first one is used without asking '
+             'Instagram, except with --snapshot (default: %(default)s, one week)',
+        type=int,
+        metavar='SECONDS',
+        default=7 * 24 * 3600)
     parser.add_argument(
         '--likes',
         help='Only download media with at least this many likes',
@@ -48,6 +139,34 @@ def parse_args():
         help=('Only download new media files'),
         action='store_true'
     )
+    parser.add_argument(
+        '--resume',
+        help='Continue from where the last sync of each user stopped, '
+             'after fetching any newer posts',
+        action='store_true')
+    parser.add_argument(
+        '--dedupe',
+        help='Hardlink downloads that are identical (content and tags) to a '
+             'file already in the archive, and reflink videos that only '
+             'differ in their tags, indexed in {} in the --path folder or '
+             '~/Downloads/instadb/'.format(ContentIndex.FILENAME),
+        action='store_true')
+
+    diagnostics = parser.add_argument_group('Diagnostics')
+    diagnostics.add_argument(
+        '--stats',
+        help='Write per-stage timings and counters to FILE at exit '
+             '(Prometheus text format if FILE ends in .prom, else JSON)',
+        metavar='FILE')
+    diagnostics.add_argument(
+        '--stats-interval',
+        help='Also rewrite the --stats file every SECONDS',
+        type=float,
+        metavar='SECONDS')
+    diagnostics.add_argument(
+        '--profile',
+        help='Run under cProfile, dump the stats to FILE and print time per stage',
+        metavar='FILE')
 
     data = parser.add_argument_group('Metadata')
     data.add_argument(
@@ -55,6 +174,30 @@ def parse_args():
         help=('Space separated media tags (default: [user, "instagram"])'),
         nargs='+',
         metavar='')
+    tagging = data.add_mutually_exclusive_group()
+    tagging.add_argument(
+        '--tag-later',
+        help='Don\'t tag files yet, record them for a later --tag-pending run',
+        action='store_true')
+    tagging.add_argument(
+        '--tag-pending',
+        help='Only tag the files recorded by earlier --tag-later runs',
+        action='store_true')
+    tagging.add_argument(
+        '--repair',
+        help='Only download or tag again the broken files listed by '
+             '`instadb.py verify`',
+        metavar='FILE')
+    data.add_argument(
+        '--tag-workers',
+        help='Number of videos to tag at once (default: %(default)s)',
+        type=int,
+        metavar='N',
+        default=1)
+    data.add_argument(
+        '--tag-processes',
+        help='Tag videos in separate processes instead of threads',
+        action='store_true')
     data.add_argument(
         '--db',
         help='Write user metadata to an Sqlite3 database',
@@ -66,6 +209,24 @@ def parse_args():
         help="Skip downloading media files",
         action='store_true'
     )
+    data.add_argument(
+        '--snapshot',
+        help='Also append every post\'s likes count to the database\'s '
+             'likes history (with --db or --only-db)',
+        action='store_true')
+    data.add_argument(
+        '--catalog',
+        help='Write every user\'s posts to this one shared database instead '
+             'of a {user}.db each (with --db or --only-db)',
+        metavar='FILE')
+    data.add_argument(
+        '--db-synchronous',
+        help='Sqlite3 synchronous level (default: %(default)s)',
+        choices=Database.SYNCHRONOUS_LEVELS,
+        type=str.upper,
+        metavar='LEVEL',
+        default='NORMAL'
+    )
 
     args = parser.parse_args()
 
@@ -75,23 +236,65 @@ def parse_args():
         else:
             args.proxy = {'https': args.proxy}  # format required by requests
 
-    if not args.tags:
-        # Add defaults
-        #
-        # Can't do default=[user, 'instagram'] in --tags add_argument
-        # because how would we get the args.user value before parsing?
-        args.tags = [args.user, 'instagram']
+    if args.proxies:
+        proxies_file, args.proxies = args.proxies, read_proxies_file(args.proxies)
+        if not args.proxies:
+            parser.error('\n[!] No proxies in {}\n'.format(proxies_file))
+
+    if args.workers < 1:
+        parser.error('\n[!] --workers must be at least 1\n')
+    if args.prefetch < 1:
+        parser.error('\n[!] --prefetch must be at least 1\n')
+    if args.tag_workers < 1:
+        parser.error('\n[!] --tag-workers must be at least 1\n')
+    if args.active_users < 1:
+        parser.error('\n[!] --active-users must be at least 1\n')
+    if args.snapshot and not (args.write_db or args.only_db):
+        parser.error('\n[!] --snapshot needs --db or --only-db\n')
+    if args.catalog and not (args.write_db or args.only_db):
+        parser.error('\n[!] --catalog needs --db or --only-db\n')
+    if args.stats_interval and not args.stats:
+        parser.error('\n[!] --stats-interval needs --stats FILE\n')
+
+    if args.repair:
+        if args.user or args.users_file:
+            parser.error('\n[!] --repair takes its users from the repair list\n')
+        args.repair = read_repair_list(args.repair)
+        args.users = sorted(set(entry['user'] for entry in args.repair))
+    elif args.user and args.users_file:
+        parser.error('\n[!] Give either a user or --users-file, not both\n')
+    elif args.users_file:
+        args.users = read_users_file(args.users_file)
+        if not args.users:
+            parser.error('\n[!] No users in {}\n'.format(args.users_file))
+    elif args.user:
+        args.users = [args.user]
+    else:
+        parser.error('\n[!] A user or --users-file is required\n')
+
+    # Without --tags, every user gets the default of [user, 'instagram']
+    # in sync_user()
 
     return args
 
 
-def main(user: str, proxy: dict, rate_limit: int, custom_path: str, tags: list,
+def main(users: list, proxy: dict, rate_limit: int, custom_path: str, tags: list,
          min_likes_required: int, only_photos=False, only_videos=False,
-         only_new_files=False, write_db=False, only_db=False):
-    """Download an Instagram user's media plus metadata
+         only_new_files=False, write_db=False, only_db=False, workers=1,
+         media_rate_limit=None, db_synchronous='NORMAL', prefetch=1,
+         tag_workers=1, tag_processes=False, tag_later=False, tag_pending=False,
+         http_cache=None, content_index=None, resume=False, snapshot=False,
+         proxies=None, min_rate_limit=None, catalog=None, repair=None,
+         subfolders=False, active_users=ACTIVE_USERS):
+    """Download Instagram users' media plus metadata
 
-    user: Instagram user
-        Example: 'sportscenter'
+    Users share one session, thread pool and rate limit. Their pages are
+    fetched in turns, one page per user, so no single account holds up the
+    rest. Only active_users of them take turns at once; when one finishes,
+    the next in the list starts.
+
+    users: List of Instagram users
+        Example: ['sportscenter'] or ['sportscenter', 'espn']
 
     proxy: Needs to be in requests format
         Example: {'https': '192.168.0.1:8080'}
@@ -99,7 +302,8 @@ def main(user: str, proxy: dict, rate_limit: int, custom_path: str, tags: list,
     rate_limit: Seconds between Instagram requests
         Example: 5
 
-    custom_path: Optional custom path for saving media files.
+    custom_path: Optional custom path for saving media files. With
+                 subfolders, each user gets a subfolder of it.
         Default: '$USER/Downloads/instadb/user/'
 
     tags: List of tags used for metadata
@@ -114,145 +318,752 @@ def main(user: str, proxy: dict, rate_limit: int, custom_path: str, tags: list,
     write_db: Write user metadata to an Sqlite3 database
     only_db: Skip downloading media files
 
+    workers: Number of media files to download at once
+        Default: 1
+
+    media_rate_limit: Seconds between media file (CDN) requests
+        Default: same as rate_limit
+
+    db_synchronous: SQLite synchronous level (OFF, NORMAL, FULL, EXTRA)
+        Default: 'NORMAL'
+
+    prefetch: How many JSON pages to fetch ahead of the one being processed
+        Default: 1
+
+    tag_workers: Size of the video tagging pool
+        Default: 1
+
+    tag_processes: Tag videos on a process pool instead of threads
+
+    tag_later: Record tagging jobs in each user's pending_tags.jsonl
+               instead of tagging while downloading
+
+    tag_pending: Only tag the files recorded by an earlier tag_later run
+
+    http_cache: Optional ResponseCache for JSON pages
+
+    content_index: Optional ContentIndex; downloads identical to an indexed
+                   file (tags included) become hardlinks of it, videos that
+                   only differ in their tags reflinks (see ContentIndex)
+
+    resume: Fetch posts newer than the last sync, then skip the pages it
+            already walked and continue from its checkpoint
+
+    snapshot: Also record every post's likes count in the likes history
+              (with write_db or only_db). Every cached page is revalidated
+              with Instagram, so no stale likes count is recorded.
+
+    proxies: List of proxies to rotate through instead of `proxy`
+        Example: ['192.168.0.1:8080', '192.168.0.2:8080']
+
+    min_rate_limit: Seconds between requests the rate limits may speed up
+                    to while responses are healthy. They always slow down
+                    on 429s and 5xx errors, and honour Retry-After.
+        Default: never faster than rate_limit / media_rate_limit
+
+    catalog: Optional Catalog that every user's posts are written to
+             instead of a {user}.db each (with write_db or only_db)
+
+    repair: Only download or tag again the files of a repair list, see
+            verify.verify_archive()
+
+    subfolders: Give every user a subfolder of custom_path, however many
+                users there are (--users-file runs), so a user's files are
+                found again by later batches of any size
+
+    active_users: Users synced at once, so a long users list doesn't run
+                  out of file descriptors
+        Default: ACTIVE_USERS
+
+    returns: Dict of {user: Counter} summaries
+
     """
-    retrieve = Retrieve(proxy)
-    base_url = 'https://www.instagram.com/{}/media/'.format(user)
-    mk_downloads_dir(user, custom_path)
-
-    if write_db or only_db:
-        db = Database(user)
-
-    post_counter = 0
-    end_cursor = ''
-    posts_remaining = True
-
-    while posts_remaining:
-        # Let's print some animated progress dots (...)
-        print('\nGrabbing 20 posts', end='')
-        for i in range(3):
-            print('.', end='', flush=True)
-            sleep(rate_limit / 3)
-        print('\n')
-
-        resp = retrieve.get(base_url, end_cursor)
-        if not resp:
-            raise SystemExit()
-
-        posts = JsonPage(resp)
-
-        if posts.private_user(post_counter):
-            raise SystemExit('\n[!] Private user {}\n'.format(user))
-
-        num_posts = posts.num_posts()
-
-        for post in range(num_posts):
-            post_counter += 1
-
-            date = posts.date(post)
-            post_type = posts.post_type(post)
-            code = posts.code(post)
-            likes = posts.likes(post)
-            location = posts.location(post)
-            caption = posts.caption(post)
-            media_files = posts.media(post)
-            end_cursor = posts.end_cursor(post)
-
-            if (write_db or only_db) and db.existing_entry(code) and only_new_files:
-                print('No more new files!')
-                posts_remaining = False
-                continue  # to next post. after these 20, program will end
-            elif (write_db or only_db) and not db.existing_entry(code):
-                db.write(date, post_type, code, likes, location, caption, media_files)
-            elif (write_db or only_db) and db.likes_changed(code, likes):
-                db.update_likes(code, likes)
-
-            if only_db:
-                print('{}: {} - {}'.format(post_counter, user, code))
-                continue  # to next post, skipping the media download
-
-            if min_likes_required and likes < min_likes_required:
-                continue  # to next post
-
-            # This should reset each post iteration, but shouldn't be reset
-            # each media file iteration, so establish it outside media loop.
-            carousel_counter = 1
-
-            for media in media_files:
-                file_ext = media.split('.')[-1]
-                filename = '{} - {}.{}'.format(user, code, file_ext)
-
-                if post_type == 'carousel':
-                    # Insert a counter in the filename after the shortcode
-                    #
-                    # Example:
-                    # sportscenter - BaXyursFd2k (1).jpg
-                    # sportscenter - BaXyursFd2k (2).mp4
-                    # sportscenter - BaXyursFd2k (3).jpg
-                    filename = filename.replace('.{}'.format(file_ext),
-                                                ' ({}).{}'.format(carousel_counter,
-                                                                  file_ext))
-                    carousel_counter += 1
-
-                # Place this logic after carousel counter increment.
-                # If later on we don't specify just --photos or --videos, the
-                # missing files that are filled in will be correctly numbered.
-                if only_photos and file_ext != 'jpg':
-                    continue  # to next media file
-                if only_videos and file_ext != 'mp4':
-                    continue  # to next media file
-
-                if not os.path.exists(filename):
-                    data = retrieve.get(media)
-                    if not data:  # Instagram 404'd the media link
-                        continue  # to next media file
-
-                    with open(filename, 'wb') as file:
-                        file.write(data.content)
-                    print('{}: {}'.format(post_counter, filename))
-
-                    if file_ext == 'mp4':
-                        metadata.process_video(filename, user, date, caption, tags, code)
-                    elif file_ext == 'jpg':
-                        metadata.process_image(filename, user, date, caption, tags, code)
-
-                    sleep(rate_limit)  # between each (.mp4, .jpg) request
-                elif only_new_files:
+    tagger = TaggingStage(tag_workers, tag_processes)
+    if tag_pending:
+        failures = tag_pending_files(users, custom_path, tagger, subfolders)
+        print('\nFinished ({} files couldn\'t be tagged)\n'.format(len(failures)))
+        return {}
+
+    if http_cache and snapshot:
+        http_cache.history_ttl = 0  # a 304 still saves the download
+    retrieve = Retrieve(proxy, rate_limit, media_rate_limit, workers, http_cache,
+                        proxies, min_rate_limit)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    if repair:
+        repaired, missing, failures = repair_files(repair, retrieve, pool,
+                                                   tagger, tags)
+        print('\nFinished ({} files repaired, {} no longer available, {} '
+              'couldn\'t be tagged)\n'.format(repaired, missing, len(failures)))
+        return {}
+
+    options = Options(tags, min_likes_required, only_photos, only_videos,
+                      only_new_files, write_db, only_db, db_synchronous,
+                      prefetch, tag_later, resume, snapshot)
+
+    summaries = OrderedDict((user, Counter()) for user in users)
+    waiting = deque(users)
+    syncs = OrderedDict()
+    try:
+        while True:
+            while waiting and len(syncs) < active_users:
+                user = waiting.popleft()
+                downloads_dir = mk_downloads_dir(user, custom_path, subfolders)
+                syncs[user] = sync_user(user, retrieve, pool, tagger, downloads_dir,
+                                        options, summaries[user], content_index,
+                                        catalog)
+            if not syncs:
+                break
+            for user in list(syncs):
+                try:
+                    next(syncs[user])
+                except StopIteration:
+                    del syncs[user]
+                except UserError as error:
+                    print('\n[!] {}\n'.format(error))
+                    summaries[user]['errors'] += 1
+                    del syncs[user]
+    finally:
+        # Also runs on KeyboardInterrupt, so committed db rows aren't lost
+        for sync in syncs.values():
+            sync.close()
+        pool.shutdown()
+        # Drain the tagging stage before exiting
+        failures = tagger.close()
+
+    if failures:
+        print('\n[!] {} files couldn\'t be tagged'.format(len(failures)))
+
+    if len(users) > 1:
+        print_summaries(summaries)
+
+    print('\nFinished\n')
+    return summaries
+
+
+def sync_user(user, retrieve, pool, tagger, downloads_dir, options, summary,
+              content_index=None, catalog=None):
+    """Download one user's media plus metadata, one page per iteration
+
+    A generator so main() can interleave users; it yields after each page.
+
+    Each page is checkpointed once it's done, but a run only replaces the
+    checkpointed range once its pages have joined up with it, and then
+    with the two ranges together, so a run that stops early (--new) never
+    throws away what an earlier one walked. With options.resume, pages are
+    walked from the newest until they reach the checkpointed range, then
+    the walk jumps to its end (or stops, if it reached the user's first
+    post).
+
+    user: Instagram user
+    retrieve: Shared Retrieve instance
+    pool: Shared ThreadPoolExecutor for media downloads
+    tagger: Shared TaggingStage (unused with options.tag_later)
+    downloads_dir: Folder for this user's files and database
+    options: Options tuple
+    summary: Counter updated with this user's totals
+    content_index: Optional shared ContentIndex for deduplication
+    catalog: Optional shared Catalog to write posts to instead of {user}.db
+
+    raises: UserError if the user is private or can't be fetched
+
+    """
+    tags = options.tags or [user, 'instagram']
+    base_url = BASE_URL.format(user)
+    manifest = Manifest(user, downloads_dir)
+
+    db = None
+    if catalog and (options.write_db or options.only_db):
+        db = catalog.for_user(user)
+    elif options.write_db or options.only_db:
+        db = Database(user, downloads_dir, options.db_synchronous)
+
+    if options.tag_later:
+        tagger = PendingTags(downloads_dir)
+
+    checkpoint = Checkpoint(user, downloads_dir)
+    # Until this run's pages join up with the checkpointed range, saving
+    # them would throw that range away
+    joined = not checkpoint
+    # Once they have, without a jump the checkpointed range reaches further
+    # down than this run until the run passes its cursor
+    extended = None  # (cursor, post_counter, complete) of both ranges
+    top = None  # first post of this run
+    newer_posts = 0  # posts above the checkpointed range
+
+    # Fetches run ahead on their own thread, rate limited by retrieve.get()
+    pages = PagePrefetcher(retrieve, base_url, options.prefetch)
+
+    try:
+        post_counter = 0
+        end_cursor = ''
+        posts_remaining = True
+
+        while posts_remaining:
+            print('\nGrabbing 20 posts from {}...\n'.format(user), flush=True)
+
+            try:
+                posts = pages.next_page()
+            except BadJson as error:
+                with open('bad_json.txt', 'w') as file:
+                    # Dump raw in case we got something besides JSON
+                    file.write(error.args[0])
+                raise SystemExit('\n[!] Bad JSON, check "bad_json.txt"\n')
+            if posts is None:
+                if joined:  # the previous page was the last one
+                    checkpoint.save(top, '', post_counter, complete=True)
+                break
+            elif posts is False:  # an empty page is falsy too
+                raise UserError('Can\'t get posts for {}'.format(user))
+
+            if posts.private_user(post_counter):
+                raise UserError('Private user {}'.format(user))
+
+            synced = []  # (post_counter, post) of the posts to sync
+            for post in posts:
+                post_counter += 1
+                summary['posts'] += 1
+                if top is None:
+                    top = post.id
+                if not joined and not checkpoint.covers(post.id):
+                    newer_posts += 1
+                end_cursor = post.id
+
+                if db and options.only_new_files and db.existing_entry(post.code):
                     print('No more new files!')
                     posts_remaining = False
+                    continue  # to next post. after these 20, program will end
+                synced.append((post_counter, post))
+
+            results = sync_posts(user, [post for _, post in synced], retrieve,
+                                 downloads_dir, None if options.only_db else manifest,
+                                 db, tags, options.only_photos, options.only_videos,
+                                 options.min_likes_required or 0, pool, tagger,
+                                 content_index, options.snapshot, options.tag_later)
+            for (number, _), result in zip(synced, results):
+                if not report(user, number, result, summary, options):
+                    posts_remaining = False
+
+            # The page's db rows are written in one transaction
+            if db:
+                db.flush()
+
+            last_page = not posts.more_available()
+            if not joined and posts.posts and checkpoint.covers(end_cursor):
+                # This run and the checkpoint now cover one gapless range
+                joined = True
+                if not options.resume:
+                    extended = (checkpoint.cursor,
+                                checkpoint.post_counter + newer_posts,
+                                checkpoint.complete)
                 else:
-                    print('{}: {} already exists!'.format(post_counter, filename))
+                    end_cursor = checkpoint.cursor
+                    post_counter = checkpoint.post_counter + newer_posts
+                    if checkpoint.complete:
+                        print('\nCaught up with the last complete sync of {}\n'.format(user))
+                        last_page = True
+                    elif posts_remaining:
+                        print('\nResuming {} from its checkpoint\n'.format(user))
+                        pages.stop()
+                        pages = PagePrefetcher(retrieve, base_url, options.prefetch,
+                                               end_cursor)
+                        last_page = False
+            elif not joined and last_page:
+                joined = True  # every page was walked by this run
 
-        if not posts.more_available():
-            posts_remaining = False
+            if last_page:
+                posts_remaining = False
+            if extended and (last_page or checkpoint.passed(end_cursor)):
+                extended = None  # this run has got further down itself
+            if extended:
+                checkpoint.save(top, *extended)
+            elif joined:
+                checkpoint.save(top, end_cursor, post_counter,
+                                complete=last_page)
 
-    print('\nFinished\n')
+            yield
+    finally:
+        pages.stop()
+        if options.tag_later:
+            tagger.close()
+        if db:
+            db.close()
+
+
+def print_summaries(summaries):
+    """Print a per-user table of what a batch run did
+
+    summaries: Dict of {user: Counter}
+
+    """
+    columns = ['posts', 'downloaded', 'existing', 'db new', 'db changed', 'errors']
+    width = max(len(user) for user in summaries)
+    print('\n{}  {}'.format('user'.ljust(width),
+                            '  '.join(column.rjust(10) for column in columns)))
+    for user, summary in summaries.items():
+        print('{}  {}'.format(user.ljust(width),
+                              '  '.join(str(summary[column]).rjust(10)
+                                        for column in columns)))
+
+
+def report(user, post_counter, result, summary, options):
+    """Print what sync_posts() did with a post and add it to the summary
+
+    returns: False if the post has a file on disk already and
+             options.only_new_files is set, i.e. there are no more new files
+
+    """
+    code = result.post.code
+    if result.db_status:
+        summary['db {}'.format(result.db_status)] += 1
+        if result.db_status == 'new':
+            print('Adding new db entry: {}'.format(code))
+        elif result.db_status == 'changed':
+            print('Updating db likes count for entry: {}'.format(code))
+    if options.only_db:
+        print('{}: {} - {}'.format(post_counter, user, code))
+
+    new_files = True
+    for file in result.files:
+        if file.status == 'existing' and options.only_new_files:
+            print('No more new files!')
+            new_files = False
+        elif file.status == 'existing':
+            print('{}: {} already exists!'.format(post_counter, file.filename))
+            summary['existing'] += 1
+        elif file.status != 'missing':  # Instagram 404'd the media link
+            summary['downloaded'] += 1
+            print('{}: {}{}'.format(post_counter, file.filename, {
+                'linked': ' (linked to an identical file)',
+                'cloned': ' (shares its media with a copy tagged for another post)',
+            }.get(file.status, '')))
+    return new_files
+
+
+def tag_pending_files(users, custom_path, tagger, subfolders=False):
+    """Tag the files each user's --tag-later runs left in pending_tags.jsonl
+
+    Jobs that fail stay in the pending file for the next pass.
+
+    returns: List of (path, reason) failures
+
+    """
+    for user in users:
+        downloads_dir = mk_downloads_dir(user, custom_path, subfolders)
+        jobs = read_pending(downloads_dir)
+        print('\nTagging {} pending files for {}'.format(len(jobs), user))
+        for job in jobs:
+            if os.path.exists(job.path):
+                tagger.submit(job)
 
+    failures = tagger.close()
+    failed_paths = set(path for path, _ in failures)
 
-def mk_downloads_dir(user, custom_path):
+    for user in users:
+        downloads_dir = mk_downloads_dir(user, custom_path, subfolders)
+        jobs = [job for job in read_pending(downloads_dir)
+                if job.path in failed_paths]
+        pending_file = os.path.join(downloads_dir, PendingTags.FILENAME)
+        if os.path.exists(pending_file):
+            os.remove(pending_file)
+        if jobs:
+            pending = PendingTags(downloads_dir)
+            for job in jobs:
+                pending.submit(job)
+            pending.close()
+
+    return failures
+
+
+def repair_files(entries, retrieve, pool, tagger, tags=None):
+    """Download or tag again the files of a verify repair list
+
+    Files to refetch are downloaded from the URL in the database, a
+    leftover .part being resumed; the broken file is only replaced once the
+    download is complete. Media URLs expire, so the ones that 404 need a
+    normal sync of the user instead. Files that only lost their tags are
+    tagged again.
+
+    entries: Repair list entries, see verify.read_repair_list()
+    tags: List of tags used for metadata
+        Default: [user, 'instagram']
+
+    returns: (files repaired, files 404'd, tagging failures)
+
+    """
+    def job(entry):
+        return TagJob(entry['path'], entry['user'], entry['date'], entry['caption'],
+                      tags or [entry['user'], 'instagram'], entry['code'])
+
+    def refetch(entry):
+        return fetch_file(retrieve, entry['url'], entry['path'], entry['user'],
+                          entry['date'], entry['caption'],
+                          tags or [entry['user'], 'instagram'], entry['code'])
+
+    refetches = [entry for entry in entries if entry['action'] == 'refetch']
+    retags = [entry for entry in entries if entry['action'] == 'retag']
+    print('\nRepairing {} files ({} to download, {} to tag)'.format(
+        len(entries), len(refetches), len(retags)))
+
+    repaired = missing = 0
+    for entry, (digest, tagged) in zip(refetches, pool.map(refetch, refetches)):
+        if not digest:
+            print('[!] {} is no longer available, sync {} to fetch it'.format(
+                entry['path'], entry['user']))
+            missing += 1
+            continue
+        repaired += 1
+        if not tagged:
+            tagger.submit(job(entry))
+    for entry in retags:
+        if os.path.exists(entry['path']):
+            tagger.submit(job(entry))
+            repaired += 1
+
+    pool.shutdown()
+    failures = tagger.close()
+    return repaired - len(failures), missing, failures
+
+
+def mk_downloads_dir(user, custom_path, subfolder=False):
     """Create the downloads directory for the Instagram user.
 
     user: The Instagram user
     custom_path: An optional custom path defined by the --path CLI arg
                  Default path is "$USER/Downloads/instadb/$ig_user/"
+    subfolder: Use "custom_path/$ig_user/" (batch runs share one --path)
+
+    returns: The downloads directory
 
     """
-    if custom_path:
+    if custom_path and subfolder:
+        downloads_dir = os.path.join(custom_path, user)
+    elif custom_path:
         downloads_dir = custom_path
     else:
-        downloads_dir = os.path.expanduser(os.path.join('~', 'Downloads', 'instadb', user))
+        downloads_dir = os.path.join(archive_dir(None), user)
     try:
         os.makedirs(downloads_dir, exist_ok=True)
     except PermissionError:
         raise SystemExit('\n[!] PermissionError creating downloads folder "{}"\n'.format(downloads_dir))
-    os.chdir(downloads_dir)
+    return downloads_dir
+
+
+def read_proxies_file(path):
+    """Read proxies from a file, one address:port per line
+
+    Blank lines and lines starting with # are skipped.
+
+    """
+    try:
+        with open(path) as file:
+            lines = [line.strip() for line in file]
+    except OSError as error:
+        raise SystemExit('\n[!] Can\'t read proxies file: {}\n'.format(error))
+    proxies = [line for line in lines if line and not line.startswith('#')]
+    for proxy in proxies:
+        if not correct_proxy_format(proxy):
+            raise SystemExit('\n[!] {} in {} is not address:port\n'.format(proxy, path))
+    return proxies
+
+
+def archive_dir(custom_path):
+    """Return the folder that holds every user's downloads
+
+    custom_path: The --path CLI arg, default "$USER/Downloads/instadb/"
+
+    """
+    return custom_path or os.path.expanduser(ARCHIVE_DIR)
+
+
+def read_users_file(path):
+    """Read Instagram users from a file, one per line
+
+    Blank lines and lines starting with # are skipped.
+
+    """
+    try:
+        with open(path) as file:
+            lines = [line.strip() for line in file]
+    except OSError as error:
+        raise SystemExit('\n[!] Can\'t read users file: {}\n'.format(error))
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def parse_command_args(argv):
+    """Parse arguments for `instadb.py COMMAND ...`"""
+    parser = argparse.ArgumentParser(
+        prog='instadb.py',
+        description='Maintenance commands for an instadb archive')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    dedupe = commands.add_parser(
+        'dedupe',
+        help='Hardlink identical media files across an archive, reflink '
+             'videos that only differ in their tags')
+    dedupe.add_argument(
+        'path',
+        help='Archive folder (default: "$USER/Downloads/instadb/")',
+        nargs='?')
+    dedupe.add_argument(
+        '--workers',
+        help='Number of files to hash at once (default: one per CPU)',
+        type=int,
+        metavar='N')
+    dedupe.add_argument(
+        '--dry-run',
+        help='Only print what would be linked',
+        action='store_true')
+
+    query = commands.add_parser(
+        'query',
+        help='Search a user\'s database by caption text, likes and date')
+    query.add_argument(
+        'user',
+        help='Instagram user')
+    query.add_argument(
+        'text',
+        help='Words to find in captions and locations (SQLite FTS5 syntax, '
+             'e.g. \'"world cup" OR olympics\')',
+        nargs='?')
+    query.add_argument(
+        '--path',
+        help='Folder with the user\'s database (default: "$USER/Downloads/instadb/$ig_user/")',
+        metavar='PATH')
+    query.add_argument(
+        '--min-likes',
+        type=int,
+        metavar='N')
+    query.add_argument(
+        '--max-likes',
+        type=int,
+        metavar='N')
+    query.add_argument(
+        '--since',
+        help='First date, YYYY, YYYY-MM or YYYY-MM-DD',
+        metavar='DATE')
+    query.add_argument(
+        '--until',
+        help='Last date (inclusive), YYYY, YYYY-MM or YYYY-MM-DD',
+        metavar='DATE')
+    query.add_argument(
+        '--sort',
+        help='Order of the results (default: %(default)s, rank is best text '
+             'match first)',
+        choices=['likes', 'date', 'rank'],
+        default='likes')
+    query.add_argument(
+        '--limit',
+        help='Show at most N posts',
+        type=int,
+        metavar='N')
+    query.add_argument(
+        '--media',
+        help='List each post\'s media files too',
+        action='store_true')
+
+    export_parser = commands.add_parser(
+        'export',
+        help='Write the posts of user databases to JSONL, CSV or Parquet')
+    export_parser.add_argument(
+        'paths',
+        help='User databases, or folders to search for them (default: '
+             '"$USER/Downloads/instadb/")',
+        nargs='*',
+        metavar='PATH')
+    export_parser.add_argument(
+        '--output',
+        help='File to write (default: stdout)',
+        metavar='FILE',
+        default='-')
+    export_parser.add_argument(
+        '--format',
+        help='Output format (default: from the --output extension, else jsonl; '
+             'parquet needs pyarrow)',
+        choices=FORMATS)
+    export_parser.add_argument(
+        '--watermark',
+        help='Only export posts updated since the last export that used this '
+             'file, then record this one in it',
+        metavar='FILE')
+
+    import_parser = commands.add_parser(
+        'import',
+        help='Merge user databases into a shared catalog (see --catalog)')
+    import_parser.add_argument(
+        'paths',
+        help='User databases, or folders to search for them (default: '
+             '"$USER/Downloads/instadb/")',
+        nargs='*',
+        metavar='PATH')
+    import_parser.add_argument(
+        '--catalog',
+        help='Catalog database to merge into (default: {} in the archive '
+             'folder)'.format(Catalog.FILENAME),
+        metavar='FILE')
+
+    verify_parser = commands.add_parser(
+        'verify',
+        help='Check an archive\'s files against its user databases and list '
+             'the broken ones for --repair')
+    verify_parser.add_argument(
+        'path',
+        help='Archive folder (default: "$USER/Downloads/instadb/")',
+        nargs='?')
+    verify_parser.add_argument(
+        '--output',
+        help='Repair list to write (default: repair.jsonl in the archive folder)',
+        metavar='FILE')
+    verify_parser.add_argument(
+        '--workers',
+        help='Number of files to check at once (default: one per CPU)',
+        type=int,
+        metavar='N')
+    verify_parser.add_argument(
+        '--missing',
+        help='Also list files that were never downloaded (skipped by --photos, '
+             '--videos, --likes or --only-db)',
+        action='store_true')
+    verify_parser.add_argument(
+        '--no-tags',
+        help='Don\'t check titles and dates',
+        action='store_false',
+        dest='check_tags')
+
+    return parser.parse_args(argv)
+
+
+def run_command(args):
+    """Run a maintenance command parsed by parse_command_args()"""
+    if args.command == 'dedupe':
+        root = archive_dir(args.path)
+        if not os.path.isdir(root):
+            raise SystemExit('\n[!] No archive folder at {}\n'.format(root))
+        # Untagged files would end up sharing whichever tags are written last
+        pending = set(os.path.abspath(job.path) for directory, _, filenames in os.walk(root)
+                      if PendingTags.FILENAME in filenames
+                      for job in read_pending(directory))
+        scanned, linked, cloned, saved = dedupe_archive(root, args.workers,
+                                                        args.dry_run, pending)
+        would = 'would be ' if args.dry_run else ''
+        print('\n{} files scanned, {} {}linked, {} {}cloned, {:.1f} MB {}saved\n'.format(
+            scanned, linked, would, cloned, would, saved / 2 ** 20, would))
+
+    elif args.command == 'query':
+        directory = args.path or os.path.join(archive_dir(None), args.user)
+        if not os.path.exists(os.path.join(directory, '{}.db'.format(args.user))):
+            raise SystemExit('\n[!] No database for {} in {}\n'.format(args.user, directory))
+        db = Database(args.user, directory)
+        try:
+            posts = db.search(args.text, args.min_likes, args.max_likes,
+                              args.since, args.until, args.sort, args.limit)
+        except sqlite3.OperationalError as error:
+            raise SystemExit('\n[!] Bad search "{}": {}\n'.format(args.text, error))
+        for code, date, _, likes, location, caption in posts:
+            caption = ' '.join((caption or '').split())
+            print('{:>8}  {}  {}  {}'.format(likes, date, code, caption[:80]))
+            if args.media:
+                for _, _, _, filename in db.media(code):
+                    print('{:>8}  {}'.format('', filename))
+        print('\n{} posts\n'.format(len(posts)))
+        db.close()
+
+    elif args.command == 'export':
+        databases = find_databases(args.paths or [archive_dir(None)])
+        if not databases:
+            raise SystemExit('\n[!] No user databases found\n')
+        output_format = args.format
+        if not output_format:
+            extension = os.path.splitext(args.output)[1].lstrip('.').lower()
+            output_format = extension if extension in FORMATS else 'jsonl'
+        written = export(databases, args.output, output_format, args.watermark)
+        print('\n[+] Exported {} posts from {} databases\n'.format(
+            written, len(databases)), file=sys.stderr)
+
+    elif args.command == 'import':
+        databases = find_databases(args.paths or [archive_dir(None)])
+        if not databases:
+            raise SystemExit('\n[!] No user databases found\n')
+        catalog = Catalog(args.catalog or os.path.join(archive_dir(None),
+                                                       Catalog.FILENAME))
+        total = 0
+        for user, path in databases:
+            posts = catalog.import_database(user, path)
+            total += posts
+            print('{}: {} posts'.format(user, posts))
+        catalog.close()
+        print('\n[+] Merged {} posts from {} databases into {}\n'.format(
+            total, len(databases), catalog.path))
+
+    elif args.command == 'verify':
+        root = archive_dir(args.path)
+        if not os.path.isdir(root):
+            raise SystemExit('\n[!] No archive folder at {}\n'.format(root))
+        output = args.output or os.path.join(root, 'repair.jsonl')
+        try:
+            found = verify_archive(root, output, args.workers, args.missing,
+                                   args.check_tags)
+        except ImportError as error:
+            raise SystemExit('\n[!] {}\n'.format(error))
+        broken = sum(found.values()) - found['ok'] - (
+            0 if args.missing else found['missing'])
+        print('\n{} files checked, {} broken{}'.format(
+            sum(found.values()), broken,
+            '' if args.missing else ', {} never downloaded'.format(found['missing'])))
+        for problem, count in sorted(found.items()):
+            if problem != 'ok' and count:
+                print('{:>8}  {}'.format(count, problem))
+        if broken:
+            print('\n[+] Repair list: {}\n'
+                  'Fix with: instadb.py --repair {}\n'.format(output, output))
+        else:
+            print()
 
 
 if __name__ == '__main__':
 
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        sys.exit(run_command(parse_command_args(sys.argv[1:])))
+
     ARGS = parse_args()
+    if not ARGS.only_db:
+        # Loaded on first use, but a missing mutagen should stop the run now
+        try:
+            import metadata  # noqa: F401
+        except ImportError as error:
+            raise SystemExit('\n[!] {}\n'.format(error))
+    CATALOG = Catalog(ARGS.catalog, ARGS.db_synchronous) if ARGS.catalog else None
+    CONTENT_INDEX = None
+    if ARGS.dedupe:
+        os.makedirs(archive_dir(ARGS.path), exist_ok=True)
+        CONTENT_INDEX = ContentIndex(os.path.join(archive_dir(ARGS.path),
+                                                  ContentIndex.FILENAME))
+    MAIN_ARGS = (ARGS.users, ARGS.proxy, ARGS.rate_limit, ARGS.path, ARGS.tags,
+                 ARGS.likes, ARGS.photos, ARGS.videos, ARGS.new, ARGS.write_db,
+                 ARGS.only_db, ARGS.workers, ARGS.media_rate_limit,
+                 ARGS.db_synchronous, ARGS.prefetch, ARGS.tag_workers,
+                 ARGS.tag_processes, ARGS.tag_later, ARGS.tag_pending,
+                 ResponseCache(ARGS.cache, ARGS.cache_size * 2 ** 20,
+                               history_ttl=ARGS.cache_ttl) if ARGS.cache else None,
+                 CONTENT_INDEX, ARGS.resume, ARGS.snapshot, ARGS.proxies,
+                 ARGS.min_rate_limit, CATALOG, ARGS.repair,
+                 ARGS.users_file is not None, ARGS.active_users)
+
+    STATS_WRITER = None
+    if ARGS.stats:
+        stats.enable()
+        if ARGS.stats_interval:
+            STATS_WRITER = stats.write_every(ARGS.stats, ARGS.stats_interval)
     try:
-        main(ARGS.user, ARGS.proxy, ARGS.rate_limit, ARGS.path, ARGS.tags,
-             ARGS.likes, ARGS.photos, ARGS.videos, ARGS.new, ARGS.write_db,
-             ARGS.only_db)
+        if ARGS.profile:
+            profile(main, ARGS.profile, *MAIN_ARGS)
+        else:
+            main(*MAIN_ARGS)
     except KeyboardInterrupt:
         raise SystemExit('\n\n[!] Interrupted by user\n')
+    finally:
+        if CATALOG:
+            CATALOG.close()
+        if STATS_WRITER:
+            STATS_WRITER.set()
+        if ARGS.stats:
+            stats.write(ARGS.stats)
@@ -0,0 +1,82 @@
+import os
+import struct
+
+
+def mp4_atoms(data):
+    """Return the (name, offset, size) of an MP4's top-level atoms, or None
+
+    None means the atom sizes don't add up to the file size.
+
+    data: The file's bytes, e.g. an mmap (only the atom headers are read)
+
+    """
+    atoms = []
+    position = 0
+    while position < len(data):
+        if position + 8 > len(data):
+            return None
+        size, name = struct.unpack('>I4s', data[position:position + 8])
+        if size == 1:
+            if position + 16 > len(data):
+                return None
+            size = struct.unpack('>Q', data[position + 8:position + 16])[0]
+        elif size == 0:  # runs to the end of the file
+            size = len(data) - position
+        if size < 8 or position + size > len(data):
+            return None
+        atoms.append((bytes(name), position, size))
+        position += size
+    return atoms
+
+
+class Manifest:
+    """Index of a user's media files already on disk
+
+    The downloads folder is read once with os.scandir() instead of calling
+    os.path.exists() for every media file, which is one server round trip
+    per call on network mounted storage. Looking a file up costs nothing
+    more: no file is opened. Downloads go to a .part file first, so a file
+    under its final name is complete unless an older version wrote it
+    there and got cut short; `instadb.py verify` finds those (see
+    verify.check_file()) and --repair fetches them again.
+
+    """
+
+    def __init__(self, user, directory='.'):
+        """
+        user: Instagram user, only "{user} - *" files are indexed
+        directory: Downloads folder for the user
+
+        """
+        self.files = {}  # filename: size in bytes
+        self.partial = {}  # filename: size of its unfinished .part file
+
+        prefix = '{} - '.format(user)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.startswith(prefix) or not entry.is_file():
+                    continue
+                size = entry.stat().st_size
+                if entry.name.endswith('.part'):
+                    self.partial[entry.name[:-len('.part')]] = size
+                else:
+                    self.files[entry.name] = size
+
+    def __contains__(self, filename):
+        """True if filename is on disk and finished
+
+        Zero-byte files and files with a leftover .part (an interrupted
+        download) don't count, so they get fetched again.
+
+        """
+        return self.files.get(filename, 0) > 0 and filename not in self.partial
+
+    def add(self, filename, size):
+        """Record a file that finished downloading"""
+        self.files[filename] = size
+        self.partial.pop(filename, None)
+
+    def broken(self):
+        """Return the filenames that are empty or unfinished"""
+        empty = [name for name, size in self.files.items() if not size]
+        return sorted(set(empty) | set(self.partial))
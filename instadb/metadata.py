@@ -1,12 +1,23 @@
+import atexit
+import io
+import json
 import os
 import re
 import string
+import struct
 import subprocess
+import threading
+from time import perf_counter
+
+from stats import stats
 
 try:
-    from mutagen.mp4 import MP4, MP4StreamInfoError
+    from mutagen.mp4 import MP4, MP4StreamInfoError, MP4Tags
 except ImportError:
-    raise SystemExit('\n[!] Mutagen not installed\npip3 install mutagen\n')
+    raise ImportError('Mutagen not installed\npip3 install mutagen') from None
+
+VIDEO_PADDING = 4096  # free bytes kept after a video's tags
+RESERVED_TAG_SPACE = 32 * 1024  # room for the longest caption, three times
 
 
 def process_video(filename: str, user: str, date=None, caption=None,
@@ -31,19 +42,40 @@ def process_video(filename: str, user: str, date=None, caption=None,
     code: Add an Instagram shortcode to the title
         Example: 'BapbIcAFsCL'
 
+    returns: False if the file can't be read as an MP4
+
     """
     title = user
     if code:
         title += ' - {}'.format(code)
 
+    with stats.timer('tag_video'):
+        return tag_video(filename, user, title, date, caption, tags)
+
+
+def tag_video(filename, user, title, date, caption, tags):
+    """The mutagen part of process_video()
+
+    The old tags are replaced in memory and the file is saved once. Saving
+    keeps (or adds) VIDEO_PADDING bytes of free space after the tags, so a
+    file that already has room, e.g. from a VideoTagStream, is updated in
+    place instead of being rewritten from its moov atom on.
+
+    """
     try:
         video = MP4(filename)
-    except MP4StreamInfoError:
-        print('\n[!] Can\'t write tags for {}'.format(filename))
-        print('[!] It probably didn\'t download correctly\n')
-        return
+    except MP4StreamInfoError:  # it probably didn't download correctly
+        stats.count('tag_failures')
+        return False
+
+    set_video_tags(video, user, title, date, caption, tags)
+    video.save(padding=video_padding)
+    return True
 
-    video.delete()  # existing metadata
+
+def set_video_tags(video, user, title, date, caption, tags):
+    """Replace every tag of a mutagen MP4 (not saved yet)"""
+    video.tags = MP4Tags()  # drop the existing metadata
 
     video['\xa9nam'] = title
 
@@ -64,7 +96,176 @@ def process_video(filename: str, user: str, date=None, caption=None,
     video['cprt'] = user  # Copyright
     video['----:com.apple.iTunes:iTunMOVI'] = xml_tags(user)  # Actor
 
-    video.save()
+
+def video_padding(info):
+    """Mutagen padding callback: keep the free space if the tags fit in it"""
+    return info.padding if info.padding >= 0 else VIDEO_PADDING
+
+
+class VideoTagStream:
+    """Tag an MP4 while it's being downloaded, so it's written only once
+
+    Tagging a finished file makes the moov atom grow, and when moov comes
+    before mdat (as in Instagram's videos) everything after it has to be
+    rewritten. Instead, the top-level atoms are held back until moov is
+    complete, tagged in memory (mutagen shifts the chunk offsets by the
+    bytes it adds), and written out; the rest of the file passes through.
+
+    Files with mdat first, or that aren't MP4s, pass through untagged and
+    `tagged` stays False, so they go through process_video() as usual.
+
+    A .part file that already got its tags is recorded in a small
+    "{part}.tags" file, so an interrupted download can resume: the server
+    offset is the .part size minus `shift`, the bytes the tags added. The
+    untagged head is kept in "{part}.head", so the resumed download can
+    still hash exactly what the server sent (see hash_part()).
+
+    """
+    MAX_HEAD = 64 * 1024 * 1024  # give up on a moov that isn't found by then
+
+    def __init__(self, user, date=None, caption=None, tags=None, code=None,
+                 reserve_only=False, log=print):
+        """
+        See process_video() for the metadata parameters.
+
+        reserve_only: Only add empty tags with RESERVED_TAG_SPACE of padding,
+                      so the file can be tagged in place later (--tag-later)
+        log: Called with a message when the file can't be tagged on the way
+
+        """
+        self.log = log
+        self.user = user
+        self.title = user if not code else '{} - {}'.format(user, code)
+        self.date = date
+        self.caption = caption
+        self.tags = tags
+        self.reserve_only = reserve_only
+        self.part = None
+        self.reset()
+
+    def reset(self):
+        """Start over with an empty .part"""
+        self.head = bytearray()  # None once the head has been written
+        self.head_size = 0  # bytes of the .part that hold the tagged head
+        self.shift = 0
+        self.tagged = False
+        self.close()
+
+    def resume(self, part):
+        """Pick up the state of a download into `part`
+
+        returns: The bytes to subtract from the .part size to get the
+                 offset to request from the server
+
+        """
+        self.part = part
+        record = part + '.tags'
+        size = os.path.getsize(part) if os.path.exists(part) else 0
+        if not os.path.exists(record):
+            self.reset()
+            if size:  # an untagged .part, the tags are written afterwards
+                self.head = None
+            return 0
+
+        with open(record, encoding='UTF-8') as file:
+            shift, head_size = json.load(file)
+        if size < head_size or not os.path.exists(part + '.head'):
+            # Interrupted while writing the head, or by an older version
+            os.remove(part)
+            self.reset()
+            return 0
+        self.head = None
+        self.head_size = head_size
+        self.shift = shift
+        self.tagged = not self.reserve_only
+        return shift
+
+    def hash_part(self, digest):
+        """Feed digest the server's bytes of the .part being resumed
+
+        The .part starts with the tagged head, so the untagged one is
+        hashed in its place.
+
+        """
+        if self.head_size:
+            with open(self.part + '.head', 'rb') as file:
+                digest.update(file.read())
+        with open(self.part, 'rb') as file:
+            file.seek(self.head_size)
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+
+    def feed(self, chunk):
+        """Take the next downloaded chunk, return the bytes to write"""
+        if self.head is None:
+            return chunk
+        self.head += chunk
+
+        position = 0
+        while position + 8 <= len(self.head):
+            size, name = struct.unpack('>I4s', self.head[position:position + 8])
+            if size == 1 and position + 16 <= len(self.head):
+                size = struct.unpack('>Q', self.head[position + 8:position + 16])[0]
+            elif size == 1:
+                break  # need the 64 bit size
+            if size < 8 or name in (b'mdat', b'moof'):
+                return self.pass_through()  # not an MP4, or moov isn't first
+            if name == b'moov' and position + size <= len(self.head):
+                return self.write_head(position + size)
+            if position + size > len(self.head):
+                break
+            position += size
+
+        if len(self.head) > self.MAX_HEAD:
+            return self.pass_through()
+        return b''
+
+    def finish(self):
+        """The download ended, return whatever is still held back"""
+        if self.head is None:
+            return b''
+        return self.pass_through()
+
+    def pass_through(self):
+        data, self.head = bytes(self.head), None
+        return data
+
+    def write_head(self, end):
+        """Tag the atoms up to the end of moov, return them and the rest"""
+        with stats.timer('tag_video'):
+            head = io.BytesIO(self.head[:end])
+            try:
+                video = MP4(head)
+                if self.reserve_only:
+                    video.tags = MP4Tags()
+                    video.save(head, padding=lambda info: RESERVED_TAG_SPACE)
+                else:
+                    set_video_tags(video, self.user, self.title, self.date,
+                                   self.caption, self.tags)
+                    video.save(head, padding=video_padding)
+            except Exception as error:  # anything mutagen can't parse
+                self.log('\n[!] Tagging {} after the download: {}\n'.format(
+                    self.part, error))
+                return self.pass_through()
+
+        data = head.getvalue()
+        self.shift = len(data) - end
+        self.head_size = len(data)
+        with open(self.part + '.head', 'wb') as file:
+            file.write(self.head[:end])
+        with open(self.part + '.tags', 'w', encoding='UTF-8') as file:
+            json.dump([self.shift, len(data)], file)
+        self.tagged = not self.reserve_only
+
+        data += self.head[end:]
+        self.head = None
+        return data
+
+    def close(self):
+        """The download is complete, forget the .part's record"""
+        for extension in ('.tags', '.head'):
+            if self.part and os.path.exists(self.part + extension):
+                os.remove(self.part + extension)
 
 
 def xml_tags(user):
@@ -86,10 +287,210 @@ def xml_tags(user):
     return output.encode('UTF-8')
 
 
+class ExifTool:
+    """A long-lived exiftool process (-stay_open True -@ -)
+
+    Spawning exiftool costs far more than the tagging itself, so one process
+    is kept around and fed commands over stdin. Commands are queued and sent
+    in batches; each queued command is a single write to a single file.
+
+    The process has one pipe, so threads sharing an ExifTool take turns.
+    Each TaggingStage has an ExifTool of its own, so their flushes don't
+    return each other's results.
+
+    """
+    SENTINEL = '{ready}'
+
+    def __init__(self, executable='exiftool', batch_size=20):
+        """
+        executable: exiftool binary name or full PATH
+        batch_size: Number of queued commands that triggers a flush
+
+        """
+        self.executable = executable
+        self.batch_size = batch_size
+        self.process = None
+        self.pending = []
+        self.sent = []  # results of the batches queue() sent on its own
+        self.lock = threading.RLock()  # a batch is written and read whole
+
+    def start(self):
+        """Launch the exiftool process if it isn't already running
+
+        raises: FileNotFoundError if exiftool isn't installed
+
+        """
+        if self.process and self.process.poll() is None:
+            return
+        try:
+            self.process = subprocess.Popen(
+                [self.executable, '-stay_open', 'True', '-@', '-'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)  # errors are read between sentinels
+        except FileNotFoundError:
+            raise FileNotFoundError('Can\'t find {} in the system PATH. Did you '
+                                    'install it?'.format(self.executable)) from None
+
+    def queue(self, filename: str, args: list):
+        """Queue one write of `args` to `filename`, sending a full batch
+
+        The results of a batch sent here are kept for the next flush().
+
+        """
+        with self.lock:
+            self.pending.append((filename, args))
+            if len(self.pending) >= self.batch_size:
+                self.sent.extend(self.send())
+
+    def flush(self):
+        """Send every queued command and wait for all of them to finish
+
+        returns: List of (filename, output) tuples for every command queued
+                 since the last flush, output being any warnings or errors
+                 exiftool printed for that file (or the error that stopped
+                 exiftool)
+
+        """
+        with self.lock:
+            results = self.sent + self.send()
+            self.sent = []
+            return results
+
+    def send(self):
+        """Send the queued commands, return their (filename, output) tuples"""
+        if not self.pending:
+            return []
+
+        batch, self.pending = self.pending, []
+        lines = []
+        for filename, args in batch:
+            lines.extend(args)
+            lines.extend([filename, '-overwrite_original_in_place', '-q', '-execute'])
+        results = []
+        started = perf_counter()
+        try:
+            self.start()
+            self.process.stdin.write(('\n'.join(lines) + '\n').encode('UTF-8'))
+            self.process.stdin.flush()
+
+            for filename, _ in batch:
+                output = []
+                while True:
+                    line = self.process.stdout.readline()
+                    if not line:
+                        raise BrokenPipeError('exiftool exited unexpectedly')
+                    line = line.decode('UTF-8', 'replace').strip()
+                    if line == self.SENTINEL:
+                        break
+                    output.append(line)
+                results.append((filename, '\n'.join(output)))
+        except OSError as error:
+            # The rest of the batch is lost, the next flush starts a new process
+            self.process = None
+            for filename, _ in batch[len(results):]:
+                results.append((filename, str(error)))
+        stats.observe('tag_exiftool_batch', perf_counter() - started)
+        stats.count('images_tagged', len(results))
+        stats.count('tag_failures', sum(1 for _, output in results if output))
+        return results
+
+    def close(self):
+        """Flush anything queued and shut the exiftool process down
+
+        returns: The results of the last flush(), see there
+
+        """
+        with self.lock:
+            results = self.flush()
+            if self.process and self.process.poll() is None:
+                self.process.stdin.write(b'-stay_open\nFalse\n')
+                self.process.stdin.flush()
+                self.process.wait()
+            self.process = None
+            return results
+
+
+_exiftool = ExifTool()
+atexit.register(_exiftool.close)
+
+
+def flush_images(exiftool=None):
+    """Write any queued image metadata to disk
+
+    exiftool: The ExifTool the images were queued on (default: the shared one)
+
+    returns: See ExifTool.flush()
+
+    """
+    return (exiftool or _exiftool).flush()
+
+
+def image_args(user: str, date=None, caption=None, tags=None, code=None):
+    """Build the exiftool arguments for an image's metadata
+
+    Everything goes into one argument list so the file is only rewritten
+    once. See process_image() for the parameters.
+
+    """
+    title = user
+    if code:
+        title += ' - {}'.format(code)
+
+    args = ['-XPSubject={}'.format(user),  # Exif
+            '-XPAuthor={}'.format(user),  # Exif
+            '-Artist={}'.format(user),  # Exif
+            '-Credit={}'.format(user),  # Iptc
+            '-Copyright={}'.format(user),  # Exif
+            '-Headline={}'.format(title),  # Iptc
+            '-Title={}'.format(title)]  # XMP
+
+    if tags and isinstance(tags, list):
+        for tag in tags:
+            args.append('-Keywords+={}'.format(tag))  # Iptc
+
+    if caption:
+        caption = remove_unicode(caption)
+        for tag in ['UserComment',  # Exif
+                    'Description',  # XMP
+                    'Caption',  # Iptc
+                    'XPComment']:  # Exif
+            args.append(argfile_line('-{}={}'.format(tag, caption)))
+
+    if date and correct_date_format(date):
+        args.append('-DateTimeOriginal={}'.format(date))  # Exif
+        # Set the modification date.
+        #
+        # "-FileModifyDate<DateTimeOriginal" copies the value that's already
+        # in the file, so it only worked as a second exiftool run. Setting it
+        # from the same date string lets it share the write.
+        args.append('-FileModifyDate={}'.format(date))
+
+    return args
+
+
+def argfile_line(arg):
+    """Escape an argument for exiftool's -@ argfile (one argument per line)
+
+    Captions can contain newlines, so those lines are written with the
+    #[CSTR] prefix, which makes exiftool decode C-style escapes.
+
+    """
+    if '\n' not in arg and '\r' not in arg:
+        return arg
+    escaped = (arg.replace('\\', '\\\\')
+               .replace('\n', '\\n')
+               .replace('\r', '\\r'))
+    return '#[CSTR]{}'.format(escaped)
+
+
 def process_image(filename: str, user: str, date=None, caption=None,
-                  tags=None, code=None):
+                  tags=None, code=None, exiftool=None):
     """Use exiftool to embed metadata to an image file
 
+    The write is queued on an exiftool process (see ExifTool) and happens
+    on the next flush_images() call, a full batch, or at exit.
+
     filename: This can be a cwd file or a full PATH
         Example: 'image.jpg' or '/home/you/Pictures/image.jpg'
 
@@ -108,54 +509,17 @@ def process_image(filename: str, user: str, date=None, caption=None,
     code: Add an Instagram shortcode to the title
         Example: 'BapbIcAFsCL'
 
-    """
-    if not os.path.exists(filename):
-        raise SystemExit('\n[!] Can\'t find {}\n'.format(filename))
+    exiftool: ExifTool to queue the write on
+        Default: the shared one, flushed at exit
 
-    title = user
-    if code:
-        title += ' - {}'.format(code)
+    raises: FileNotFoundError if there's no such file. exiftool's own
+            errors come back from flush_images().
 
-    try:
-        subprocess.run(['exiftool', '{}'.format(filename),
-                        '-XPSubject={}'.format(user),  # Exif
-                        '-XPAuthor={}'.format(user),  # Exif
-                        '-Artist={}'.format(user),  # Exif
-                        '-Credit={}'.format(user),  # Iptc
-                        '-Copyright={}'.format(user),  # Exif
-                        '-Headline={}'.format(title),  # Iptc
-                        '-Title={}'.format(title),  # XMP
-                        '-overwrite_original', '-q'])
-    except FileNotFoundError:
-        raise SystemExit('\n[!] Can\'t find exiftool in the system PATH. '
-                         'Did you install it?\n')
-
-    if tags and isinstance(tags, list):
-        for tag in tags:
-            subprocess.run(['exiftool', '{}'.format(filename),
-                            '-Keywords+={}'.format(tag),  # Iptc
-                            '-overwrite_original', '-q'])
-
-    if caption:
-        caption = remove_unicode(caption)
-        subprocess.run(['exiftool', '{}'.format(filename),
-                        '-UserComment={}'.format(caption),  # Exif
-                        '-Description={}'.format(caption),  # XMP
-                        '-Caption={}'.format(caption),  # Iptc
-                        '-XPComment={}'.format(caption),  # Exif
-                        '-overwrite_original', '-q'])
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError('Can\'t find {}'.format(filename))
 
-    if date and correct_date_format(date):
-        subprocess.run(['exiftool', '{}'.format(filename),
-                        '-DateTimeOriginal={}'.format(date),  # Exif
-                        '-overwrite_original', '-q'])
-        # Set the modification date.
-        #
-        # This has to be done separate from -DateTimeOriginal
-        # being added or else it doesn't work.
-        subprocess.run(['exiftool', '{}'.format(filename),
-                        '-FileModifyDate<DateTimeOriginal',
-                        '-overwrite_original', '-q'])
+    (exiftool or _exiftool).queue(filename, image_args(user, date, caption, tags, code))
 
 
 def remove_unicode(caption):
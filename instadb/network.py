@@ -1,9 +1,25 @@
+import os
 import re
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import monotonic, perf_counter, sleep
+from urllib.parse import urlparse
+
+from dedupe import hash_file, new_hash
+from proxies import ProxyPool
+from stats import stats
 
 try:
     import requests
 except ImportError:
-    raise SystemExit('\n[!] Requests not installed\npip3 install requests\n')
+    raise ImportError('Requests not installed\npip3 install requests') from None
+
+
+class FetchError(Exception):
+    """A request failed and there's no proxy to switch to, or a URL kept
+    failing (interactive=False)"""
 
 
 def correct_proxy_format(proxy):
@@ -21,6 +37,118 @@ def correct_proxy_format(proxy):
         return True
 
 
+class TokenBucket:
+    """Thread-safe token bucket rate limiter that adapts to the server
+
+    Callers reserve a token and sleep until it's due, so concurrent threads
+    are spaced out evenly instead of all sleeping the same fixed amount.
+
+    The interval between requests follows AIMD: every healthy response adds
+    a fixed step to the request rate until it's back at min_interval, and a
+    429 or 5xx halves the rate. Pushback from requests that were already in
+    flight (within one interval of the last decrease) doesn't halve it
+    again. A Retry-After pauses the bucket entirely.
+
+    """
+    DECREASE = 0.5  # rate multiplier on a 429 / 5xx
+    RECOVERY_STEPS = 20  # healthy responses to climb from 0 to full speed
+    MIN_BACKOFF = 0.1  # seconds, where backing off from unlimited starts
+    MAX_INTERVAL = 120.0
+
+    def __init__(self, interval: float, burst=1, min_interval=None, log=print):
+        """
+        interval: Average seconds between requests to start with
+                  (0 disables limiting until the server objects)
+        burst: How many requests may go out back to back after being idle
+        min_interval: Shortest interval to speed up to while responses are
+                      healthy (default: interval, so it only ever slows down)
+        log: Called with each message for the user
+
+        """
+        self.log = log
+        self.interval = interval
+        self.min_interval = interval if min_interval is None else min(min_interval, interval)
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self.decreased = None  # monotonic() of the last throttle
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request is allowed to go out"""
+        if not self.interval and not self.paused_until:
+            return
+        with self.lock:
+            now = monotonic()
+            wait = max(self.paused_until - now, 0)
+            if self.interval:
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) / self.interval)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens * self.interval)
+        if wait:
+            sleep(wait)
+
+    def healthy(self):
+        """A response came back fine: step the rate up (additive increase)"""
+        if self.interval <= self.min_interval:
+            return
+        with self.lock:
+            step = 1 / max(self.min_interval, self.MIN_BACKOFF) / self.RECOVERY_STEPS
+            interval = 1 / (1 / self.interval + step)
+            if interval <= max(self.min_interval, self.MIN_BACKOFF):
+                interval = self.min_interval
+            self.interval = interval
+
+    def throttle(self, retry_after=None):
+        """The server pushed back: halve the rate (multiplicative decrease)
+
+        retry_after: Seconds to send nothing at all, from Retry-After
+
+        """
+        with self.lock:
+            now = monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if self.decreased is not None and now - self.decreased < self.interval:
+                return  # same burst as the last decrease
+            self.decreased = now
+            if self.interval:  # what's been refilled since, e.g. slept off
+                self.tokens += (now - self.updated) / self.interval
+            self.interval = min(max(self.interval, self.MIN_BACKOFF) / self.DECREASE,
+                                self.MAX_INTERVAL)
+            self.tokens = min(self.tokens, 0)  # no burst right after a 429
+            self.updated = now
+            interval = self.interval
+        stats.count('throttled')
+        self.log('\n[!] Slowing down to a request every {:.1f}s{}\n'.format(
+            interval, ', pausing {}s'.format(retry_after) if retry_after else ''))
+
+
+def retry_after(resp):
+    """Return a response's Retry-After in seconds, or None
+
+    The header is either a number of seconds or an HTTP date.
+
+    """
+    value = resp.headers.get('Retry-After', '').strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0) if when else None
+
+
+# Where a request goes: the session and proxy to send it with, the rate
+# limiter to wait on, and the pool's Proxy (or the single proxy dict)
+Route = namedtuple('Route', 'session proxies bucket proxy')
+
+
 class Retrieve:
     """Wrapper around a requests Session() so I can set default headers, proxy,
        etc for all requests.
@@ -28,19 +156,155 @@ class Retrieve:
     """
     USER_AGENT = ('Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:52.0) '
                   'Gecko/20100101 Firefox/52.0')
+    CHUNK_SIZE = 64 * 1024  # bytes held in memory per transfer
+    JSON_HOST = 'instagram.com'  # everything else is rate limited as media
+    MAX_FAILURES = 10  # failed requests for one URL before giving up (interactive=False)
 
-    def __init__(self, proxy: dict):
+    def __init__(self, proxy: dict, rate_limit=0, media_rate_limit=None,
+                 workers=1, cache=None, proxies=None, min_rate_limit=None,
+                 session=None, interactive=True, log=print):
         """
         proxy: Needs to be in requests format -- {'https': '192.168.0.1:8080'}
+        rate_limit: Seconds between instagram.com (JSON) requests
+        media_rate_limit: Seconds between CDN media requests
+                          Default: same as rate_limit
+        workers: Number of threads that will share this session
+        cache: Optional ResponseCache for JSON pages
+        proxies: Optional list of address:port proxies to rotate through
+                 instead of `proxy`, each with its own session and rate
+                 limits (see ProxyPool)
+        min_rate_limit: Shortest interval the adaptive rate limiters may
+                        speed up to (see TokenBucket)
+                        Default: only ever slow down from the limits above
+        session: Optional requests Session to send everything through
+                 (except with proxies, which get a session each)
+        interactive: Ask for a new proxy when a request fails. Otherwise
+                     a failure that isn't a 429 or 5xx raises FetchError,
+                     and so does a URL that fails MAX_FAILURES times.
+        log: Called with each message for the user
 
         """
-        self.session = requests.Session()
-        self.session.headers.update({
+        self.workers = workers
+        self.interactive = interactive
+        self.log = log
+        self.session = session if session is not None else self.new_session()
+        self.proxy = proxy if proxy else None
+        self.proxy_lock = threading.Lock()
+        self.cache = cache
+
+        if media_rate_limit is None:
+            media_rate_limit = rate_limit
+        self.rate_limit = rate_limit
+        self.media_rate_limit = media_rate_limit
+        self.min_rate_limit = min_rate_limit
+        self.json_bucket = self.new_bucket('json')
+        self.media_bucket = self.new_bucket('media')
+
+        self.proxy_pool = None
+        if proxies:
+            self.proxy_pool = ProxyPool(proxies, self.new_session, self.new_bucket,
+                                        log)
+
+    def new_session(self):
+        """Return a Session with our headers and a pool sized for the workers"""
+        session = requests.Session()
+        session.headers.update({
             'User-Agent': self.USER_AGENT,
             'Origin': 'https://www.instagram.com',
             'Referer': 'https://www.instagram.com/'
         })
-        self.proxy = proxy if proxy else None
+        # One pooled connection per worker, or urllib3 throws them away
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.workers, 10))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def new_bucket(self, kind):
+        """Return a TokenBucket for 'json' or 'media' requests"""
+        if kind == 'json':
+            return TokenBucket(self.rate_limit, min_interval=self.min_rate_limit,
+                               log=self.log)
+        return TokenBucket(self.media_rate_limit, burst=self.workers,
+                           min_interval=self.min_rate_limit, log=self.log)
+
+    def is_json(self, url):
+        """True for instagram.com (JSON) URLs, False for the CDN"""
+        host = urlparse(url).hostname or ''
+        return host == self.JSON_HOST or host.endswith('.' + self.JSON_HOST)
+
+    def bucket(self, url):
+        """Return the rate limiter for a URL (instagram.com or the CDN)"""
+        return self.json_bucket if self.is_json(url) else self.media_bucket
+
+    def route(self, url):
+        """Pick the session, proxy and rate limiter for the next request
+
+        Pair every route() with a succeeded() or failed() call.
+
+        """
+        if not self.proxy_pool:
+            return Route(self.session, self.proxy, self.bucket(url), self.proxy)
+        proxy = self.proxy_pool.acquire()
+        bucket = proxy.json_bucket if self.is_json(url) else proxy.media_bucket
+        return Route(proxy.session, proxy.proxies, bucket, proxy)
+
+    def succeeded(self, route, seconds):
+        """Record a request that got an answer"""
+        route.bucket.healthy()
+        if self.proxy_pool:
+            self.proxy_pool.succeeded(route.proxy, seconds)
+
+    def failed(self, route, resp=None, failures=1):
+        """Record a failed request (resp is None for connection errors)
+
+        A 429 or 5xx means we're going too fast: that endpoint's rate
+        limiter (the proxy's own, with proxies) backs off and the same
+        proxy is kept. Anything else means the proxy is the problem, and
+        it's replaced or cooled down.
+
+        failures: Failed requests for this URL so far, this one included
+
+        raises: FetchError if the proxy would have to be replaced and
+                there's no one to ask, or after MAX_FAILURES failures
+                (interactive=False)
+
+        """
+        stats.count('retries')
+        status = resp.status_code if resp is not None else None
+        wait = retry_after(resp) if resp is not None else None
+        overloaded = status is not None and (status == 429 or status >= 500)
+        if overloaded:
+            route.bucket.throttle(wait)
+
+        if self.proxy_pool:
+            self.proxy_pool.failed(route.proxy, overloaded)
+        elif not overloaded:
+            if not self.interactive:
+                raise FetchError('request failed with {}'.format(
+                    status or 'a connection error'))
+            self.switch_proxy(route.proxy)
+        if not self.interactive and failures >= self.MAX_FAILURES:
+            raise FetchError('gave up after {} failed requests, the last with {}'.format(
+                failures, status or 'a connection error'))
+
+    def cut_short(self, bucket, failures):
+        """Record a transfer that ended before the whole file arrived
+
+        The server answered but didn't send everything, which it does when
+        it's overloaded: as on a 429, that endpoint's rate limiter backs
+        off and the same proxy is kept.
+
+        bucket: TokenBucket the request went through
+        failures: Failed requests for this URL so far, this one included
+
+        raises: FetchError after MAX_FAILURES failures (interactive=False)
+
+        """
+        stats.count('retries')
+        bucket.throttle()
+        if not self.interactive and failures >= self.MAX_FAILURES:
+            raise FetchError('gave up after {} failed requests, the last cut '
+                             'short'.format(failures))
 
     def get(self, url, end_cursor=''):
         """GET either a JSON page or a media file
@@ -55,24 +319,159 @@ class Retrieve:
         if end_cursor:
             url += '?max_id={}'.format(end_cursor)
 
+        use_cache = self.cache and self.is_json(url)
+
+        entry = None
+        if use_cache:
+            entry = self.cache.lookup(url)
+            if entry and entry['fresh']:
+                return self.cache.hit(url, entry)
+        headers = self.cache.conditional_headers(entry) if entry else {}
+        answered = [200, 304, 404] if entry else [200, 404]
+
+        failures = 0
         while True:
+            route = self.route(url)
+            route.bucket.acquire()
+            started = perf_counter()
             try:
-                resp = self.session.get(url, timeout=7, proxies=self.proxy)
-                if resp.status_code not in [200, 404]:
-                    print('\n[!] {}\n\007'.format(resp.status_code))
-                    self.proxy = self.new_proxy()
-                else:
-                    break
+                with stats.timer('json_fetch'):
+                    resp = route.session.get(url, timeout=7, proxies=route.proxies,
+                                             headers=headers)
             except requests.exceptions.RequestException as error:  # Catch all
-                print('\n{}\007'.format(error))
-                self.proxy = self.new_proxy()
+                self.log('\n{}\007'.format(error))
+                failures += 1
+                self.failed(route, failures=failures)
+                continue
+
+            if resp.status_code not in answered:
+                self.log('\n[!] {}\n\007'.format(resp.status_code))
+                failures += 1
+                self.failed(route, resp, failures)
+                continue
+            self.succeeded(route, perf_counter() - started)
+            if resp.status_code == 304:
+                return self.cache.hit(url, entry, revalidated=True)
+            break
 
         if resp.status_code == 404:
-            print('\n[!] {} is 404\n'.format(url))
+            self.log('\n[!] {} is 404\n'.format(url))
             return False
 
+        if use_cache:
+            self.cache.store(url, resp)
         return resp
 
+    def download(self, url, filename, tagger=None):
+        """Stream a media file to disk in CHUNK_SIZE pieces
+
+        The file is written to "{filename}.part" and only renamed to filename
+        once Content-Length bytes have arrived, so an interrupted transfer
+        never looks finished. A leftover .part file is resumed with a Range
+        request. The server's bytes are hashed as they stream in, before
+        any tags are added, so the same media always has the same hash.
+
+        tagger: Optional metadata.VideoTagStream that tags an MP4 on its way
+                to disk
+
+        returns: False if the URL is 404'd, else the hash of the server's
+                 bytes (hex digest, see dedupe.new_hash()) once it's complete
+
+        """
+        part = filename + '.part'
+
+        failures = 0
+        while True:
+            route = self.route(url)
+            shift = tagger.resume(part) if tagger else 0
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            headers = {'Range': 'bytes={}-'.format(offset - shift)} if offset else {}
+            bucket = route.bucket
+            bucket.acquire()
+            started = perf_counter()
+            try:
+                with route.session.get(url, timeout=7, proxies=route.proxies,
+                                       headers=headers, stream=True) as resp:
+                    if resp.status_code not in [200, 206, 404, 416]:
+                        self.log('\n[!] {}\n\007'.format(resp.status_code))
+                        failures += 1
+                        self.failed(route, resp, failures)
+                        continue
+                    # Answered; the transfer itself is timed as media_transfer
+                    self.succeeded(route, perf_counter() - started)
+                    route = None
+
+                    if resp.status_code == 404:
+                        self.log('\n[!] {} is 404\n'.format(url))
+                        return False
+                    if resp.status_code == 416:
+                        # The .part doesn't fit the file anymore, start over
+                        os.remove(part)
+                        if tagger:
+                            tagger.reset()
+                        continue
+                    if resp.status_code == 200:
+                        offset = shift = 0  # Range was ignored, we get the whole file
+                        if tagger:
+                            tagger.reset()
+
+                    digest = new_hash()
+                    if offset and tagger:
+                        tagger.hash_part(digest)  # what earlier attempts got
+                    elif offset:
+                        hash_file(part, digest)
+
+                    expected = None
+                    length = resp.headers.get('Content-Length')
+                    if length and 'Content-Encoding' not in resp.headers:
+                        expected = offset - shift + int(length)
+
+                    with open(part, 'ab' if offset else 'wb') as file:
+                        for chunk in resp.iter_content(self.CHUNK_SIZE):
+                            digest.update(chunk)
+                            if tagger:
+                                chunk = tagger.feed(chunk)
+                            file.write(chunk)
+                        if tagger:
+                            file.write(tagger.finish())
+                        size = file.tell()
+                    stats.count('media_bytes', size - offset)
+            except requests.exceptions.RequestException as error:  # Catch all
+                self.log('\n{}\007'.format(error))
+                failures += 1
+                if route:
+                    self.failed(route, failures=failures)
+                else:  # dropped mid-transfer, the proxy did answer
+                    self.cut_short(bucket, failures)
+                continue
+            finally:
+                stats.observe('media_transfer', perf_counter() - started)
+
+            if tagger:
+                size -= tagger.shift  # in the server's bytes
+            if expected is not None and size != expected:
+                self.log('\n[!] {} is {} of {} bytes\n'.format(part, size, expected))
+                if size > expected:
+                    os.remove(part)
+                    if tagger:
+                        tagger.reset()
+                failures += 1
+                self.cut_short(bucket, failures)
+                continue  # resume from what we have
+
+            os.replace(part, filename)
+            if tagger:
+                tagger.close()
+            stats.count('media_files')
+            return digest.hexdigest()
+
+    def switch_proxy(self, failed_proxy):
+        """Replace a proxy that failed, unless another thread already has"""
+        with self.proxy_lock:
+            if self.proxy is failed_proxy:
+                self.proxy = self.new_proxy()
+                stats.count('proxy_switches')
+
     def new_proxy(self):
         """Enter a new proxy"""
         while True:
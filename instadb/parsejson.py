@@ -1,99 +1,107 @@
+from collections import namedtuple
 from datetime import datetime
+from time import perf_counter
+
+from stats import stats
+
+try:
+    import orjson  # optional, decodes pages several times faster
+except ImportError:
+    orjson = None
+
+# One post, parsed once from the page JSON
+#   id: Used by Instagram for pagination (see JsonPage.end_cursor)
+#   date: "2017:12:31 12:30:02"
+#   type: video, image or carousel
+#   code: Shortcode aka share link, https://www.instagram.com/p/{code}/
+#   likes: Number of likes
+#   location: Tagged location name or None
+#   caption: Caption text or None
+#   media: Tuple of media URLs (mp4 or jpg)
+Post = namedtuple('Post', 'id date type code likes location caption media')
+
+
+class BadJson(ValueError):
+    """A page that isn't JSON, with the raw response text as args[0]"""
 
 
 class JsonPage:
-    """This class holds and accesses the JSON for each page of posts.
+    """This class holds the posts for each page of JSON.
 
-    Each page contains a maximum of 20 posts.
+    Each page contains a maximum of 20 posts. The JSON is walked once, into
+    Post tuples; iterate over the page to get them. The per-field methods
+    (date(), code(), ...) are kept for older callers.
 
     """
 
     def __init__(self, resp):
+        started = perf_counter()
         try:
-            self.js = resp.json()
+            if orjson:
+                self.js = orjson.loads(resp.content)
+            else:
+                self.js = resp.json()
         except Exception:   # Don't know the specific error yet
-            with open('bad_json.txt', 'w') as file:
-                # Dump raw in case we got something besides JSON
-                file.write(resp.text)
-            raise SystemExit('\n[!] Bad JSON, check "bad_json.txt"\n')
-
-    def num_posts(self):
-        """Return how many posts are in the JSON (default 20)"""
-        return len(self.js['items'])
+            raise BadJson(resp.text) from None
 
-    def date(self, post_num):
-        """Return the post date in "2017:12:31 12:30:02" format"""
-        timestamp = int(self.js['items'][post_num]['created_time'])
-        time = datetime.fromtimestamp(timestamp)
-        date = time.strftime('%Y:%m:%d %H:%M:%S')
-        return date
+        self.posts = [self.parse_post(item) for item in self.js['items']]
+        stats.observe('json_parse', perf_counter() - started)
+        stats.count('json_pages')
+        stats.count('posts', len(self.posts))
 
-    def post_type(self, post_num):
-        """Return the post type (video, photo, or carousel)"""
-        return self.js['items'][post_num]['type']
-
-    def code(self, post_num):
-        """Return the post shortcode aka share link
+    def __iter__(self):
+        return iter(self.posts)
 
-        Example:
-        https://www.instagram.com/p/{shortcode}/ <--
+    def __len__(self):
+        return len(self.posts)
 
-        """
-        return self.js['items'][post_num]['code']
+    @classmethod
+    def parse_post(cls, item):
+        """Build a Post from one of the page's items"""
+        timestamp = int(item['created_time'])
+        date = datetime.fromtimestamp(timestamp).strftime('%Y:%m:%d %H:%M:%S')
 
-    def likes(self, post_num):
-        """Return the number of likes for a post"""
         try:
-            likes = self.js['items'][post_num]['likes']['count']
+            likes = item['likes']['count']
         except TypeError:
             likes = 0
-        return likes
 
-    def location(self, post_num):
-        """Return the post tagged location"""
         try:
-            location = self.js['items'][post_num]['location']['name']
+            location = item['location']['name']
         except TypeError:
             location = None
-        return location
 
-    def caption(self, post_num):
-        """Return the post caption"""
         try:
-            caption = self.js['items'][post_num]['caption']['text']
+            caption = item['caption']['text']
         except TypeError:
             caption = None
-        return caption
 
-    def media(self, post_num):
-        """Return the post media link(s) (mp4 or jpg) as a list"""
-        post_type = self.post_type(post_num)
+        post_type = item['type']
         if post_type == 'video':
-            media = self.js['items'][post_num]['videos']['standard_resolution']['url']
+            media = (item['videos']['standard_resolution']['url'],)
         elif post_type == 'carousel':
-            media = self.carousel_media(post_num)
+            media = cls.carousel_media(item['carousel_media'])
         else:
-            img_url = self.js['items'][post_num]['images']['standard_resolution']['url']
-            media = self.clean_img_url(img_url)
-        return media.split(',')
+            img_url = item['images']['standard_resolution']['url']
+            media = (cls.clean_img_url(img_url),)
+
+        return Post(item['id'], date, post_type, item['code'], likes,
+                    location, caption, media)
 
-    def carousel_media(self, post_num):
+    @classmethod
+    def carousel_media(cls, carousel):
         """Carousel media is its own nested list, so parse out the media
-        URLs and return them"""
+        URLs and return them as a tuple"""
         media_files = []
-        carousel = self.js['items'][post_num]['carousel_media']
-        slides = len(carousel)
 
-        for slide in range(slides):
-            media_type = carousel[slide]['type']
-            if media_type == 'image':
-                img_url = media = carousel[slide]['images']['standard_resolution']['url']
-                media = self.clean_img_url(img_url)
-            elif media_type == 'video':
-                media = carousel[slide]['videos']['standard_resolution']['url']
-            media_files.append(media)
+        for slide in carousel:
+            if slide['type'] == 'image':
+                img_url = slide['images']['standard_resolution']['url']
+                media_files.append(cls.clean_img_url(img_url))
+            elif slide['type'] == 'video':
+                media_files.append(slide['videos']['standard_resolution']['url'])
 
-        return (',').join(media_files)
+        return tuple(media_files)
 
     @staticmethod
     def clean_img_url(img_url):
@@ -112,6 +120,43 @@ class JsonPage:
         cleaned_url = img_url.replace('p640x640/', '').replace('s640x640/', '')
         return cleaned_url
 
+    def num_posts(self):
+        """Return how many posts are in the JSON (default 20)"""
+        return len(self.posts)
+
+    def date(self, post_num):
+        """Return the post date in "2017:12:31 12:30:02" format"""
+        return self.posts[post_num].date
+
+    def post_type(self, post_num):
+        """Return the post type (video, photo, or carousel)"""
+        return self.posts[post_num].type
+
+    def code(self, post_num):
+        """Return the post shortcode aka share link
+
+        Example:
+        https://www.instagram.com/p/{shortcode}/ <--
+
+        """
+        return self.posts[post_num].code
+
+    def likes(self, post_num):
+        """Return the number of likes for a post"""
+        return self.posts[post_num].likes
+
+    def location(self, post_num):
+        """Return the post tagged location"""
+        return self.posts[post_num].location
+
+    def caption(self, post_num):
+        """Return the post caption"""
+        return self.posts[post_num].caption
+
+    def media(self, post_num):
+        """Return the post media link(s) (mp4 or jpg) as a list"""
+        return list(self.posts[post_num].media)
+
     def more_available(self):
         """Determine if another page of posts is available. True or False"""
         return self.js['more_available']
@@ -126,7 +171,7 @@ class JsonPage:
         https://www.instagram.com/user/media/?max_id={end_cursor} <--
 
         """
-        return self.js['items'][post_num]['id']
+        return self.posts[post_num].id
 
     def private_user(self, post_counter):
         """Determine if the Instagram user has public posts available
@@ -135,5 +180,5 @@ class JsonPage:
         it must be a private user.
 
         """
-        if not self.js['items'] and post_counter == 0:
+        if not self.posts and post_counter == 0:
             return True
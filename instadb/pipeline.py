@@ -0,0 +1,227 @@
+import json
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from queue import Empty, Full, Queue
+
+from parsejson import JsonPage
+
+
+class PagePrefetcher:
+    """Fetch a user's JSON pages on a background thread
+
+    The next page's cursor is known as soon as a page is parsed, so the
+    fetcher keeps up to `depth` pages queued while the current one is being
+    processed. Requests still go through Retrieve, so the rate limit holds.
+
+    """
+
+    def __init__(self, retrieve, base_url, depth=1, end_cursor=''):
+        """
+        retrieve: Retrieve instance used for the requests
+        base_url: https://www.instagram.com/{user}/media/
+        depth: How many parsed pages may wait in the queue
+        end_cursor: Cursor of the first page to fetch ('' for the newest)
+
+        """
+        self.retrieve = retrieve
+        self.base_url = base_url
+        self.end_cursor = end_cursor
+        self.queue = Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Fetch pages until the last one, a failure, or stop()"""
+        end_cursor = self.end_cursor
+        try:
+            while not self.stopped.is_set():
+                resp = self.retrieve.get(self.base_url, end_cursor)
+                if not resp:
+                    self.put(False)
+                    return
+
+                page = JsonPage(resp)
+                self.put(page)
+
+                if not page.posts or not page.more_available():
+                    self.put(None)
+                    return
+                end_cursor = page.posts[-1].id
+        except BaseException as error:  # e.g. BadJson, FetchError
+            self.put(error)
+
+    def put(self, item):
+        """Queue an item, giving up if the consumer has stopped"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except Full:
+                continue
+
+    def next_page(self):
+        """Return the next JsonPage
+
+        returns: None after the last page, False if the fetch was 404'd
+
+        """
+        while True:
+            try:
+                item = self.queue.get(timeout=0.5)
+                break
+            except Empty:
+                if not self.thread.is_alive() and self.queue.empty():
+                    return None
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def stop(self):
+        """Stop fetching; pages already queued are dropped"""
+        self.stopped.set()
+
+
+# A downloaded file waiting for its metadata, arguments as in
+# metadata.process_video() / process_image()
+TagJob = namedtuple('TagJob', 'path user date caption tags code')
+
+
+class TaggingStage:
+    """Tag downloaded files in the background
+
+    metadata (and with it mutagen) is only imported once a file is
+    submitted, so runs that never tag anything don't load it.
+
+    Videos are tagged by mutagen on a thread or process pool (the ones that
+    couldn't be tagged while downloading, see VideoTagStream). Images go to
+    one thread that feeds the stage's own exiftool process and flushes
+    whenever it runs out of queued images, so they're still written in
+    batches.
+
+    """
+
+    def __init__(self, workers=1, processes=False, log=print):
+        """
+        workers: Size of the video tagging pool
+        processes: Use a process pool instead of threads for videos
+        log: Called with a message for each file that couldn't be tagged
+
+        """
+        self.log = log
+        if processes:
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.failures = []  # (path, reason)
+        self.lock = threading.Lock()
+        self.images = Queue()
+        self.exiftool = None  # started with the first image
+        self.image_thread = threading.Thread(target=self.tag_images, daemon=True)
+        self.image_thread.start()
+
+    def submit(self, job):
+        """Queue a TagJob"""
+        import metadata
+        if job.path.endswith('.mp4'):
+            future = self.pool.submit(metadata.process_video, job.path, job.user,
+                                      job.date, job.caption, job.tags, job.code)
+            future.add_done_callback(partial(self.video_done, job.path))
+        elif job.path.endswith('.jpg'):
+            self.images.put(job)
+
+    def video_done(self, path, future):
+        """Record a failed video"""
+        try:
+            if future.result() is False:
+                self.fail(path, 'not a readable MP4, it probably didn\'t '
+                                'download correctly')
+        except Exception as error:
+            self.fail(path, error)
+
+    def tag_images(self):
+        """Image thread: queue images on exiftool, flush when idle"""
+        while True:
+            job = self.images.get()
+            if job is None:
+                break
+            import metadata
+            if self.exiftool is None:
+                self.exiftool = metadata.ExifTool()
+            try:
+                metadata.process_image(job.path, job.user, job.date,
+                                       job.caption, job.tags, job.code,
+                                       self.exiftool)
+                if self.images.empty():
+                    self.flush_images()
+            except FileNotFoundError as error:  # the file is gone
+                self.fail(job.path, error)
+        if self.exiftool:
+            self.record(self.exiftool.close())
+
+    def flush_images(self):
+        """Write queued images and record the ones exiftool complained about"""
+        self.record(self.exiftool.flush())
+
+    def record(self, results):
+        """Record the files of exiftool (filename, output) results that failed"""
+        for path, output in results:
+            if output:
+                self.fail(path, output)
+
+    def fail(self, path, reason):
+        """Report a file that couldn't be tagged"""
+        self.log('\n[!] Tagging failed for {}: {}\n'.format(path, reason))
+        with self.lock:
+            self.failures.append((path, str(reason)))
+
+    def close(self):
+        """Wait for every queued file to be tagged
+
+        returns: List of (path, reason) failures
+
+        """
+        self.images.put(None)
+        self.image_thread.join()
+        self.pool.shutdown(wait=True)
+        return self.failures
+
+
+class PendingTags:
+    """Record tagging jobs to a file instead of running them (--tag-later)
+
+    Same interface as TaggingStage. The file is read back by read_pending().
+
+    """
+    FILENAME = 'pending_tags.jsonl'
+
+    def __init__(self, directory):
+        """
+        directory: Downloads folder the pending file is written to
+
+        """
+        self.path = os.path.join(directory, self.FILENAME)
+        self.file = open(self.path, 'a', encoding='UTF-8')
+        self.failures = []
+
+    def submit(self, job):
+        """Append a TagJob to the pending file"""
+        self.file.write(json.dumps(job._asdict()) + '\n')
+        self.file.flush()
+
+    def close(self):
+        """Close the pending file"""
+        self.file.close()
+        return self.failures
+
+
+def read_pending(directory):
+    """Return the TagJobs recorded by PendingTags in a downloads folder"""
+    path = os.path.join(directory, PendingTags.FILENAME)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='UTF-8') as file:
+        return [TagJob(**json.loads(line)) for line in file if line.strip()]
@@ -0,0 +1,125 @@
+import threading
+from time import monotonic, sleep
+
+from stats import stats
+
+
+class Proxy:
+    """One proxy of a ProxyPool, with its own session and health record"""
+
+    def __init__(self, address, session, json_bucket, media_bucket):
+        """
+        address: address:port
+        session: requests Session used only through this proxy, so every
+                 proxy keeps its own cookies
+        json_bucket, media_bucket: This proxy's TokenBuckets
+
+        """
+        self.address = address
+        self.proxies = {'https': address, 'http': address}  # requests format
+        self.session = session
+        self.json_bucket = json_bucket
+        self.media_bucket = media_bucket
+
+        self.successes = 0
+        self.failures = 0
+        self.strikes = 0  # failures in a row, sets the cooldown length
+        self.latency = None  # moving average, seconds
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+
+    def score(self):
+        """Higher is better: success rate over average latency
+
+        Success rate starts at 1/2 (one imaginary success and failure) so a
+        proxy that hasn't been tried yet still gets picked.
+
+        """
+        rate = (self.successes + 1) / (self.successes + self.failures + 2)
+        return rate / max(self.latency or 1.0, 0.01)
+
+
+class ProxyPool:
+    """Rotate requests across proxies by health, without asking anyone
+
+    Every request goes to the available proxy with the best score divided by
+    the requests it's already serving, so concurrent requests spread out
+    over the healthy proxies. A proxy that fails is cooled down for a while,
+    longer for each failure in a row. A 429 or 5xx isn't the proxy's fault:
+    it only slows down that proxy's rate limiter (for as long as
+    Retry-After says) and lowers its score. If every proxy is cooling down,
+    callers wait for the first one to come back.
+
+    """
+    ERROR_COOLDOWN = 5  # seconds, doubled per failure in a row
+    MAX_COOLDOWN = 900
+    LATENCY_WEIGHT = 0.2  # of each new sample in the moving average
+
+    def __init__(self, addresses, new_session, new_bucket, log=print):
+        """
+        addresses: List of proxies in address:port format
+        new_session: Callable returning a configured requests Session
+        new_bucket: Callable taking 'json' or 'media', returning a
+                    TokenBucket for one proxy
+        log: Called with each message for the user
+
+        """
+        self.log = log
+        self.proxies = [Proxy(address, new_session(), new_bucket('json'),
+                              new_bucket('media'))
+                        for address in addresses]
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Return the proxy the next request should use (blocks if none are up)
+
+        Pair every acquire() with a succeeded() or failed() call.
+
+        """
+        while True:
+            with self.lock:
+                now = monotonic()
+                available = [proxy for proxy in self.proxies
+                             if proxy.cooldown_until <= now]
+                if available:
+                    proxy = max(available,
+                                key=lambda proxy: proxy.score() / (1 + proxy.in_flight))
+                    proxy.in_flight += 1
+                    return proxy
+                wait = min(proxy.cooldown_until for proxy in self.proxies) - now
+            self.log('\n[!] Every proxy is cooling down, waiting {:.0f}s\n'.format(wait))
+            sleep(wait)
+
+    def succeeded(self, proxy, seconds):
+        """Record a request that got an answer (a 404 counts)"""
+        with self.lock:
+            proxy.in_flight -= 1
+            proxy.successes += 1
+            proxy.strikes = 0
+            if proxy.latency is None:
+                proxy.latency = seconds
+            else:
+                proxy.latency += self.LATENCY_WEIGHT * (seconds - proxy.latency)
+
+    def failed(self, proxy, overloaded=False):
+        """Record a failed request and cool the proxy down
+
+        overloaded: True for a 429 or 5xx. The proxy's rate limiter backs
+                    off from those (see Retrieve.failed()), so the proxy
+                    only loses score and stays in the rotation: cooling it
+                    down as well would stall a pool of one.
+
+        """
+        with self.lock:
+            proxy.in_flight -= 1
+            proxy.failures += 1
+            if overloaded:
+                return
+            proxy.strikes += 1
+            cooldown = min(self.ERROR_COOLDOWN * 2 ** (proxy.strikes - 1),
+                           self.MAX_COOLDOWN)
+            proxy.cooldown_until = monotonic() + cooldown
+            # Come back with a new identity, like a freshly entered proxy
+            proxy.session.cookies.clear()
+        stats.count('proxy_cooldowns')
+        self.log('\n[!] Proxy {} cooling down for {:.0f}s\n'.format(proxy.address, cooldown))
@@ -0,0 +1,235 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+
+class NullTimer:
+    """What Stats.timer() returns while stats are off, it does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    """Context manager that records its duration in a Stats histogram"""
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Histogram:
+    """Latency histogram with fixed, cumulative-on-report buckets (seconds)"""
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+               10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # last one is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """Return [(upper bound, observations <= bound)], ending with +Inf"""
+        running = 0
+        output = []
+        for bound, count in zip(self.BUCKETS + (float('inf'),), self.counts):
+            running += count
+            output.append((bound, running))
+        return output
+
+
+class Stats:
+    """Counters and latency histograms for every stage of a run
+
+    Off by default: timer() then hands back a shared no-op object and
+    count() returns straight away, so instrumented code pays next to
+    nothing. Stats recorded in --tag-processes worker processes are lost.
+
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.write_lock = threading.RLock()  # one writer of the report file
+        self.counters = Counter()
+        self.histograms = {}
+        self.started = time.time()
+
+    def enable(self):
+        """Start recording, from zero"""
+        with self.lock:
+            self.counters = Counter()
+            self.histograms = {}
+            self.started = time.time()
+            self.enabled = True
+
+    def count(self, name, value=1):
+        """Add value to a counter"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        """Record a duration in a histogram"""
+        if not self.enabled:
+            return
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    def timer(self, name):
+        """Time a `with` block into the `name` histogram"""
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def as_dict(self):
+        """Return everything recorded so far as plain data"""
+        with self.lock:
+            return {
+                'started': self.started,
+                'elapsed': time.time() - self.started,
+                'counters': dict(self.counters),
+                'histograms': {
+                    name: {'count': histogram.count,
+                           'sum': histogram.total,
+                           'buckets': [[str(bound), count] for bound, count
+                                       in histogram.cumulative()]}
+                    for name, histogram in self.histograms.items()},
+            }
+
+    def prometheus(self):
+        """Return everything recorded so far in Prometheus text format"""
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE instadb_{}_total counter'.format(name))
+                lines.append('instadb_{}_total {}'.format(name, value))
+            for name, histogram in sorted(self.histograms.items()):
+                metric = 'instadb_{}_seconds'.format(name)
+                lines.append('# TYPE {} histogram'.format(metric))
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(metric, le, count))
+                lines.append('{}_sum {}'.format(metric, histogram.total))
+                lines.append('{}_count {}'.format(metric, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the report to path, Prometheus format if it ends in .prom
+
+        The file is replaced atomically so scrapers never see half of it.
+
+        """
+        if path.endswith('.prom'):
+            output = self.prometheus()
+        else:
+            output = json.dumps(self.as_dict(), indent=2)
+        with self.write_lock:
+            with open(path + '.tmp', 'w') as file:
+                file.write(output)
+            os.replace(path + '.tmp', path)
+
+    def write_every(self, path, interval):
+        """Rewrite the report every `interval` seconds on a daemon thread
+
+        returns: An Event; set it before the final write() so the thread
+                 can't overwrite the final report afterwards
+
+        """
+        def run():
+            while not stopped.wait(interval):
+                with self.write_lock:
+                    if stopped.is_set():
+                        return
+                    self.write(path)
+
+        stopped = threading.Event()
+        threading.Thread(target=run, daemon=True).start()
+        return stopped
+
+
+stats = Stats()
+
+# Functions whose cumulative time is reported per stage by profile()
+PROFILE_STAGES = [
+    ('json fetch', 'network.py', 'get'),
+    ('media transfer', 'network.py', 'download'),
+    ('json parse', 'parsejson.py', '__init__'),
+    ('db upsert', 'database.py', 'upsert'),
+    ('db commit', 'database.py', 'flush'),
+    ('tag video', 'metadata.py', 'process_video'),
+    ('tag images', 'metadata.py', 'flush'),
+]
+
+
+def profile(func, path, *args, **kwargs):
+    """Run func under cProfile, in every thread it starts too
+
+    The merged stats are dumped to path (open with pstats) and the
+    cumulative time of each stage in PROFILE_STAGES is printed.
+
+    returns: Whatever func returns
+
+    """
+    profiles = []
+    lock = threading.Lock()
+
+    def start_thread_profile(*_):
+        # First event in a new thread: swap this hook for a real profiler
+        thread_profile = cProfile.Profile()
+        with lock:
+            profiles.append(thread_profile)
+        thread_profile.enable()
+
+    main_profile = cProfile.Profile()
+    threading.setprofile(start_thread_profile)
+    main_profile.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        main_profile.disable()
+        threading.setprofile(None)
+
+        merged = pstats.Stats(main_profile)
+        for thread_profile in profiles:
+            try:
+                merged.add(thread_profile)
+            except TypeError:  # thread never recorded anything
+                continue
+        merged.dump_stats(path)
+
+        print('\nCumulative seconds per stage (all threads):')
+        for stage, filename, function in PROFILE_STAGES:
+            seconds = sum(
+                entry[3] for (file, _, name), entry in merged.stats.items()
+                if name == function and os.path.basename(file) == filename)
+            print('  {:<16} {:.3f}'.format(stage, seconds))
+        print('Full profile written to {}\n'.format(path))
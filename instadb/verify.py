@@ -0,0 +1,243 @@
+import json
+import mmap
+import os
+import sqlite3
+import struct
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from database import Database
+from dedupe import HASH_CHUNK_SIZE, new_hash
+from export import find_databases
+from manifest import mp4_atoms
+from pipeline import PendingTags, read_pending
+
+# What a broken file needs, by problem
+ACTIONS = {'missing': 'refetch',  # in the database, never downloaded
+           'unfinished': 'refetch',  # leftover .part
+           'empty': 'refetch',
+           'truncated': 'refetch',  # fails the JPEG / MP4 structure check
+           'changed': 'refetch',  # contents differ from the last verify
+           'untagged': 'retag'}  # title or date don't match the posts row
+
+
+def hash_view(view):
+    """Return the hex digest of a memoryview, in HASH_CHUNK_SIZE pieces"""
+    digest = new_hash()
+    for start in range(0, len(view), HASH_CHUNK_SIZE):
+        digest.update(view[start:start + HASH_CHUNK_SIZE])
+    return digest.hexdigest()
+
+
+def jpeg_segments(data):
+    """Return the payloads of a JPEG's segments before the image data, or None
+
+    None means the markers don't add up, or the file doesn't end with an
+    end of image marker, i.e. it's truncated or not a JPEG.
+
+    """
+    if data[:2] != b'\xff\xd8' or data[-2:] != b'\xff\xd9':
+        return None
+    segments = []
+    position = 2
+    while position + 4 <= len(data):
+        marker, length = struct.unpack('>2sH', data[position:position + 4])
+        if marker[0] != 0xff or length < 2:
+            return None
+        if marker == b'\xff\xda':  # start of scan, the image data follows
+            return segments
+        segments.append(data[position + 4:position + 2 + length])
+        position += 2 + length
+    return None
+
+
+def video_tags_match(path, title, date):
+    """True if a video's title and date tags are the expected ones"""
+    from metadata import MP4, correct_date_format
+    try:
+        tags = MP4(path).tags or {}
+    except Exception:
+        return False
+    if tags.get('\xa9nam') != [title]:
+        return False
+    return not correct_date_format(date) or tags.get('purd') == [date]
+
+
+def check_file(item):
+    """Check one media file (runs on a worker process)
+
+    item: (path, title, date, check_tags, baseline), baseline being the
+          (size, mtime_ns, ctime_ns, hash) recorded by the last verify, or
+          None
+
+    returns: (path, problem or None, (size, mtime_ns, ctime_ns, hash) or
+             None)
+
+    """
+    from metadata import correct_date_format  # loads mutagen
+    path, title, date, check_tags, baseline = item
+    if os.path.exists(path + '.part'):
+        return path, 'unfinished', None
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return path, 'missing', None
+    if not stat.st_size:
+        return path, 'empty', None
+
+    with open(path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            digest = hash_view(view)
+            record = (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, digest)
+            if baseline and baseline[:3] == record[:3] and baseline[3] != digest:
+                return path, 'changed', record  # never written since, new bytes
+
+            if path.endswith('.jpg'):
+                segments = jpeg_segments(data)
+                if segments is None:
+                    return path, 'truncated', record
+                if check_tags:
+                    header = b''.join(segments)
+                    if title.encode('UTF-8') not in header or (
+                            correct_date_format(date)
+                            and date.encode('UTF-8') not in header):
+                        return path, 'untagged', record
+            else:
+                names = [name for name, _, _ in mp4_atoms(data) or []]
+                if b'moov' not in names or b'mdat' not in names:
+                    return path, 'truncated', record
+                if check_tags and not video_tags_match(path, title, date):
+                    return path, 'untagged', record
+        finally:
+            view.release()
+    return path, None, record
+
+
+class Checksums:
+    """Size, modification and change times and hash of every file a
+    verify has seen
+
+    A file whose size and times haven't changed since the last verify must
+    still have the same hash; if it doesn't, the disk changed it. The
+    change time (ctime) is in there because the modification time isn't
+    enough: image tagging sets it to the post's date, so a retagged photo
+    with tags of the same length keeps its size and mtime. Any write moves
+    ctime on, and nothing can set it back, so files rewritten on purpose
+    just get a new record.
+
+    """
+    FILENAME = 'checksums.db'
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS checksums('
+                          'path TEXT PRIMARY KEY,'
+                          'size INT,'
+                          'mtime_ns INT,'
+                          'hash TEXT,'
+                          'ctime_ns INT)')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(checksums)')]
+        if 'ctime_ns' not in columns:
+            # Older records have no ctime, so they're only recorded again
+            self.conn.execute('ALTER TABLE checksums ADD COLUMN ctime_ns INT')
+
+    def get(self, path):
+        return self.conn.execute('SELECT size, mtime_ns, ctime_ns, hash '
+                                 'FROM checksums WHERE path=?', (path,)).fetchone()
+
+    def set(self, path, record):
+        self.conn.execute('INSERT OR REPLACE INTO checksums'
+                          '(path, size, mtime_ns, ctime_ns, hash) '
+                          'VALUES(?, ?, ?, ?, ?)', (path,) + tuple(record))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def media_rows(user, path):
+    """Yield (code, date, caption, url, filename) for a user database's media
+
+    Databases older than the current schema are migrated first.
+
+    """
+    conn = sqlite3.connect(path)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.close()
+    if version < Database.SCHEMA_VERSION:
+        Database(user, os.path.dirname(path)).close()
+
+    conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        yield from conn.execute('SELECT posts.code, date, caption, url, filename '
+                                'FROM media JOIN posts ON posts.code = media.code '
+                                'ORDER BY posts.code, position')
+    finally:
+        conn.close()
+
+
+def verify_archive(root, repair_list, workers=None, include_missing=False,
+                   check_tags=True):
+    """Check every media file the user databases under root list
+
+    Files are checked on a process pool, each read once through mmap: it's
+    hashed, its JPEG markers or MP4 atoms must add up to its size, and its
+    title and date tags must match the posts row. Files still waiting in a
+    pending_tags.jsonl (--tag-later) aren't expected to have tags yet.
+
+    Every broken file goes on the repair list, one JSON object per line
+    with the post fields needed to download or tag it again (see
+    instadb.py --repair).
+
+    root: Archive folder, e.g. ~/Downloads/instadb
+    repair_list: File the repair list is written to
+    workers: Worker processes (default: one per CPU)
+    include_missing: Also list files that were never downloaded, e.g.
+                     skipped by --photos, --likes or --only-db
+    check_tags: Check titles and dates
+
+    returns: Counter of files by problem ('ok' for the good ones)
+
+    raises: ImportError if mutagen isn't installed
+
+    """
+    import metadata  # noqa: F401, fail before starting the workers
+    checksums = Checksums(os.path.join(root, Checksums.FILENAME))
+    items, posts = [], {}
+    for user, db_path in find_databases([root]):
+        directory = os.path.dirname(db_path)
+        pending = set()
+        if os.path.exists(os.path.join(directory, PendingTags.FILENAME)):
+            pending = set(os.path.abspath(job.path) for job in read_pending(directory))
+        for code, date, caption, url, filename in media_rows(user, db_path):
+            path = os.path.abspath(os.path.join(directory, filename))
+            title = '{} - {}'.format(user, code)
+            posts[path] = (user, code, date, caption, url)
+            items.append((path, title, date, check_tags and path not in pending,
+                          checksums.get(path)))
+
+    found = Counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+            open(repair_list, 'w', encoding='UTF-8') as file:
+        for path, problem, record in pool.map(check_file, items, chunksize=32):
+            if record:
+                checksums.set(path, record)
+            found[problem or 'ok'] += 1
+            if not problem or (problem == 'missing' and not include_missing):
+                continue
+            user, code, date, caption, url = posts[path]
+            print('{}: {}'.format(problem, path))
+            file.write(json.dumps({'action': ACTIONS[problem], 'problem': problem,
+                                   'path': path, 'url': url, 'user': user,
+                                   'code': code, 'date': date,
+                                   'caption': caption}) + '\n')
+    checksums.close()
+    return found
+
+
+def read_repair_list(path):
+    """Return the entries of a repair list written by verify_archive()"""
+    with open(path, encoding='UTF-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
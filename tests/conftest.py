@@ -0,0 +1,92 @@
+import io
+import os
+import sys
+from collections import Counter
+from contextlib import redirect_stdout
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'instadb'), os.path.join(ROOT, 'bench')]
+
+import api  # noqa: E402
+import instadb  # noqa: E402
+from fake_instagram import FakeInstagram, serve  # noqa: E402
+from network import Retrieve  # noqa: E402
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    """A fake Instagram server that instadb and api syncs talk to
+
+    Its settings (posts, ...) can be changed between syncs.
+
+    """
+    fake = FakeInstagram(posts=50, jpeg_kb=1, mp4_kb=1)
+    server = serve(fake)
+    base_url = 'http://127.0.0.1:{}/{{}}/media/'.format(fake.port)
+    monkeypatch.setattr(instadb, 'BASE_URL', base_url)
+    monkeypatch.setattr(api, 'BASE_URL', base_url)
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+EXIFTOOL_STUB = """#!{python}
+import sys
+args = []
+for line in sys.stdin:
+    line = line.rstrip('\\n')
+    if line == '-execute':
+        if 'crash' in args[-3]:  # the file, see ExifTool.send()
+            break
+        if 'bad' in args[-3]:
+            print('Error: cannot write ' + args[-3])
+        print('{{ready}}')
+        sys.stdout.flush()
+        args = []
+    elif line == 'False' and args[-1:] == ['-stay_open']:
+        break
+    else:
+        args.append(line)
+"""
+
+
+@pytest.fixture
+def exiftool(tmp_path_factory, monkeypatch):
+    """A stand-in exiftool on PATH that fails files with "bad" in the name
+    and exits on files with "crash" in it"""
+    folder = tmp_path_factory.mktemp('bin')
+    path = folder / 'exiftool'
+    path.write_text(EXIFTOOL_STUB.format(python=sys.executable))
+    path.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(folder, os.pathsep,
+                                               os.environ['PATH']))
+    return str(path)
+
+
+def sync(user, directory, pages=None, catalog=None, **options):
+    """Run instadb.sync_user() to the end, writing only the database
+
+    pages: Stop after this many pages, like an interrupted run
+    catalog: Catalog to write to instead of {user}.db
+    options: Options fields to change, e.g. resume=True
+
+    returns: The user's summary Counter
+
+    """
+    settings = dict(tags=None, min_likes_required=0, only_photos=False,
+                    only_videos=False, only_new_files=False, write_db=False,
+                    only_db=True, db_synchronous='NORMAL', prefetch=1,
+                    tag_later=False, resume=False, snapshot=False)
+    settings.update(options)
+    retrieve = Retrieve(None, interactive=False)
+    summary = Counter()
+    run = instadb.sync_user(user, retrieve, None, None, str(directory),
+                            instadb.Options(**settings), summary, catalog=catalog)
+    with redirect_stdout(io.StringIO()):
+        for page, _ in enumerate(run, 1):
+            if page == pages:
+                run.close()
+                break
+    return summary
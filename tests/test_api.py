@@ -0,0 +1,35 @@
+import pytest
+
+import api
+from network import FetchError, Retrieve
+from pipeline import TaggingStage
+
+
+def test_sync_user_reports_instead_of_printing(fake, tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv('PATH', str(tmp_path))  # no exiftool
+    fake.posts = 8
+    messages = []
+    tagger = TaggingStage(log=messages.append)
+
+    results = list(api.sync_user('alice', api.retriever(), str(tmp_path),
+                                 tagger=tagger))
+    failures = tagger.close()
+
+    assert [result.post.code for result in results] == [
+        'BA{:09d}'.format(num) for num in range(8)]
+    statuses = [file.status for result in results for file in result.files]
+    assert statuses == ['downloaded'] * 12
+    # Without exiftool every image fails, but nothing exits or prints
+    images = [file.path for result in results for file in result.files
+              if file.filename.endswith('.jpg')]
+    assert sorted(path for path, _ in failures) == sorted(images)
+    assert 'Can\'t find exiftool' in failures[0][1]
+    assert len(messages) == len(images)
+    assert capsys.readouterr().out == ''
+
+
+def test_overloaded_url_gives_up(fake, monkeypatch):
+    monkeypatch.setattr(Retrieve, 'MAX_FAILURES', 3)
+    fake.error_rate = 1.0  # every request is a 503
+    with pytest.raises(FetchError, match='gave up after 3 failed requests'):
+        next(api.iter_posts('alice', api.retriever()))
@@ -0,0 +1,33 @@
+import sqlite3
+
+import instadb
+from cache import ResponseCache
+from network import Retrieve
+
+
+def test_snapshot_revalidates_cached_pages(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr(Retrieve, 'JSON_HOST', '127.0.0.1')  # pages get cached
+    fake.posts = 60
+    cache = ResponseCache(str(tmp_path / 'cache.db'))
+
+    def run():
+        instadb.main(['alice'], None, 0, str(tmp_path), None, 0, only_db=True,
+                     http_cache=cache, snapshot=True)
+
+    run()
+    item = fake.item
+
+    def liked_again(user, num):
+        post = item(user, num)
+        post['likes']['count'] += 1
+        return post
+
+    fake.item = liked_again
+    run()
+
+    conn = sqlite3.connect(str(tmp_path / 'alice.db'))
+    likes = dict(conn.execute('SELECT code, likes FROM posts'))
+    assert likes == {'BA{:09d}'.format(num): (num * 37) % 5000 + 1
+                     for num in range(60)}
+    conn.close()
+    cache.close()
@@ -0,0 +1,56 @@
+import os
+
+from conftest import sync
+
+from catalog import Catalog
+
+
+def posts(catalog):
+    return dict(((user, code), likes) for user, code, likes in catalog.cur.execute(
+        'SELECT user, code, likes FROM posts'))
+
+
+def test_sync_writes_to_catalog(fake, tmp_path):
+    catalog = Catalog(str(tmp_path / Catalog.FILENAME))
+    fake.posts = 30
+    sync('alice', tmp_path, catalog=catalog, snapshot=True)
+    sync('bob', tmp_path, catalog=catalog)
+    assert not os.path.exists(str(tmp_path / 'alice.db'))
+
+    stored = posts(catalog)
+    assert len(stored) == 60
+    assert stored['bob', 'BB000000001'] == 37
+    assert catalog.cur.execute('SELECT filename FROM media WHERE user=? AND code=? '
+                               'ORDER BY position', ('bob', 'BB000000002')).fetchall() == [
+        ('bob - BB000000002 ({}).{}'.format(num, ext),)
+        for num, ext in [(1, 'jpg'), (2, 'mp4'), (3, 'jpg')]]
+    assert catalog.cur.execute('SELECT COUNT(*) FROM likes_history '
+                               'WHERE user=?', ('alice',)).fetchone()[0] == 30
+
+    # --new stops after the page of the first post the catalog already has
+    assert sync('alice', tmp_path, catalog=catalog, only_new_files=True)['posts'] == 20
+    catalog.close()
+
+
+def test_import_keeps_latest_likes(fake, tmp_path):
+    sync('alice', tmp_path)
+    catalog = Catalog(str(tmp_path / Catalog.FILENAME))
+    assert catalog.import_database('alice', str(tmp_path / 'alice.db')) == 50
+    assert catalog.cur.execute('SELECT COUNT(*) FROM media').fetchone()[0] == 74
+
+    # The user database is synced again after the import
+    item = fake.item
+
+    def liked_again(user, num):
+        post = item(user, num)
+        post['likes']['count'] += num == 4
+        return post
+
+    fake.item = liked_again
+    sync('alice', tmp_path)
+    assert catalog.import_database('alice', str(tmp_path / 'alice.db')) == 50
+    stored = posts(catalog)
+    assert len(stored) == 50
+    assert stored['alice', 'BA000000004'] == 4 * 37 + 1
+    assert catalog.cur.execute('SELECT COUNT(*) FROM media').fetchone()[0] == 74
+    catalog.close()
@@ -0,0 +1,72 @@
+from conftest import sync
+
+from checkpoint import Checkpoint
+
+
+def checkpoint(directory):
+    state = Checkpoint('alice', str(directory))
+    return state.top, state.cursor, state.post_counter, state.complete
+
+
+def test_interrupted_sync_is_checkpointed(fake, tmp_path):
+    fake.posts = 100
+    sync('alice', tmp_path, pages=2)
+    assert checkpoint(tmp_path) == ('100', '61', 40, False)
+
+
+def test_resume_jumps_to_the_checkpoint(fake, tmp_path):
+    fake.posts = 100
+    sync('alice', tmp_path, pages=2)
+    fake.posts = 110  # 10 new posts on top
+
+    summary = sync('alice', tmp_path, resume=True)
+
+    # The first page joins up with the checkpoint, then 60 older posts
+    assert summary['posts'] == 80
+    assert checkpoint(tmp_path) == ('110', '1', 110, True)
+
+
+def test_resume_after_a_complete_sync_stops_at_the_join(fake, tmp_path):
+    fake.posts = 100
+    sync('alice', tmp_path)
+    assert checkpoint(tmp_path) == ('100', '1', 100, True)
+
+    assert sync('alice', tmp_path, resume=True)['posts'] == 20
+    assert checkpoint(tmp_path)[3]
+
+
+def test_new_run_keeps_a_complete_checkpoint(fake, tmp_path):
+    fake.posts = 100
+    sync('alice', tmp_path)
+
+    summary = sync('alice', tmp_path, only_new_files=True)
+    assert summary['posts'] == 20
+    assert checkpoint(tmp_path) == ('100', '1', 100, True)
+
+    assert sync('alice', tmp_path, resume=True)['posts'] == 20
+
+
+def test_short_run_keeps_a_longer_checkpoint(fake, tmp_path):
+    fake.posts = 100
+    sync('alice', tmp_path, pages=3)
+    fake.posts = 130  # the first page is all new posts
+
+    # Stops before joining up: nothing to save
+    sync('alice', tmp_path, pages=1)
+    assert checkpoint(tmp_path) == ('100', '41', 60, False)
+
+    # Joins up, then walks on: the checkpoint keeps its cursor until this
+    # run gets past it
+    sync('alice', tmp_path, pages=4)
+    assert checkpoint(tmp_path) == ('130', '41', 90, False)
+    sync('alice', tmp_path, pages=5)
+    assert checkpoint(tmp_path) == ('130', '31', 100, False)
+
+
+def test_full_run_completes_the_checkpoint(fake, tmp_path):
+    fake.posts = 100
+    sync('alice', tmp_path, pages=2)
+    fake.posts = 110
+
+    sync('alice', tmp_path)
+    assert checkpoint(tmp_path) == ('110', '1', 110, True)
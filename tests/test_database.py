@@ -0,0 +1,94 @@
+import sqlite3
+
+import pytest
+from conftest import sync
+
+from database import Database
+
+DATE = '2017:01:01 00:00:00'
+
+
+def test_upsert_inserts_then_updates_likes(tmp_path):
+    db = Database('alice', str(tmp_path))
+    assert db.upsert(DATE, 'carousel', 'B1', 10, 'Here', 'one',
+                     ['http://cdn/a.jpg', 'http://cdn/b.mp4']) == 'new'
+    assert db.upsert(DATE, 'carousel', 'B1', 10, 'Here', 'one', []) == 'unchanged'
+    assert db.upsert(DATE, 'carousel', 'B1', 12, 'Here', 'one', []) == 'changed'
+    db.close()
+
+    db = Database('alice', str(tmp_path))  # known posts are loaded again
+    assert db.existing_entry('B1')
+    assert db.upsert(DATE, 'carousel', 'B1', 12, 'Here', 'one', []) == 'unchanged'
+    assert db.cur.execute('SELECT code, likes FROM posts').fetchall() == [('B1', 12)]
+    assert db.media('B1') == [
+        (1, 'image', 'http://cdn/a.jpg', 'alice - B1 (1).jpg'),
+        (2, 'video', 'http://cdn/b.mp4', 'alice - B1 (2).mp4')]
+    db.close()
+
+
+def test_rows_commit_per_batch(tmp_path):
+    db = Database('alice', str(tmp_path), batch_size=3)
+    reader = sqlite3.connect(str(tmp_path / 'alice.db'))
+
+    def committed():
+        return reader.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+
+    for num in range(5):
+        db.upsert(DATE, 'image', 'B{}'.format(num), num, None, None, ['a.jpg'])
+    assert committed() == 3
+    db.flush()
+    assert committed() == 5
+    reader.close()
+    db.close()
+
+
+def test_migrates_original_schema(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'alice.db'))
+    conn.execute('CREATE TABLE posts(date TEXT, type TEXT, code TEXT, likes INT, '
+                 'location TEXT, caption TEXT, media TEXT)')
+    conn.executemany('INSERT INTO posts VALUES(?, ?, ?, ?, ?, ?, ?)', [
+        (DATE, 'image', 'B1', 1, 'Old town', 'first try', 'http://cdn/1.jpg'),
+        (DATE, 'image', 'B1', 5, 'Old town', 'first try', 'http://cdn/1.jpg'),
+        (DATE, 'carousel', 'B2', 7, None, 'touchdown',
+         'http://cdn/2.jpg,http://cdn/3.mp4')])
+    conn.commit()
+    conn.close()
+
+    db = Database('alice', str(tmp_path))
+    assert db.cur.execute('PRAGMA user_version').fetchone()[0] == Database.SCHEMA_VERSION
+    # The newest of the duplicate rows is kept
+    assert db.cur.execute('SELECT code, likes, updated FROM posts '
+                          'ORDER BY code').fetchall() == [('B1', 5, 0), ('B2', 7, 0)]
+    assert db.media('B2') == [
+        (1, 'image', 'http://cdn/2.jpg', 'alice - B2 (1).jpg'),
+        (2, 'video', 'http://cdn/3.mp4', 'alice - B2 (2).mp4')]
+    assert [row[0] for row in db.search('touchdown')] == ['B2']
+    assert db.upsert(DATE, 'image', 'B1', 5, 'Old town', 'first try', []) == 'unchanged'
+    db.close()
+
+
+def test_search_by_text_likes_and_date(fake, tmp_path):
+    sync('alice', tmp_path)
+    db = Database('alice', str(tmp_path))
+    rows = db.cur.execute('SELECT code, date, likes, location FROM posts').fetchall()
+
+    def by(key, rows=rows):
+        return [row[0] for row in sorted(rows, key=key, reverse=True)]
+
+    located = [row for row in rows if row[3]]
+    assert [post[0] for post in db.search('"post 7"')] == ['BA000000007']
+    assert [post[0] for post in db.search('somewhere', order='date')] == by(
+        lambda row: row[1], located)
+    assert [post[3] for post in db.search(min_likes=1000, max_likes=1500)] == sorted(
+        (row[2] for row in rows if 1000 <= row[2] <= 1500), reverse=True)
+    # until is inclusive of the whole day
+    assert sorted(post[0] for post in db.search(since='2017-01-02', until='2017-01-02')) == \
+        sorted(row[0] for row in rows if row[1].startswith('2017:01:02'))
+    assert [post[0] for post in db.search(limit=3)] == by(lambda row: row[2])[:3]
+
+    db.fts = False  # SQLite without FTS5 scans instead
+    assert len(db.search('somewhere')) == len(located)
+    db.fts = True
+    with pytest.raises(sqlite3.OperationalError):
+        db.search('"unclosed')
+    db.close()
@@ -0,0 +1,80 @@
+import hashlib
+import os
+import shutil
+
+import pytest
+
+import dedupe
+from dedupe import ContentIndex, dedupe_archive, video_payload
+from fake_instagram import fake_mp4
+from metadata import MP4, VideoTagStream, process_video
+from network import Retrieve
+from pipeline import TagJob
+
+
+@pytest.fixture
+def copy_reflinks(monkeypatch):
+    """Reflinks as plain copies, for filesystems without them"""
+    monkeypatch.setattr(dedupe, 'reflink', shutil.copyfile)
+
+
+def video(path, user, caption):
+    """Write the fake MP4 to path, tagged for one of user's posts"""
+    with open(path, 'wb') as file:
+        file.write(fake_mp4(20 * 1024))
+    process_video(path, user, '2017:01:01 00:00:00', caption, [user], 'B0')
+    return TagJob(path, user, '2017:01:01 00:00:00', caption, [user], 'B0')
+
+
+def title(path):
+    return MP4(path).tags['\xa9nam']
+
+
+def test_download_hashes_server_bytes(fake, tmp_path):
+    url = 'http://localhost:{}/cdn/alice_1/vid.mp4'.format(fake.port)
+    expected = hashlib.sha256(fake.mp4).hexdigest()
+    retrieve = Retrieve(None, interactive=False)
+
+    path = str(tmp_path / 'full.mp4')
+    assert retrieve.download(url, path, VideoTagStream('alice', code='B0')) == expected
+    assert title(path) == ['alice - B0']
+
+    # Interrupted after the tagged head was written
+    path = str(tmp_path / 'resumed.mp4')
+    tagger = VideoTagStream('bob', code='B0')
+    tagger.resume(path + '.part')
+    with open(path + '.part', 'wb') as file:
+        file.write(tagger.feed(fake.mp4[:len(fake.mp4) // 2]))
+    assert retrieve.download(url, path, VideoTagStream('bob', code='B0')) == expected
+    assert title(path) == ['bob - B0']
+    assert not os.path.exists(path + '.part.head')
+
+
+def test_link_duplicate(tmp_path, copy_reflinks):
+    index = ContentIndex(str(tmp_path / 'content.db'))
+    first = video(str(tmp_path / 'a.mp4'), 'alice', 'caption')
+    same = video(str(tmp_path / 'b.mp4'), 'alice', 'caption')
+    repost = video(str(tmp_path / 'c.mp4'), 'bob', 'other caption')
+
+    assert index.link_duplicate('digest', first) is None
+    assert index.link_duplicate('digest', same) == 'linked'
+    assert os.path.samefile(first.path, same.path)
+    assert index.link_duplicate('digest', repost) == 'cloned'
+    assert title(repost.path) == ['bob - B0']
+    assert video_payload(repost.path) == video_payload(first.path)
+    index.close()
+
+
+def test_dedupe_archive_clones_retagged_videos(tmp_path, copy_reflinks):
+    (tmp_path / 'alice').mkdir()
+    (tmp_path / 'bob').mkdir()
+    video(str(tmp_path / 'alice' / 'alice - B0.mp4'), 'alice', 'caption')
+    video(str(tmp_path / 'alice' / 'alice - B1.mp4'), 'alice', 'caption')
+    repost = video(str(tmp_path / 'bob' / 'bob - B0.mp4'), 'bob', 'other caption')
+
+    scanned, linked, cloned, saved = dedupe_archive(str(tmp_path))
+
+    # alice's two files have the same tags too, so they're hardlinked
+    assert (scanned, linked, cloned) == (3, 1, 1)
+    assert saved > 0
+    assert title(repost.path) == ['bob - B0']
@@ -0,0 +1,83 @@
+import csv
+import json
+import time
+
+import pytest
+from conftest import sync
+
+from catalog import Catalog
+from database import Database
+from export import export, find_databases
+
+
+def exported(db_path, output, watermark):
+    export([('alice', str(db_path))], str(output), watermark=str(watermark))
+    with open(str(output), encoding='UTF-8') as file:
+        return [json.loads(line)['code'] for line in file]
+
+
+def test_watermark_keeps_rows_committed_later(tmp_path, monkeypatch):
+    clock = [1000]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    db = Database('alice', str(tmp_path))
+    db.upsert('2017:01:01 00:00:00', 'image', 'B', 1, None, 'b', ['b.jpg'])
+    db.flush()
+    # A's page is still downloading when the export runs
+    db.upsert('2017:01:01 00:00:00', 'image', 'A', 1, None, 'a', ['a.jpg'])
+
+    clock[0] = 1005
+    output, watermark = tmp_path / 'posts.jsonl', tmp_path / 'watermark.json'
+    assert exported(tmp_path / 'alice.db', output, watermark) == ['B']
+    db.flush()
+    assert exported(tmp_path / 'alice.db', output, watermark) == ['A']
+
+    # Committed in the same second as the export's last post, smaller code
+    db.upsert('2017:01:01 00:00:00', 'image', '0', 1, None, 'c', ['c.jpg'])
+    db.flush()
+    assert exported(tmp_path / 'alice.db', output, watermark) == ['0']
+    assert exported(tmp_path / 'alice.db', output, watermark) == []
+    db.close()
+
+
+def test_incremental_export(fake, tmp_path):
+    sync('alice', tmp_path)
+    Catalog(str(tmp_path / Catalog.FILENAME)).close()  # not a user database
+    databases = find_databases([str(tmp_path)])
+    assert databases == [('alice', str(tmp_path / 'alice.db'))]
+
+    output, watermark = tmp_path / 'posts.jsonl', tmp_path / 'watermark.json'
+    export(databases, str(output), watermark=str(watermark))
+    posts = {post['code']: post for post in map(json.loads, output.read_text().splitlines())}
+    assert len(posts) == 50
+    assert [media['filename'] for media in posts['BA000000002']['media']] == [
+        'alice - BA000000002 ({}).{}'.format(num, ext)
+        for num, ext in [(1, 'jpg'), (2, 'mp4'), (3, 'jpg')]]
+
+    item = fake.item
+
+    def liked_again(user, num):
+        post = item(user, num)
+        post['likes']['count'] += num in (3, 30)
+        return post
+
+    fake.item = liked_again
+    sync('alice', tmp_path)
+    assert export(databases, str(output), watermark=str(watermark)) == 2
+    assert sorted(post['code'] for post in map(json.loads, output.read_text().splitlines())) == [
+        'BA000000003', 'BA000000030']
+
+    export(databases, str(tmp_path / 'posts.csv'), 'csv')
+    with open(str(tmp_path / 'posts.csv'), encoding='UTF-8', newline='') as file:
+        rows = list(csv.DictReader(file))
+    assert len(rows) == 50
+    assert {row['code']: len(json.loads(row['media'])) for row in rows}['BA000000002'] == 3
+
+
+def test_parquet_export(fake, tmp_path):
+    pyarrow = pytest.importorskip('pyarrow.parquet')
+    sync('alice', tmp_path)
+    output = str(tmp_path / 'posts.parquet')
+    assert export(find_databases([str(tmp_path)]), output, 'parquet') == 50
+    table = pyarrow.read_table(output)
+    assert table.num_rows == 50
+    assert sorted(table.column('code').to_pylist())[0] == 'BA000000000'
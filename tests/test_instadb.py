@@ -0,0 +1,47 @@
+import os
+import resource
+import sqlite3
+
+import pytest
+from conftest import sync
+
+import instadb
+
+
+def test_many_users_within_fd_limit(fake, tmp_path):
+    fake.posts = 3
+    users = ['user{:03d}'.format(num) for num in range(100)]
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # Room for a window of users, nowhere near enough for all of them at once
+    limit = len(os.listdir('/proc/self/fd')) + 64
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    try:
+        summaries = instadb.main(users, None, 0, str(tmp_path), None, 0,
+                                 only_db=True, subfolders=True)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    assert list(summaries) == users
+    assert all(summary['posts'] == 3 and not summary['errors']
+               for summary in summaries.values())
+    conn = sqlite3.connect(str(tmp_path / users[-1] / (users[-1] + '.db')))
+    assert conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0] == 3
+    conn.close()
+
+
+def test_query_command(fake, tmp_path, capsys):
+    sync('alice', tmp_path)
+
+    def query(*argv):
+        instadb.run_command(instadb.parse_command_args(
+            ['query', 'alice'] + list(argv) + ['--path', str(tmp_path)]))
+        return capsys.readouterr().out
+
+    output = query('"post 2"', '--media')
+    assert 'BA000000002  Post 2 by alice #fake' in output
+    assert 'alice - BA000000002 (3).jpg' in output
+    assert '\n1 posts\n' in output
+    assert '\n50 posts\n' in query()
+    with pytest.raises(SystemExit, match='Bad search'):
+        query('"unclosed')
@@ -0,0 +1,30 @@
+import builtins
+import os
+
+from manifest import Manifest
+
+
+def test_lookups_only_use_the_directory_scan(tmp_path, monkeypatch):
+    (tmp_path / 'alice - B1.jpg').write_bytes(b'\xff\xd8 cut short')
+    (tmp_path / 'alice - B2.jpg').write_bytes(b'')
+    (tmp_path / 'alice - B3.mp4').write_bytes(b'half')
+    (tmp_path / 'alice - B3.mp4.part').write_bytes(b'the rest')
+    (tmp_path / 'bob - B1.jpg').write_bytes(b'someone else')
+    manifest = Manifest('alice', str(tmp_path))
+
+    def no_io(*args, **kwargs):
+        raise AssertionError('a lookup touched the disk')
+
+    monkeypatch.setattr(builtins, 'open', no_io)
+    monkeypatch.setattr(os, 'stat', no_io)
+    monkeypatch.setattr(os.path, 'exists', no_io)
+
+    # A file cut short under its final name is left to `instadb.py verify`
+    assert 'alice - B1.jpg' in manifest
+    assert 'alice - B2.jpg' not in manifest  # empty
+    assert 'alice - B3.mp4' not in manifest  # unfinished
+    assert 'bob - B1.jpg' not in manifest
+    assert manifest.broken() == ['alice - B2.jpg', 'alice - B3.mp4']
+
+    manifest.add('alice - B3.mp4', 12)
+    assert 'alice - B3.mp4' in manifest
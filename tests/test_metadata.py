@@ -0,0 +1,75 @@
+import threading
+
+from metadata import ExifTool, process_image
+from pipeline import TaggingStage, TagJob
+
+
+def images(folder, names):
+    """Write empty .jpg files, return their TagJobs"""
+    jobs = []
+    for name in names:
+        path = folder / '{}.jpg'.format(name)
+        path.write_bytes(b'')
+        jobs.append(TagJob(str(path), 'alice', None, 'caption', ['alice'], 'B0'))
+    return jobs
+
+
+def test_tagging_stages_keep_their_own_results(exiftool, tmp_path):
+    jobs = {'good': images(tmp_path, ['good{}'.format(num) for num in range(50)]),
+            'bad': images(tmp_path, ['bad{}'.format(num) for num in range(50)])}
+    failures = {}
+
+    def tag(kind):
+        stage = TaggingStage(log=lambda message: None)
+        for job in jobs[kind]:
+            stage.submit(job)
+        failures[kind] = stage.close()
+
+    threads = [threading.Thread(target=tag, args=(kind,)) for kind in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert failures['good'] == []
+    assert sorted(path for path, _ in failures['bad']) == sorted(
+        job.path for job in jobs['bad'])
+
+
+def test_one_exiftool_process_tags_every_batch(exiftool, tmp_path):
+    tool = ExifTool(batch_size=20)
+    paths = [job.path for job in images(
+        tmp_path, ['photo{}'.format(num) for num in range(44)] + ['bad'])]
+    for path in paths:
+        process_image(path, 'alice', '2017:01:01 00:00:00', 'caption',
+                      ['alice'], 'B0', exiftool=tool)
+    process = tool.process  # started by the first full batch
+
+    results = tool.flush()
+    assert [path for path, _ in results] == paths
+    assert [path for path, output in results if output] == paths[-1:]
+    assert tool.process is process
+    tool.close()
+    assert tool.process is None
+
+
+def test_exiftool_restarts_after_it_dies(exiftool, tmp_path):
+    tool = ExifTool()
+    first, crash, second = [job.path for job in
+                            images(tmp_path, ['first', 'crash', 'second'])]
+    for path in (first, crash, second):
+        tool.queue(path, ['-Title=x'])
+    results = tool.flush()
+    # The rest of the batch is lost along with the process
+    assert results[0] == (first, '')
+    assert [path for path, output in results[1:] if output] == [crash, second]
+
+    tool.queue(second, ['-Title=x'])
+    assert tool.flush() == [(second, '')]
+    process = tool.process
+    process.kill()
+    process.wait()
+    tool.queue(second, ['-Title=x'])
+    assert tool.flush() == [(second, '')]
+    assert tool.process is not process
+    tool.close()
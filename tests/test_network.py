@@ -0,0 +1,58 @@
+import hashlib
+
+import pytest
+
+import network
+from network import FetchError, Retrieve, TokenBucket
+
+
+def media_url(fake, name='img.jpg'):
+    return 'http://127.0.0.1:{}/cdn/alice_1/{}'.format(fake.port, name)
+
+
+def test_download_resumes_part_file(fake, tmp_path):
+    path = tmp_path / 'img.jpg'
+    (tmp_path / 'img.jpg.part').write_bytes(fake.jpeg[:300])
+
+    digest = Retrieve(None, interactive=False).download(media_url(fake), str(path))
+
+    assert path.read_bytes() == fake.jpeg
+    assert digest == hashlib.sha256(fake.jpeg).hexdigest()
+    assert not (tmp_path / 'img.jpg.part').exists()
+
+
+def test_download_of_missing_file(fake, tmp_path):
+    retrieve = Retrieve(None, interactive=False, log=lambda message: None)
+    url = 'http://127.0.0.1:{}/gone.jpg'.format(fake.port)
+    assert retrieve.download(url, str(tmp_path / 'gone.jpg')) is False
+
+
+@pytest.mark.parametrize('short_body', [0, 300])
+def test_download_cut_short_gives_up(fake, tmp_path, monkeypatch, short_body):
+    monkeypatch.setattr(Retrieve, 'MAX_FAILURES', 3)
+    fake.short_body = short_body  # every response stops short
+    retrieve = Retrieve(None, interactive=False, log=lambda message: None)
+
+    with pytest.raises(FetchError, match='gave up after 3 failed requests'):
+        retrieve.download(media_url(fake), str(tmp_path / 'img.jpg'))
+    assert retrieve.media_bucket.interval > 0  # backed off like on a 429
+    assert not (tmp_path / 'img.jpg').exists()
+
+
+def test_throttled_bucket_waits_one_interval(monkeypatch):
+    clock = [0.0]
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(network, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(network, 'sleep', sleep)
+    bucket = TokenBucket(1.0, log=lambda message: None)
+
+    for _ in range(5):  # every request is answered with a 429
+        bucket.acquire()
+        bucket.throttle()
+    # One interval after each decrease, not one more for every 429 so far
+    assert waits == [2.0, 4.0, 8.0, 16.0]
@@ -0,0 +1,34 @@
+import pytest
+from conftest import sync
+
+from api import UserError
+from checkpoint import Checkpoint
+
+
+def test_private_user(fake, tmp_path):
+    fake.posts = 0  # an empty first page
+    with pytest.raises(UserError, match='Private user'):
+        sync('alice', tmp_path)
+
+
+def test_empty_last_page(fake, tmp_path):
+    fake.posts = 40
+    page = fake.page
+
+    def more_available_after_last_post(user, max_id):
+        js = page(user, max_id)
+        js['more_available'] = bool(js['items'])
+        return js
+
+    fake.page = more_available_after_last_post
+    summary = sync('alice', tmp_path)
+
+    assert summary['posts'] == 40
+    assert Checkpoint('alice', str(tmp_path)).complete
+
+
+def test_missing_user(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr('instadb.BASE_URL', 'http://127.0.0.1:{}/{{}}/gone/'.format(
+        fake.port))
+    with pytest.raises(UserError, match='Can\'t get posts'):
+        sync('alice', tmp_path)
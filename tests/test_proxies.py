@@ -0,0 +1,28 @@
+import requests
+
+from network import Retrieve
+
+
+def fail(retrieve, status=None):
+    """Send one request through the pool that fails with status"""
+    resp = None
+    if status:
+        resp = requests.Response()
+        resp.status_code = status
+    route = retrieve.route('https://www.instagram.com/alice/media/')
+    retrieve.failed(route, resp)
+    return route.proxy
+
+
+def test_overload_keeps_the_proxy():
+    retrieve = Retrieve(None, proxies=['127.0.0.1:3128'], interactive=False,
+                        log=lambda message: None)
+
+    for status in [429, 503]:
+        proxy = fail(retrieve, status)
+        assert proxy.cooldown_until == 0
+    assert proxy.failures == 2 and proxy.in_flight == 0
+    assert proxy.json_bucket.interval > 0  # the proxy's rate limiter backed off
+
+    proxy = fail(retrieve)  # a connection error is the proxy's fault
+    assert proxy.cooldown_until > 0
@@ -0,0 +1,67 @@
+import os
+import sqlite3
+
+from conftest import sync
+
+import instadb
+from verify import Checksums, read_repair_list, verify_archive
+
+
+def archive(fake, folder):
+    """Sync 8 of alice's posts with their files, tags left for later"""
+    fake.posts = 8
+    sync('alice', folder, only_db=False, write_db=True, tag_later=True)
+
+
+def verify(folder, include_missing=False):
+    return verify_archive(str(folder), str(folder / 'repair.jsonl'), workers=2,
+                          include_missing=include_missing)
+
+
+def test_retagged_file_is_not_bit_rot(fake, tmp_path):
+    archive(fake, tmp_path)
+    assert verify(tmp_path) == {'ok': 12}
+
+    # Tagged again with tags of the same length: exiftool keeps the size
+    # and sets the modification time to the post's date
+    path = tmp_path / 'alice - BA000000000.jpg'
+    stat = os.stat(str(path))
+    data = bytearray(path.read_bytes())
+    data[-3] ^= 0xff  # in the image data, before the end of image marker
+    path.write_bytes(bytes(data))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert verify(tmp_path) == {'ok': 12}
+
+    # Bytes that changed without a write are reported
+    conn = sqlite3.connect(str(tmp_path / Checksums.FILENAME))
+    conn.execute("UPDATE checksums SET hash='0' WHERE path=?",
+                 (os.path.abspath(str(path)),))
+    conn.commit()
+    conn.close()
+    assert verify(tmp_path)['changed'] == 1
+
+
+def test_broken_files_are_listed_and_repaired(fake, exiftool, tmp_path):
+    archive(fake, tmp_path)
+    truncated = [tmp_path / 'alice - BA000000000.jpg', tmp_path / 'alice - BA000000001.mp4']
+    for path in truncated:
+        path.write_bytes(path.read_bytes()[:200])
+    part = tmp_path / 'alice - BA000000003.jpg.part'
+    part.write_bytes(b'')
+    (tmp_path / 'alice - BA000000004.jpg').unlink()
+
+    assert verify(tmp_path) == {'ok': 8, 'truncated': 2, 'unfinished': 1, 'missing': 1}
+    entries = read_repair_list(str(tmp_path / 'repair.jsonl'))
+    assert sorted((entry['problem'], os.path.basename(entry['path']))
+                  for entry in entries) == [
+        ('truncated', 'alice - BA000000000.jpg'),
+        ('truncated', 'alice - BA000000001.mp4'),
+        ('unfinished', 'alice - BA000000003.jpg')]
+    assert all(entry['action'] == 'refetch' for entry in entries)
+
+    verify(tmp_path, include_missing=True)
+    entries = read_repair_list(str(tmp_path / 'repair.jsonl'))
+    assert len(entries) == 4
+    instadb.main(['alice'], None, 0, str(tmp_path), None, 0, repair=entries)
+    assert not part.exists()
+    assert verify(tmp_path) == {'ok': 12}